@@ -31,10 +31,11 @@ from getpass import getpass
 import urllib
 from xml.sax import saxutils
 from datetime import *
+from time import monotonic
 import sqlite3
 from sqlite3 import Error
 from ljdumpsqlite import *
-from ljdumptohtml import ljdumptohtml
+from ljdumptohtml import ljdumptohtml, parse_download_hours, set_download_throttle, throttle_download, describe_download_rate, download_throttle
 
 
 MimeExtensions = {
@@ -70,7 +71,7 @@ def gettext(e):
     return e[0].firstChild.nodeValue
 
 
-def ljdump(journal_server, username, password, journal_short_name, ljuniq=None, verbose=True, max_to_fetch=100, make_pages=False, cache_images=False, retry_images=True):
+def ljdump(journal_server, username, password, journal_short_name, ljuniq=None, verbose=True, max_to_fetch=100, make_pages=False, cache_images=False, retry_images=True, jobs=1, cache_fragments=False, memory_budget=None, comments_per_page=None, thread_depth=None, image_jobs=8, image_jobs_per_host=2, image_time_budget=10, image_byte_budget=None, image_order='oldest', image_max_size=20, revalidate_images=False, image_disk_budget=None, image_eviction='least_referenced', reconcile_images=False, download_rate_limit=None, download_rate_hours=None):
 
     m = re.search("(.*)/interface/xmlrpc", journal_server)
     if m:
@@ -400,6 +401,11 @@ def ljdump(journal_server, username, password, journal_short_name, ljuniq=None,
         if verbose:
             print("Fetching userpics for: %s" % journal_short_name)
 
+        # Userpics count against the same download rate limit as cached images.
+        set_download_throttle(download_rate_limit, download_rate_hours)
+        userpics_started = monotonic()
+        userpics_waited_before = download_throttle['waited']
+        userpic_bytes = 0
         for p in userpics:
             pic = urllib.request.urlopen(userpics[p])
             ext = MimeExtensions.get(pic.info()["Content-Type"], "")
@@ -411,13 +417,21 @@ def ljdump(journal_server, username, password, journal_short_name, ljuniq=None,
                 # for installations where the above utf_8_decode doesn't work
                 picfn = "".join([ord(x) < 128 and x or "_" for x in picfn])
                 picf = open("%s/userpics/%s%s" % (journal_short_name, picfn, ext), "wb")
-            shutil.copyfileobj(pic, picf)
+            while True:
+                chunk = pic.read(65536)
+                if not chunk:
+                    break
+                picf.write(chunk)
+                userpic_bytes += len(chunk)
+                throttle_download(len(chunk))
             pic.close()
             picf.close()
             insert_or_update_icon(cur, verbose,
                 {'keywords': p,
                     'filename': (picfn+ext),
                     'url': userpics[p]})
+        if verbose and (userpic_bytes > 0):
+            print("Fetched %s userpics (%.1f KB).  %s" % (len(userpics), userpic_bytes / 1024, describe_download_rate(userpic_bytes, userpics_started, userpics_waited_before)))
 
     sync_status['last_max_comment_id'] = new_max_comment_id
 
@@ -440,7 +454,24 @@ def ljdump(journal_server, username, password, journal_short_name, ljuniq=None,
             journal_short_name=journal_short_name,
             verbose=verbose,
             cache_images=cache_images,
-            retry_images=retry_images
+            retry_images=retry_images,
+            jobs=jobs,
+            cache_fragments=cache_fragments,
+            memory_budget=memory_budget,
+            comments_per_page=comments_per_page,
+            thread_depth=thread_depth,
+            image_jobs=image_jobs,
+            image_jobs_per_host=image_jobs_per_host,
+            image_time_budget=image_time_budget,
+            image_byte_budget=image_byte_budget,
+            image_order=image_order,
+            image_max_size=image_max_size,
+            revalidate_images=revalidate_images,
+            image_disk_budget=image_disk_budget,
+            image_eviction=image_eviction,
+            reconcile_images=reconcile_images,
+            download_rate_limit=download_rate_limit,
+            download_rate_hours=download_rate_hours
         )
 
 if __name__ == "__main__":
@@ -455,6 +486,40 @@ if __name__ == "__main__":
                       help="build a cache of images referenced in entries")
     args.add_argument("--dont_retry_images", "-d", action='store_false', dest='retry_images',
                       help="don't retry images that failed to cache once already")
+    args.add_argument('--jobs', '-j', type=int, default=1, dest='jobs',
+                      help='Number of processes to use when generating HTML pages.  Default is 1.')
+    args.add_argument("--cache_fragments", "-f", action='store_true', dest='cache_fragments',
+                      help="keep rendered entries in the database so later runs can reuse them")
+    args.add_argument('--memory_budget', '-m', type=int, default=None, dest='memory_budget',
+                      help='Approximate number of megabytes of memory to use when generating HTML pages.')
+    args.add_argument('--comments_per_page', type=int, default=None, dest='comments_per_page',
+                      help='Split the comments on an entry into pages of about this many.  Default is no limit.')
+    args.add_argument('--thread_depth', type=int, default=None, dest='thread_depth',
+                      help='Move replies deeper than this onto separate thread pages.  Default is no limit.')
+    args.add_argument('--image_jobs', type=int, default=8, dest='image_jobs',
+                      help='Number of images to download at once.  Default is 8.')
+    args.add_argument('--image_jobs_per_host', type=int, default=2, dest='image_jobs_per_host',
+                      help='Number of images to download at once from any one server.  Default is 2.')
+    args.add_argument('--image_time_budget', type=float, default=10, dest='image_time_budget',
+                      help='Minutes to spend caching images in one run.  Default is 10.')
+    args.add_argument('--image_byte_budget', type=float, default=None, dest='image_byte_budget',
+                      help='Megabytes of images to download in one run.  Default is no limit.')
+    args.add_argument('--image_order', choices=['oldest', 'newest', 'referenced'], default='oldest', dest='image_order',
+                      help='Which images to cache first: from the oldest entries, the newest, or the ones used in the most entries.  Default is oldest.')
+    args.add_argument('--image_max_size', type=float, default=20, dest='image_max_size',
+                      help='Largest image to cache, in megabytes.  Default is 20.')
+    args.add_argument("--revalidate_images", action='store_true', dest='revalidate_images',
+                      help="check cached images against the originals, and fetch any that have changed")
+    args.add_argument('--image_disk_budget', type=float, default=None, dest='image_disk_budget',
+                      help='Most megabytes of disk for the image cache to use.  Default is no limit.')
+    args.add_argument('--image_eviction', choices=['largest', 'least_referenced'], default='least_referenced', dest='image_eviction',
+                      help='Which images to delete first when the image cache is over its disk budget.  Default is least_referenced.')
+    args.add_argument("--reconcile_images", action='store_true', dest='reconcile_images',
+                      help="compare the image cache folder with the database, and fix any differences")
+    args.add_argument('--download_rate_limit', type=float, default=None, dest='download_rate_limit',
+                      help='Most kilobytes per second to download images and userpics at, all together.  Default is no limit.')
+    args.add_argument('--download_rate_hours', type=parse_download_hours, default=None, dest='download_rate_hours',
+                      help='Only limit the download rate between these times of day, like 08:00-23:30.  Default is all day.')
     args = args.parse_args()
     if os.access("ljdump.config", os.F_OK):
         config = xml.dom.minidom.parse("ljdump.config")
@@ -475,7 +540,7 @@ if __name__ == "__main__":
         # If a user is hosting images on Dreamwidth and using a config file, they will
         # put their cookie in the config file.  Asking for it every time would annoy users
         # who are not hosting images on Dreamwidth.
-        if args.cache_images:
+        if args.cache_images or args.revalidate_images:
             ljuniq_els = config.documentElement.getElementsByTagName("ljuniq")
             if len(ljuniq_els) > 0:
                 ljuniq = ljuniq_els[0].childNodes[0].data
@@ -490,7 +555,7 @@ if __name__ == "__main__":
         username = input("Username: ")
         password = getpass("Password: ")
         ljuniq = None
-        if args.cache_images:
+        if args.cache_images or args.revalidate_images:
             ljuniq = getpass("ljuniq cookie (for Dreamwidth hosted image downloads, leave blank otherwise): ")
         print
         print("You may back up either your own journal, or a community.")
@@ -515,6 +580,23 @@ if __name__ == "__main__":
             max_to_fetch=args.max_to_fetch,
             make_pages=args.make_pages,
             cache_images=args.cache_images,
-            retry_images=args.retry_images
+            retry_images=args.retry_images,
+            jobs=args.jobs,
+            cache_fragments=args.cache_fragments,
+            memory_budget=args.memory_budget,
+            comments_per_page=args.comments_per_page,
+            thread_depth=args.thread_depth,
+            image_jobs=args.image_jobs,
+            image_jobs_per_host=args.image_jobs_per_host,
+            image_time_budget=args.image_time_budget,
+            image_byte_budget=args.image_byte_budget,
+            image_order=args.image_order,
+            image_max_size=args.image_max_size,
+            revalidate_images=args.revalidate_images,
+            image_disk_budget=args.image_disk_budget,
+            image_eviction=args.image_eviction,
+            reconcile_images=args.reconcile_images,
+            download_rate_limit=args.download_rate_limit,
+            download_rate_hours=args.download_rate_hours
         )
 # vim:ts=4 et:	
@@ -26,13 +26,25 @@
 
 from datetime import *
 import calendar
+import json
+import os
+import re
 import sqlite3
+import urllib.request
 import xmlrpc.client
 from sqlite3 import Error
+from xml.etree import ElementTree as ET
 from xml.sax import saxutils
 from builtins import str
 
 
+# Finds the address of every image in an entry body that's worth caching.
+# It only matches complete img tags.
+image_tag_src_pattern = re.compile(r'<img[^<>]*\ssrc\s?=\s?[\'\"](https?:/+[^\s\"\'()<>]+)[\'\"]', flags=re.IGNORECASE)
+# Detects images hosted on Dreamwidth, which are linked at a particular size.
+dw_hosted_pattern = re.compile(r'^https://(\w+).dreamwidth.org/file/\d+x\d+/(.+)')
+
+
 # Subclass of tzinfo swiped mostly from dateutil
 class fancytzoffset(tzinfo):
     def __init__(self, name, offset):
@@ -73,22 +85,6 @@ class fancytzutc(tzinfo):
     __reduce__ = object.__reduce__
 
 
-def object_to_xml_string(accumulator, name, e):
-    accumulator += ("<%s>\n" % name)
-    for k in e.keys():
-        if isinstance(e[k], {}.__class__):
-            accumulator += object_to_xml_string(f, k, e[k])
-        else:
-            try:
-                s = str(e[k])
-            except UnicodeDecodeError:
-                # fall back to Latin-1 for old entries that aren't UTF-8
-                s = e[k].decode('cp1252')
-            accumulator += ("<%s>%s</%s>\n" % (k, saxutils.escape(s), k))
-    accumulator += ("</%s>\n" % name)
-    return accumulator
-
-
 def possible_unicode_or_none(u):
     if u is None:
         return None
@@ -103,18 +99,57 @@ def possible_unicode_or_none(u):
     return s
 
 
-def connect_to_local_journal_db(db_file, verbose):
+def props_to_json_string(props):
+    """ serialize the properties of an entry as compact JSON, so they can be queried later
+    with SQLite's JSON functions, e.g. json_extract(raw_props, '$.taglist')
+    :param props: dictionary of properties as received from data provider
+    :return: JSON string
+    """
+    return json.dumps(props, ensure_ascii=False, separators=(',', ':'), default=possible_unicode_or_none)
+
+
+def props_xml_string_to_object(xml_string):
+    """ convert a raw_props XML chunk, as written by versions of this script before 1.8,
+    back into a dictionary of properties
+    :param xml_string: XML chunk with a <props> root element
+    :return: A dictionary of properties
+    """
+    def element_to_object(el):
+        props = {}
+        for child in el:
+            if len(child) > 0:
+                props[child.tag] = element_to_object(child)
+            else:
+                props[child.tag] = child.text or u''
+        return props
+    try:
+        return element_to_object(ET.fromstring(xml_string))
+    except ET.ParseError:
+        # Old entries can contain characters that aren't legal in XML at all,
+        # so fall back to picking the simple <key>value</key> pairs out by hand.
+        props = {}
+        for (k, v) in re.findall(r'<([^<>/\s]+)>([^<]*)</\1>', xml_string):
+            props[k] = saxutils.unescape(v)
+        return props
+
+
+def connect_to_local_journal_db(db_file, verbose, read_only=False):
     """ create a database connection to the SQLite database
         specified by the db_file
     :param db_file: database file
     :param verbose: whether we are verbose logging
+    :param read_only: whether to open the database in read-only mode
     :return: Connection object or None
     """
     conn = None
     if verbose:
         print('Opening local database: %s' % db_file)
     try:
-        conn = sqlite3.connect(db_file)
+        if read_only:
+            db_uri = "file:%s?mode=ro" % urllib.request.pathname2url(os.path.abspath(db_file))
+            conn = sqlite3.connect(db_uri, uri=True)
+        else:
+            conn = sqlite3.connect(db_file)
     except Error as e:
         print(e)
 
@@ -143,6 +178,9 @@ def create_tables_if_missing(conn, verbose):
             userid INTEGER
         )""")
 
+    # revision goes up every time an entry is stored, so the HTML generator can tell which
+    # entries changed since its last run without reading them.  Entries are never deleted,
+    # so a revision is never seen twice.
     conn.execute("""
         CREATE TABLE IF NOT EXISTS entries (
             itemid INTEGER PRIMARY KEY NOT NULL,
@@ -166,7 +204,9 @@ def create_tables_if_missing(conn, verbose):
             props_picture_mapid INTEGER,
             props_taglist TEXT,
 
-            raw_props TEXT NOT NULL
+            raw_props TEXT NOT NULL,
+
+            revision INTEGER NOT NULL DEFAULT 0
         )""")
 
     conn.execute("""
@@ -179,6 +219,47 @@ def create_tables_if_missing(conn, verbose):
             ON "entries" (logtime_unix);
         """)
 
+    # Tags split out of props_taglist, one row per tag per entry.
+    # The time of the entry is repeated here so entries with a tag can be
+    # fetched in date order straight from the index.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS entry_tags (
+            entry_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            eventtime_unix REAL NOT NULL,
+            PRIMARY KEY (entry_id, tag)
+        )""")
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS entry_tags_tag_eventtime_unix
+            ON "entry_tags" (tag, eventtime_unix, entry_id);
+        """)
+
+    # Running totals kept up to date as entries, tags and comments are added,
+    # so pages that only need counts don't have to scan everything.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS month_entry_counts (
+            month TEXT PRIMARY KEY NOT NULL,
+            entry_count INTEGER NOT NULL,
+            first_itemid INTEGER,
+            last_itemid INTEGER
+        )""")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tag_entry_counts (
+            tag TEXT PRIMARY KEY NOT NULL,
+            entry_count INTEGER NOT NULL
+        )""")
+
+    # The revision here goes up every time a comment on the entry is stored.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS entry_comment_counts (
+            entry_id INTEGER PRIMARY KEY NOT NULL,
+            comment_count INTEGER NOT NULL,
+            revision INTEGER NOT NULL DEFAULT 0
+        )""")
+
     conn.execute("""
         CREATE TABLE IF NOT EXISTS comments (
             id INTEGER PRIMARY KEY NOT NULL,
@@ -190,7 +271,11 @@ def create_tables_if_missing(conn, verbose):
             user TEXT,
             subject TEXT,
             body TEXT,
-            state TEXT
+            state TEXT,
+
+            thread_root INTEGER,
+            depth INTEGER,
+            thread_path TEXT
         )""")
 
     conn.execute("""
@@ -241,6 +326,22 @@ def create_tables_if_missing(conn, verbose):
     # This table does not reflect any data taken directly from the journal site.
     # It's used to resolve URLs for images in entries with their cached counterparts,
     # when building the local HTML.
+    # It's also the queue of images still to fetch.  An image that fails to cache is
+    # tried again at next_attempt, with attempt_count counting the failures so far,
+    # and last_error saying what happened the last time.  Images that keep failing
+    # are eventually marked failed_permanently, and left alone.  Images bigger than
+    # --image_max_size are given up on straight away, with the limit at the time kept in
+    # failed_max_size, so they can be tried again if the limit is raised.
+    # content_hash is the SHA-1 of the file.  Images with the same content share one file.
+    # etag and last_modified are what the server said about the cached copy, so it can be
+    # checked for changes later without downloading it again.
+    # Images are evicted when the cache goes over its disk budget.  Their files are
+    # deleted and they're marked as not cached, so pages link to the originals again.
+    # width and height are the size of the image in pixels.  They're 0 if the file was looked
+    # at but its size couldn't be worked out, and NULL if it hasn't been looked at yet.
+    # reference_count, first_entry_id and first_entry_eventtime_unix say how many entries
+    # use the image, and which one is the earliest, so the download queue can be read
+    # in order straight from an index.  They're kept up to date by refresh_image_references.
     conn.execute("""
         CREATE TABLE IF NOT EXISTS cached_images (
             id INTEGER PRIMARY KEY NOT NULL,
@@ -248,9 +349,343 @@ def create_tables_if_missing(conn, verbose):
             filename TEXT,
             date_first_seen REAL,
             date_last_attempted REAL,
-            cached INTEGER NOT NULL
+            cached INTEGER NOT NULL,
+
+            next_attempt REAL,
+            attempt_count INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            failed_permanently INTEGER NOT NULL DEFAULT 0,
+            failed_max_size INTEGER,
+
+            content_hash TEXT,
+            size INTEGER,
+
+            etag TEXT,
+            last_modified TEXT,
+            date_last_validated REAL,
+
+            evicted INTEGER NOT NULL DEFAULT 0,
+
+            width INTEGER,
+            height INTEGER,
+
+            reference_count INTEGER NOT NULL DEFAULT 0,
+            first_entry_id INTEGER,
+            first_entry_eventtime_unix INTEGER
+        )""")
+
+    # The images referenced by each entry, found when the entry is stored, so the image
+    # cache doesn't have to search every entry for them.  normalized_url is the address
+    # the image is cached under (see image_url_in_cache), and image_id is its record in
+    # cached_images.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS entry_images (
+            entry_id INTEGER NOT NULL,
+            raw_url TEXT NOT NULL,
+            normalized_url TEXT NOT NULL,
+            image_id INTEGER NOT NULL,
+            PRIMARY KEY (entry_id, raw_url)
+        )""")
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS entry_images_image_id
+            ON "entry_images" (image_id, entry_id);
+        """)
+
+    # This table also does not reflect any data from the journal site.
+    # It records a hash of everything that went into each generated HTML page,
+    # so pages whose inputs haven't changed can be skipped next time.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS build_manifest (
+            filename TEXT PRIMARY KEY NOT NULL,
+            input_hash TEXT NOT NULL
+        )""")
+
+    # This table also does not reflect any data from the journal site.
+    # When asked to, the HTML generator keeps the rendered block for each entry here,
+    # along with a hash of what went into it, so later runs can reuse it.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS entry_fragments (
+            entry_id INTEGER PRIMARY KEY NOT NULL,
+            input_hash TEXT NOT NULL,
+            html TEXT NOT NULL
         )""")
 
+    upgrade_tables_if_needed(conn, verbose)
+
+
+def upgrade_tables_if_needed(conn, verbose):
+    """ run any migrations needed to bring an existing database up to the current schema.
+    The schema version is kept in SQLite's user_version pragma.  Migrations must be safe
+    to run against freshly created tables, since a new database starts at version 0 too.
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for (migration_version, migration) in schema_migrations:
+        if version < migration_version:
+            if verbose:
+                print('Upgrading database to schema version %d' % migration_version)
+            migration(conn, verbose)
+            conn.execute("PRAGMA user_version = %d" % migration_version)
+            conn.commit()
+
+
+def migrate_raw_props_to_json(conn, verbose):
+    """ convert the raw_props of every entry from the old XML chunks to JSON
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    cur = conn.execute("SELECT itemid, raw_props FROM entries WHERE raw_props LIKE '<%'")
+    converted = []
+    for row in cur.fetchall():
+        converted.append((props_to_json_string(props_xml_string_to_object(row[1])), row[0]))
+    if verbose:
+        print('Converting properties of %d entries to JSON' % len(converted))
+    conn.executemany("UPDATE entries SET raw_props = ? WHERE itemid = ?", converted)
+
+
+def migrate_backfill_entry_tags(conn, verbose):
+    """ fill the entry_tags table from the props_taglist of every entry
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    if verbose:
+        print('Indexing tags of all entries')
+    cur = conn.cursor()
+    cur.execute("SELECT itemid, eventtime_unix, props_taglist FROM entries WHERE props_taglist IS NOT NULL")
+    for row in cur.fetchall():
+        update_entry_tags(cur, row[0], row[1], row[2])
+    cur.close()
+
+
+def add_column_if_missing(conn, table, column, definition):
+    """ add a column to an existing table, unless it's already there
+    :param conn: database connection
+    :param table: table name
+    :param column: column name
+    :param definition: column type and constraints
+    """
+    columns = [row[1] for row in conn.execute('PRAGMA table_info("%s")' % table).fetchall()]
+    if not (column in columns):
+        conn.execute('ALTER TABLE "%s" ADD COLUMN %s %s' % (table, column, definition))
+
+
+def migrate_add_comment_threads(conn, verbose):
+    """ add thread root, depth and path columns to comments.  They are filled in by
+    migrate_compact_comment_thread_paths.
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    add_column_if_missing(conn, "comments", "thread_root", "INTEGER")
+    add_column_if_missing(conn, "comments", "depth", "INTEGER")
+    add_column_if_missing(conn, "comments", "thread_path", "TEXT")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS comments_entryid_thread_path
+            ON "comments" (entryid, thread_path);
+        """)
+
+
+def migrate_compact_comment_thread_paths(conn, verbose):
+    """ compute the thread root, depth and path of every comment, replacing the longer
+    paths written by earlier versions, and index comments by parent so the replies to a
+    comment can be found quickly
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS comments_entryid_parentid
+            ON "comments" (entryid, parentid);
+        """)
+
+    if verbose:
+        print('Computing comment thread structure')
+    comments_by_entry = {}
+    for row in conn.execute("SELECT id, entryid, parentid FROM comments").fetchall():
+        if not (row[1] in comments_by_entry):
+            comments_by_entry[row[1]] = {}
+        comments_by_entry[row[1]][row[0]] = comment_parent_id_or_none(row[2])
+
+    positions = []
+    for parents in comments_by_entry.values():
+        resolved = {}
+        for comment_id in parents.keys():
+            # Walk up to the nearest comment already resolved (or the top of the thread),
+            # then resolve everything on the way back down.
+            chain = []
+            c_id = comment_id
+            while (c_id is not None) and (c_id in parents) and not (c_id in resolved) and not (c_id in chain):
+                chain.append(c_id)
+                c_id = parents[c_id]
+            if c_id is None:
+                above = None
+            elif c_id in resolved:
+                above = resolved[c_id]
+            else:
+                # Parent missing from this entry, or a loop.
+                above = (None, None, None)
+            for c_id in reversed(chain):
+                if above is None:
+                    position = (c_id, 1, comment_thread_path_segment(c_id))
+                else:
+                    position = comment_thread_position_below(above, c_id)
+                resolved[c_id] = position
+                above = position
+        for (c_id, position) in resolved.items():
+            positions.append(position + (c_id,))
+
+    conn.executemany("""
+        UPDATE comments SET thread_root = ?, depth = ?, thread_path = ?
+        WHERE id = ?""", positions)
+
+
+def migrate_backfill_counts(conn, verbose):
+    """ fill in the month_entry_counts, tag_entry_counts and entry_comment_counts tables
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    if verbose:
+        print('Counting entries by month and tag, and comments by entry')
+    cur = conn.cursor()
+    cur.execute("DELETE FROM month_entry_counts")
+    cur.execute("SELECT DISTINCT strftime('%Y-%m', eventtime_unix, 'unixepoch') FROM entries")
+    for row in cur.fetchall():
+        refresh_month_entry_count(cur, row[0])
+    cur.execute("DELETE FROM tag_entry_counts")
+    cur.execute("""
+        INSERT INTO tag_entry_counts (tag, entry_count)
+            SELECT tag, COUNT(*) FROM entry_tags GROUP BY tag""")
+    cur.execute("DELETE FROM entry_comment_counts")
+    cur.execute("""
+        INSERT INTO entry_comment_counts (entry_id, comment_count)
+            SELECT entryid, COUNT(*) FROM comments GROUP BY entryid""")
+    cur.close()
+
+
+def migrate_backfill_entry_images(conn, verbose):
+    """ fill the entry_images table from the body of every entry
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    if verbose:
+        print('Indexing images in all entries')
+    cur = conn.cursor()
+    cur.execute("SELECT itemid, eventtime_unix, event FROM entries")
+    for row in cur.fetchall():
+        update_entry_images(cur, row[0], row[1], row[2])
+    cur.close()
+
+
+def migrate_add_image_fetch_queue(conn, verbose):
+    """ add retry scheduling columns to cached_images, and carry over earlier attempts
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    add_column_if_missing(conn, "cached_images", "next_attempt", "REAL")
+    add_column_if_missing(conn, "cached_images", "attempt_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(conn, "cached_images", "last_error", "TEXT")
+    add_column_if_missing(conn, "cached_images", "failed_permanently", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute("DROP INDEX IF EXISTS cached_images_cached_date_last_attempted")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS cached_images_queue
+            ON "cached_images" (cached, failed_permanently, next_attempt);
+        """)
+    # Before this, a failed image was simply tried again a day later.
+    conn.execute("""
+        UPDATE cached_images SET
+            attempt_count = 1,
+            next_attempt = date_last_attempted + 86400
+        WHERE cached = 0 AND date_last_attempted IS NOT NULL AND attempt_count = 0""")
+
+
+def migrate_add_image_content_hashes(conn, verbose):
+    """ add content hash and size columns to cached_images
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    add_column_if_missing(conn, "cached_images", "content_hash", "TEXT")
+    add_column_if_missing(conn, "cached_images", "size", "INTEGER")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS cached_images_content_hash
+            ON "cached_images" (content_hash);
+        """)
+
+
+def migrate_add_image_validators(conn, verbose):
+    """ add ETag, Last-Modified and last validation columns to cached_images
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    add_column_if_missing(conn, "cached_images", "etag", "TEXT")
+    add_column_if_missing(conn, "cached_images", "last_modified", "TEXT")
+    add_column_if_missing(conn, "cached_images", "date_last_validated", "REAL")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS cached_images_cached_date_last_validated
+            ON "cached_images" (cached, date_last_validated);
+        """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS cached_images_filename
+            ON "cached_images" (filename);
+        """)
+
+
+def migrate_add_image_eviction(conn, verbose):
+    """ add the evicted column to cached_images
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    add_column_if_missing(conn, "cached_images", "evicted", "INTEGER NOT NULL DEFAULT 0")
+
+
+def migrate_add_image_dimensions(conn, verbose):
+    """ add width and height columns to cached_images.  Images already cached are left
+    with no size, and are measured the next time pages are made.
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    add_column_if_missing(conn, "cached_images", "width", "INTEGER")
+    add_column_if_missing(conn, "cached_images", "height", "INTEGER")
+
+
+def migrate_add_image_queue_order(conn, verbose):
+    """ add the columns and indexes that let the image download queue be read in order from an index
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    add_column_if_missing(conn, "cached_images", "reference_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(conn, "cached_images", "first_entry_id", "INTEGER")
+    add_column_if_missing(conn, "cached_images", "first_entry_eventtime_unix", "INTEGER")
+    conn.execute(image_references_update)
+    # One for each of image_queue_orders.  'newest' reads the first one backwards.
+    # These take over from cached_images_queue, which could find the due images but not
+    # put them in order.
+    conn.execute("DROP INDEX IF EXISTS cached_images_queue")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS cached_images_queue_by_date
+            ON "cached_images" (cached, failed_permanently, evicted, first_entry_eventtime_unix, id);
+        """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS cached_images_queue_by_references
+            ON "cached_images" (cached, failed_permanently, evicted, reference_count DESC, first_entry_eventtime_unix, id);
+        """)
+
+
+def migrate_add_change_revisions(conn, verbose):
+    """ add revision counters to entries and entry comment counts
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    add_column_if_missing(conn, "entries", "revision", "INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(conn, "entry_comment_counts", "revision", "INTEGER NOT NULL DEFAULT 0")
+
+
+def migrate_add_image_failed_max_size(conn, verbose):
+    """ add the column that records the size limit an image was too large for
+    :param conn: database connection
+    :param verbose: whether we are verbose logging
+    """
+    add_column_if_missing(conn, "cached_images", "failed_max_size", "INTEGER")
+
 
 def get_sync_status_or_defaults(cur, last_sync, last_max_comment_id):
     """ get values from the current status record, or create a new one if missing
@@ -318,67 +753,298 @@ def insert_or_update_user_info(cur, verbose, data):
                 userid = :userid""", data)
 
 
-def get_all_events(cur, verbose):
+# Columns selected when reading entries, in the order entry_from_row expects them.
+entry_columns = """
+            entries.itemid,
+            entries.anum,
+            entries.eventtime, entries.eventtime_unix,
+            entries.logtime, entries.logtime_unix,
+
+            entries.subject, entries.event, entries.url,
+
+            entries.props_commentalter,
+            entries.props_current_moodid,
+            entries.props_current_music,
+            entries.props_import_source,
+            entries.props_interface,
+            entries.props_opt_backdated,
+            entries.props_picture_keyword,
+            entries.props_picture_mapid,
+            entries.props_taglist"""
+
+
+def entry_from_row(row):
+    """ convert a row selected with entry_columns into an entry object
+    :param row: database row
+    :return: An entry object
+    """
+    return {
+        "itemid": row[0],
+        "anum": row[1],
+        "eventtime": row[2],
+        "eventtime_unix": row[3],
+        "logtime": row[4],
+        "logtime_unix": row[5],
+
+        "subject": row[6] or u'(no subject)',
+        "event": row[7],
+        "url": row[8],
+
+        "props_commentalter": row[9],
+        "props_current_moodid": row[10],
+        "props_current_music": row[11],
+        "props_import_source": row[12],
+        "props_interface": row[13],
+        "props_opt_backdated": row[14],
+        "props_picture_keyword": row[15],
+        "props_picture_mapid": row[16],
+        "props_taglist": row[17],
+    }
+
+
+def attach_tags_to_entries(cur, entries):
+    """ add a 'tags' array to each of the given entry objects, in the order the tags were given
+    :param cur: database cursor
+    :param entries: array of entry objects
+    """
+    entries_by_id = {}
+    for entry in entries:
+        entry['tags'] = []
+        entries_by_id[entry['itemid']] = entry
+    if len(entries_by_id) == 0:
+        return
+    if len(entries_by_id) < 500:
+        ids = list(entries_by_id.keys())
+        cur.execute("""
+            SELECT entry_id, tag FROM entry_tags
+            WHERE entry_id IN (%s) ORDER BY entry_id, position""" % ",".join("?" * len(ids)), ids)
+    else:
+        cur.execute("SELECT entry_id, tag FROM entry_tags ORDER BY entry_id, position")
+    for row in cur.fetchall():
+        if row[0] in entries_by_id:
+            entries_by_id[row[0]]['tags'].append(row[1])
+
+
+def get_all_events(cur, verbose, include_raw_props=False):
     """ get all entries in the database
     :param cur: database cursor
     :param verbose: whether we are verbose logging
+    :param include_raw_props: whether to also fetch and decode the full set of properties
     :return: An array of entry objects
     """
     if verbose:
         print('Fetching all entries from database')
     cur.execute("""
-        SELECT
-            itemid,
-            anum,
-            eventtime, eventtime_unix,
-            logtime, logtime_unix,
-
-            subject, event, url,
-
-            props_commentalter,
-            props_current_moodid,
-            props_current_music,
-            props_import_source,
-            props_interface,
-            props_opt_backdated,
-            props_picture_keyword,
-            props_picture_mapid,
-            props_taglist,
-
-            raw_props
-        FROM entries ORDER BY itemid""")
+        SELECT %s,
+            %s
+        FROM entries ORDER BY itemid""" % (entry_columns, "raw_props" if include_raw_props else "NULL"))
     rows = cur.fetchall()
     entries = []
     for row in rows:
-        title = (row[1] or u'')
-        entry = {
-            "itemid": row[0],
-            "anum": row[1],
-            "eventtime": row[2],
-            "eventtime_unix": row[3],
-            "logtime": row[4],
-            "logtime_unix": row[5],
-
-            "subject": row[6] or u'(no subject)',
-            "event": row[7],
-            "url": row[8],
-
-            "props_commentalter": row[9],
-            "props_current_moodid": row[10],
-            "props_current_music": row[11],
-            "props_import_source": row[12],
-            "props_interface": row[13],
-            "props_opt_backdated": row[14],
-            "props_picture_keyword": row[15],
-            "props_picture_mapid": row[16],
-            "props_taglist": row[17],
-
-            "raw_props": row[18],
-        }
+        entry = entry_from_row(row)
+        if include_raw_props:
+            entry["raw_props"] = json.loads(row[18])
         entries.append(entry)
+    attach_tags_to_entries(cur, entries)
+    return entries
+
+
+def get_event(cur, verbose, itemid):
+    """ get one entry by id
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param itemid: id of entry
+    :return: An entry object, or None if not found
+    """
+    cur.execute("SELECT %s FROM entries WHERE itemid = ?" % entry_columns, (itemid,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    entry = entry_from_row(row)
+    attach_tags_to_entries(cur, [entry])
+    return entry
+
+
+def get_events_by_id(cur, verbose, itemids):
+    """ get a batch of entries by id
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param itemids: ids of entries
+    :return: A dictionary of entry ids to entry objects.  Entries that weren't found are left out.
+    """
+    itemids = list(itemids)
+    entries = []
+    # SQLite limits how many values can go in one query.
+    for start in range(0, len(itemids), 500):
+        ids = itemids[start:start + 500]
+        cur.execute("""
+            SELECT %s FROM entries
+            WHERE itemid IN (%s)""" % (entry_columns, ",".join("?" * len(ids))), ids)
+        entries.extend([entry_from_row(row) for row in cur.fetchall()])
+    attach_tags_to_entries(cur, entries)
+    entries_by_id = {}
+    for entry in entries:
+        entries_by_id[entry['itemid']] = entry
+    return entries_by_id
+
+
+def get_entry_change_markers(cur, verbose):
+    """ get a small summary of every entry, ordered by date, oldest to newest, that changes whenever
+    the entry or any of its comments do
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: An array of (itemid, eventtime_unix, revision, comment count, comments revision) tuples
+    """
+    if verbose:
+        print('Fetching entry revisions from database')
+    cur.execute("""
+        SELECT entries.itemid, entries.eventtime_unix, entries.revision,
+            IFNULL(entry_comment_counts.comment_count, 0), IFNULL(entry_comment_counts.revision, 0)
+        FROM entries LEFT JOIN entry_comment_counts ON entry_comment_counts.entry_id = entries.itemid
+        ORDER BY entries.eventtime_unix, entries.itemid""")
+    return [tuple(row) for row in cur.fetchall()]
+
+
+def get_events_page(cur, verbose, after=None, limit=100):
+    """ get a page of entries ordered by date, oldest to newest, starting after a given entry.
+    Entries with the same timestamp are ordered by itemid.  To get the next page, pass in the
+    last entry of this one.
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param after: entry object (or anything with 'eventtime_unix' and 'itemid') to start after, or None to start at the beginning
+    :param limit: maximum number of entries to return
+    :return: An array of entry objects
+    """
+    if after is None:
+        cur.execute("""
+            SELECT %s FROM entries
+            ORDER BY eventtime_unix, itemid LIMIT ?""" % entry_columns, (limit,))
+    else:
+        cur.execute("""
+            SELECT %s FROM entries
+            WHERE (eventtime_unix, itemid) > (?, ?)
+            ORDER BY eventtime_unix, itemid LIMIT ?""" % entry_columns,
+            (after['eventtime_unix'], after['itemid'], limit))
+    entries = [entry_from_row(row) for row in cur.fetchall()]
+    attach_tags_to_entries(cur, entries)
+    return entries
+
+
+def iterate_events_by_date(cur, verbose, page_size=200):
+    """ go through all entries ordered by date, oldest to newest, fetching a page at a time
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param page_size: number of entries to fetch from the database at once
+    :return: A generator of entry objects
+    """
+    if verbose:
+        print('Fetching all entries by date from database')
+    entries = get_events_page(cur, verbose, None, page_size)
+    while len(entries) > 0:
+        for entry in entries:
+            yield entry
+        entries = get_events_page(cur, verbose, entries[-1], page_size)
+
+
+def get_events_in_range(cur, verbose, start_unix, end_unix):
+    """ get all entries from a span of time, ordered by date, oldest to newest
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param start_unix: start of span, as a UNIX timestamp (inclusive)
+    :param end_unix: end of span, as a UNIX timestamp (exclusive)
+    :return: An array of entry objects
+    """
+    cur.execute("""
+        SELECT %s FROM entries
+        WHERE eventtime_unix >= ? AND eventtime_unix < ?
+        ORDER BY eventtime_unix, itemid""" % entry_columns, (start_unix, end_unix))
+    entries = [entry_from_row(row) for row in cur.fetchall()]
+    attach_tags_to_entries(cur, entries)
     return entries
 
 
+def get_events_in_month(cur, verbose, year, month):
+    """ get all entries from one month, ordered by date, oldest to newest
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param year: year, e.g. 2024
+    :param month: month, 1 to 12
+    :return: An array of entry objects
+    """
+    if verbose:
+        print('Fetching entries for %04d-%02d from database' % (year, month))
+    (start_unix, end_unix) = month_range_unix(year, month)
+    return get_events_in_range(cur, verbose, start_unix, end_unix)
+
+
+def get_events_in_year(cur, verbose, year):
+    """ get all entries from one year, ordered by date, oldest to newest
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param year: year, e.g. 2024
+    :return: An array of entry objects
+    """
+    if verbose:
+        print('Fetching entries for %04d from database' % year)
+    start_unix = calendar.timegm((year, 1, 1, 0, 0, 0))
+    end_unix = calendar.timegm((year + 1, 1, 1, 0, 0, 0))
+    return get_events_in_range(cur, verbose, start_unix, end_unix)
+
+
+def get_entry_summaries_in_range(cur, verbose, start_unix, end_unix):
+    """ get the id, date and subject of every entry from a span of time, ordered by date, oldest
+    to newest.  That's all a list of entries needs, and it's much smaller than the entries themselves.
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param start_unix: start of span, as a UNIX timestamp (inclusive)
+    :param end_unix: end of span, as a UNIX timestamp (exclusive)
+    :return: An array of (itemid, eventtime_unix, subject) tuples
+    """
+    cur.execute("""
+        SELECT itemid, eventtime_unix, subject FROM entries
+        WHERE eventtime_unix >= ? AND eventtime_unix < ?
+        ORDER BY eventtime_unix, itemid""", (start_unix, end_unix))
+    return [(row[0], row[1], row[2] or u'(no subject)') for row in cur.fetchall()]
+
+
+def get_neighbor_events(cur, verbose, entry):
+    """ get the entries immediately before and after the given one, by date
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param entry: entry object (or anything with 'eventtime_unix' and 'itemid')
+    :return: A tuple of (previous entry, next entry), either of which may be None
+    """
+    cur.execute("""
+        SELECT %s FROM entries
+        WHERE (eventtime_unix, itemid) < (?, ?)
+        ORDER BY eventtime_unix DESC, itemid DESC LIMIT 1""" % entry_columns,
+        (entry['eventtime_unix'], entry['itemid']))
+    row = cur.fetchone()
+    previous_entry = entry_from_row(row) if row else None
+    cur.execute("""
+        SELECT %s FROM entries
+        WHERE (eventtime_unix, itemid) > (?, ?)
+        ORDER BY eventtime_unix, itemid LIMIT 1""" % entry_columns,
+        (entry['eventtime_unix'], entry['itemid']))
+    row = cur.fetchone()
+    next_entry = entry_from_row(row) if row else None
+    return (previous_entry, next_entry)
+
+
+def get_event_raw_props(cur, verbose, itemid):
+    """ get the full set of properties saved for one entry
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param itemid: id of entry
+    :return: A dictionary of properties, or None if the entry doesn't exist
+    """
+    cur.execute("SELECT raw_props FROM entries WHERE itemid = :itemid", {'itemid': itemid})
+    row = cur.fetchone()
+    if not row:
+        return None
+    return json.loads(row[0])
+
+
 def insert_or_update_event(cur, verbose, ev):
     """ insert a new entry or update any preexisting one with a matching itemid
     :param cur: database cursor
@@ -392,9 +1058,9 @@ def insert_or_update_event(cur, verbose, ev):
     eventtime = eventtime.replace(tzinfo=tz_utc)
     logtime = datetime.strptime(ev['logtime'], '%Y-%m-%d %H:%M:%S')
     logtime = logtime.replace(tzinfo=tz_utc)
-    # Preserve all the properties as an XML chunk in case there are
+    # Preserve all the properties as JSON in case there are
     # some we're not aware of here.
-    prop_dump = object_to_xml_string('<?xml version="1.0"?>', "props", ev['props'])
+    prop_dump = props_to_json_string(ev['props'])
     event_content = possible_unicode_or_none(ev['event'])
     event_subject = None
     if 'subject' in ev:
@@ -427,8 +1093,9 @@ def insert_or_update_event(cur, verbose, ev):
         "raw_props": prop_dump,
     }
 
-    cur.execute("SELECT itemid FROM entries WHERE itemid = :itemid", data)
+    cur.execute("SELECT itemid, eventtime_unix FROM entries WHERE itemid = :itemid", data)
     row = cur.fetchone()
+    months_affected = set([month_of_timestamp(data['eventtime_unix'])])
     if not row:
         if verbose:
             print('Adding new event %s at %s: %s' % (data['itemid'], data['eventtime'], data['subject']))
@@ -473,6 +1140,7 @@ def insert_or_update_event(cur, verbose, ev):
                 :raw_props
             )""", data)
     else:
+        months_affected.add(month_of_timestamp(row[1]))
         if verbose:
             print('Updating event %s at %s: %s' % (data['itemid'], data['eventtime'], data['subject']))
         cur.execute("""
@@ -497,51 +1165,524 @@ def insert_or_update_event(cur, verbose, ev):
                 props_picture_mapid = :props_picture_mapid,
                 props_taglist = :props_taglist,
 
-                raw_props = :raw_props
+                raw_props = :raw_props,
+
+                revision = revision + 1
 
             WHERE itemid = :itemid""", data)
 
+    tags_affected = update_entry_tags(cur, data['itemid'], data['eventtime_unix'], taglist)
+    images_affected = update_entry_images(cur, data['itemid'], data['eventtime_unix'], event_content)
 
-def get_all_comments(cur, verbose):
-    """ get all comments in the database
-    :param cur: database cursor
-    :param verbose: whether we are verbose logging
-    :return: An array of comment objects
-    """
+    for month in months_affected:
+        refresh_month_entry_count(cur, month)
+    for tag in tags_affected:
+        refresh_tag_entry_count(cur, tag)
+    for image_id in images_affected:
+        refresh_image_references(cur, image_id)
+
+
+def split_taglist(taglist):
+    """ split a taglist property into individual tags
+    :param taglist: comma-separated list of tags, or None
+    :return: An array of tags, in the order given
+    """
+    if taglist is None:
+        return []
+    return [tag for tag in taglist.split(', ') if tag != '']
+
+
+def update_entry_tags(cur, itemid, eventtime_unix, taglist):
+    """ replace the rows in the entry_tags table for the given entry
+    :param cur: database cursor
+    :param itemid: id of entry
+    :param eventtime_unix: timestamp of entry, kept alongside each tag for date-ordered lookups
+    :param taglist: comma-separated list of tags, or None
+    :return: A set of all the tags the entry had before, or has now
+    """
+    cur.execute("SELECT tag FROM entry_tags WHERE entry_id = ?", (itemid,))
+    tags_affected = set([row[0] for row in cur.fetchall()])
+    cur.execute("DELETE FROM entry_tags WHERE entry_id = ?", (itemid,))
+    rows = []
+    for (position, tag) in enumerate(split_taglist(taglist)):
+        rows.append((itemid, tag, position, eventtime_unix))
+        tags_affected.add(tag)
+    cur.executemany("""
+        INSERT OR IGNORE INTO entry_tags (
+            entry_id, tag, position, eventtime_unix
+        ) VALUES (?, ?, ?, ?)""", rows)
+    return tags_affected
+
+
+def image_url_in_cache(image_url):
+    """ the address an image is cached under.  Dreamwidth-hosted images are cached at
+    full size, under the address without the size in it.
+    :param image_url: url of image as it appears in an entry
+    :return: The url to cache it under
+    """
+    dw_hosted = dw_hosted_pattern.match(image_url)
+    if dw_hosted:
+        return 'https://' + dw_hosted.group(1) + '.dreamwidth.org/file/' + dw_hosted.group(2)
+    return image_url
+
+
+def update_entry_images(cur, itemid, eventtime_unix, event):
+    """ replace the rows in the entry_images table for the given entry, creating
+    image cache records for any images not seen before
+    :param cur: database cursor
+    :param itemid: id of entry
+    :param eventtime_unix: timestamp of entry, used as the date new images were first seen
+    :param event: body of entry
+    :return: A set of the ids of all the images the entry used before, or uses now
+    """
+    cur.execute("SELECT image_id FROM entry_images WHERE entry_id = ?", (itemid,))
+    images_affected = set([row[0] for row in cur.fetchall()])
+    cur.execute("DELETE FROM entry_images WHERE entry_id = ?", (itemid,))
+    if event is None:
+        return images_affected
+    urls = {}
+    for raw_url in image_tag_src_pattern.findall(event):
+        urls[raw_url] = image_url_in_cache(raw_url)
+    if len(urls) == 0:
+        return images_affected
+    cur.executemany("""
+        INSERT OR IGNORE INTO cached_images (
+            url, date_first_seen, cached
+        ) VALUES (?, ?, 0)""", [(url, eventtime_unix) for url in set(urls.values())])
+    cur.executemany("""
+        INSERT INTO entry_images (
+            entry_id, raw_url, normalized_url, image_id
+        ) SELECT ?, ?, url, id FROM cached_images WHERE url = ?""",
+        [(itemid, raw_url, normalized_url) for (raw_url, normalized_url) in urls.items()])
+    cur.execute("SELECT image_id FROM entry_images WHERE entry_id = ?", (itemid,))
+    images_affected.update([row[0] for row in cur.fetchall()])
+    return images_affected
+
+
+def get_image_urls_by_entry(cur, verbose):
+    """ get the addresses of the images used by each entry, as they are cached
+    (see image_url_in_cache)
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: A dictionary of entry ids to arrays of image urls
+    """
     if verbose:
-        print('Fetching all comments from database')
+        print('Fetching image addresses by entry from database')
+    cur.execute("SELECT entry_id, normalized_url FROM entry_images ORDER BY entry_id, raw_url")
+    urls_by_entry = {}
+    for row in cur.fetchall():
+        if not (row[0] in urls_by_entry):
+            urls_by_entry[row[0]] = []
+        urls_by_entry[row[0]].append(row[1])
+    return urls_by_entry
+
+
+# Sets the reference_count, first_entry_id, and first_entry_eventtime_unix of cached_images.
+image_references_update = """
+    UPDATE cached_images SET
+        reference_count = (SELECT COUNT(*) FROM entry_images ei WHERE ei.image_id = cached_images.id),
+        (first_entry_id, first_entry_eventtime_unix) = (
+            SELECT e.itemid, e.eventtime_unix
+            FROM entry_images ei JOIN entries e ON e.itemid = ei.entry_id
+            WHERE ei.image_id = cached_images.id
+            ORDER BY e.eventtime_unix, e.itemid LIMIT 1)"""
+
+
+def refresh_image_references(cur, image_id):
+    """ recount the entries that use one image, and find the earliest of them, for the download queue
+    :param cur: database cursor
+    :param image_id: id of image
+    """
+    cur.execute(image_references_update + " WHERE id = ?", (image_id,))
+
+
+def month_of_timestamp(timestamp):
+    """ the month a UNIX timestamp falls in, as used in the month_entry_counts table
+    :param timestamp: UNIX timestamp
+    :return: A string like "2024-09"
+    """
+    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m")
+
+
+def month_range_unix(year, month):
+    """ the span of time covered by a month
+    :param year: year, e.g. 2024
+    :param month: month, 1 to 12
+    :return: A tuple of UNIX timestamps for the start of the month (inclusive) and the end (exclusive)
+    """
+    start_unix = calendar.timegm((year, month, 1, 0, 0, 0))
+    if month == 12:
+        end_unix = calendar.timegm((year + 1, 1, 1, 0, 0, 0))
+    else:
+        end_unix = calendar.timegm((year, month + 1, 1, 0, 0, 0))
+    return (start_unix, end_unix)
+
+
+def refresh_month_entry_count(cur, month):
+    """ recount the entries in one month and update its row in month_entry_counts
+    :param cur: database cursor
+    :param month: month, as a string like "2024-09"
+    """
+    (start_unix, end_unix) = month_range_unix(int(month[0:4]), int(month[5:7]))
+    cur.execute("""
+        SELECT COUNT(*) FROM entries
+        WHERE eventtime_unix >= ? AND eventtime_unix < ?""", (start_unix, end_unix))
+    entry_count = cur.fetchone()[0]
+    if entry_count == 0:
+        cur.execute("DELETE FROM month_entry_counts WHERE month = ?", (month,))
+        return
     cur.execute("""
-        SELECT
-            id,
-            entryid,
-            date, date_unix,
+        SELECT itemid FROM entries
+        WHERE eventtime_unix >= ? AND eventtime_unix < ?
+        ORDER BY eventtime_unix, itemid LIMIT 1""", (start_unix, end_unix))
+    first_itemid = cur.fetchone()[0]
+    cur.execute("""
+        SELECT itemid FROM entries
+        WHERE eventtime_unix >= ? AND eventtime_unix < ?
+        ORDER BY eventtime_unix DESC, itemid DESC LIMIT 1""", (start_unix, end_unix))
+    last_itemid = cur.fetchone()[0]
+    cur.execute("""
+        INSERT OR REPLACE INTO month_entry_counts (
+            month, entry_count, first_itemid, last_itemid
+        ) VALUES (?, ?, ?, ?)""", (month, entry_count, first_itemid, last_itemid))
+
+
+def refresh_tag_entry_count(cur, tag):
+    """ recount the entries with one tag and update its row in tag_entry_counts
+    :param cur: database cursor
+    :param tag: tag name
+    """
+    cur.execute("SELECT COUNT(*) FROM entry_tags WHERE tag = ?", (tag,))
+    entry_count = cur.fetchone()[0]
+    if entry_count == 0:
+        cur.execute("DELETE FROM tag_entry_counts WHERE tag = ?", (tag,))
+    else:
+        cur.execute("""
+            INSERT OR REPLACE INTO tag_entry_counts (tag, entry_count) VALUES (?, ?)""", (tag, entry_count))
+
+
+def get_month_entry_counts(cur, verbose):
+    """ get the number of entries in each month that has any, with the first and last entry of each
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: An array of objects, ordered by month, oldest to newest
+    """
+    if verbose:
+        print('Fetching entry counts by month from database')
+    cur.execute("SELECT month, entry_count, first_itemid, last_itemid FROM month_entry_counts ORDER BY month")
+    months = []
+    for row in cur.fetchall():
+        months.append({
+            "month": row[0],
+            "year": int(row[0][0:4]),
+            "month_number": int(row[0][5:7]),
+            "entry_count": row[1],
+            "first_itemid": row[2],
+            "last_itemid": row[3]
+        })
+    return months
+
+
+def get_tag_entry_counts(cur, verbose):
+    """ get the number of entries using each tag
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: A dictionary of tag names to entry counts
+    """
+    if verbose:
+        print('Fetching entry counts by tag from database')
+    cur.execute("SELECT tag, entry_count FROM tag_entry_counts")
+    counts = {}
+    for row in cur.fetchall():
+        counts[row[0]] = row[1]
+    return counts
+
+
+def get_tags_in_use(cur, verbose):
+    """ get the names of all tags used by at least one entry
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: An array of tag names, sorted
+    """
+    if verbose:
+        print('Fetching tags in use from database')
+    cur.execute("SELECT DISTINCT tag FROM entry_tags ORDER BY tag")
+    return [row[0] for row in cur.fetchall()]
+
+
+def get_entries_with_tag(cur, verbose, tag):
+    """ get all entries with the given tag, ordered by date, oldest to newest
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param tag: tag name
+    :return: An array of entry objects
+    """
+    if verbose:
+        print('Fetching entries with tag: %s' % tag)
+    cur.execute("""
+        SELECT %s
+        FROM entry_tags JOIN entries ON entries.itemid = entry_tags.entry_id
+        WHERE entry_tags.tag = ?
+        ORDER BY entry_tags.eventtime_unix, entry_tags.entry_id""" % entry_columns, (tag,))
+    entries = [entry_from_row(row) for row in cur.fetchall()]
+    attach_tags_to_entries(cur, entries)
+    return entries
+
+
+def get_entry_summaries_with_tag(cur, verbose, tag):
+    """ get the id, date and subject of every entry with the given tag, ordered by date, oldest to newest
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param tag: tag name
+    :return: An array of (itemid, eventtime_unix, subject) tuples
+    """
+    cur.execute("""
+        SELECT entries.itemid, entries.eventtime_unix, entries.subject
+        FROM entry_tags JOIN entries ON entries.itemid = entry_tags.entry_id
+        WHERE entry_tags.tag = ?
+        ORDER BY entry_tags.eventtime_unix, entry_tags.entry_id""", (tag,))
+    return [(row[0], row[1], row[2] or u'(no subject)') for row in cur.fetchall()]
+
+
+def get_entry_ids_by_tag(cur, verbose):
+    """ get the ids of all tagged entries, grouped by tag, using only the entry_tags index
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: A dictionary of tag names to arrays of entry ids, ordered by date
+    """
+    if verbose:
+        print('Fetching entry ids by tag from database')
+    cur.execute("""
+        SELECT tag, entry_id FROM entry_tags
+        ORDER BY tag, eventtime_unix, entry_id""")
+    entry_ids_by_tag = {}
+    for row in cur.fetchall():
+        if not (row[0] in entry_ids_by_tag):
+            entry_ids_by_tag[row[0]] = []
+        entry_ids_by_tag[row[0]].append(row[1])
+    return entry_ids_by_tag
+
+
+# Columns selected when reading comments, in the order comment_from_row expects them.
+comment_columns = """
+            comments.id,
+            comments.entryid,
+            comments.date, comments.date_unix,
+
+            comments.parentid,
+            comments.posterid,
+            comments.user,
+
+            comments.subject, comments.body, comments.state,
 
-            parentid,
-            posterid,
-            user,
+            comments.thread_root, comments.depth, comments.thread_path"""
 
-            subject, body, state
-        FROM comments ORDER BY id""")
+
+def comment_from_row(row):
+    """ convert a row selected with comment_columns into a comment object
+    :param row: database row
+    :return: A comment object
+    """
+    return {
+        "id": row[0],
+        "entryid": row[1],
+        "date": row[2],
+        "date_unix": row[3],
+        "parentid": row[4],
+        "posterid": row[5],
+        "user": row[6],
+        "subject": row[7],
+        "body": row[8],
+        "state": row[9],
+        "thread_root": row[10],
+        "depth": row[11],
+        "thread_path": row[12],
+    }
+
+
+def get_all_comments(cur, verbose):
+    """ get all comments in the database, grouped by entry, and in thread order within each entry
+    (see get_comments_for_entry)
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: An array of comment objects
+    """
+    if verbose:
+        print('Fetching all comments from database')
+    cur.execute("""
+        SELECT %s
+        FROM comments ORDER BY entryid, thread_path""" % comment_columns)
     rows = cur.fetchall()
     comments = []
     for row in rows:
-        title = (row[1] or u'')
-        comment = {
-            "id": row[0],
-            "entryid": row[1],
-            "date": row[2],
-            "date_unix": row[3],
-            "parentid": row[4],
-            "posterid": row[5],
-            "user": row[6],
-            "subject": row[7],
-            "body": row[8],
-            "state": row[9],
-        }
-        comments.append(comment)
+        comments.append(comment_from_row(row))
     return comments
 
 
+def get_comments_for_entry(cur, verbose, entry_id):
+    """ get all comments for one entry, in the order they are displayed: Each top-level comment
+    is followed by its replies, and replies to those replies, depth-first, ordered by id at each level
+    (down to comment_thread_max_depth).  Comments whose parent is missing come first, with a
+    thread_path of None.
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param entry_id: id of entry
+    :return: An array of comment objects
+    """
+    if verbose:
+        print('Fetching comments for entry %s' % entry_id)
+    cur.execute("""
+        SELECT %s
+        FROM comments WHERE entryid = ? ORDER BY thread_path""" % comment_columns, (entry_id,))
+    return [comment_from_row(row) for row in cur.fetchall()]
+
+
+def get_comment_count_for_entry(cur, verbose, entry_id):
+    """ get the number of comments on one entry
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param entry_id: id of entry
+    :return: Number of comments
+    """
+    cur.execute("SELECT comment_count FROM entry_comment_counts WHERE entry_id = ?", (entry_id,))
+    row = cur.fetchone()
+    if not row:
+        return 0
+    return row[0]
+
+
+def refresh_entry_comment_count(cur, entry_id):
+    """ recount the comments on one entry and update its row in entry_comment_counts, counting
+    one more revision of its comments.  The row is kept even with no comments left, so its
+    revision keeps going up.
+    :param cur: database cursor
+    :param entry_id: id of entry
+    """
+    cur.execute("SELECT COUNT(*) FROM comments WHERE entryid = ?", (entry_id,))
+    comment_count = cur.fetchone()[0]
+    cur.execute("""
+        UPDATE entry_comment_counts SET comment_count = ?, revision = revision + 1
+        WHERE entry_id = ?""", (comment_count, entry_id))
+    if cur.rowcount == 0:
+        cur.execute("""
+            INSERT INTO entry_comment_counts (entry_id, comment_count, revision) VALUES (?, ?, 1)""",
+            (entry_id, comment_count))
+
+
+def comment_parent_id_or_none(parentid):
+    """ normalize the parentid of a comment, which is an empty string (or 0) for top-level comments
+    :param parentid: parentid as received from data provider or stored in the database
+    :return: Integer id of the parent comment, or None
+    """
+    if parentid is None or parentid == '':
+        return None
+    parentid = int(parentid)
+    if parentid == 0:
+        return None
+    return parentid
+
+
+# A thread path is the path of the comment's parent with one fixed-width segment added
+# for the comment itself, so sorting paths as strings puts every comment after its parent
+# and its earlier siblings' replies.  Each level costs a segment in every comment below it,
+# so paths only grow until comment_thread_max_depth: replies deeper than that are all shown
+# one level below their ancestor at that depth, in the order they were written.
+comment_thread_max_depth = 100
+# Digits for path segments, in the order both SQLite and Python sort them.
+comment_thread_path_digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+# Six of them cover ids up to 62**6, well past the 32-bit ids handed out by the servers.
+comment_thread_path_segment_length = 6
+
+
+def comment_thread_path_segment(comment_id):
+    """ the piece of a thread path that represents one comment.  Fixed-width, so that sorting
+    paths as strings puts sibling comments in id order.
+    :param comment_id: id of comment
+    :return: String
+    """
+    n = int(comment_id)
+    digits = []
+    for i in range(0, comment_thread_path_segment_length):
+        digits.append(comment_thread_path_digits[n % 62])
+        n //= 62
+    return ''.join(reversed(digits))
+
+
+def comment_thread_position_below(parent_position, comment_id):
+    """ the thread root, depth and path of a reply, given those of the comment it replies to
+    :param parent_position: (thread root, depth, thread path) of the parent comment
+    :param comment_id: id of the reply
+    :return: (thread root, depth, thread path), all None if the parent has no place in a thread
+    """
+    (thread_root, depth, thread_path) = parent_position
+    if thread_path is None:
+        return (None, None, None)
+    if depth > comment_thread_max_depth:
+        # The parent is already as deep as threads go, so the reply goes next to it.
+        return (thread_root, depth, thread_path[:-comment_thread_path_segment_length] + comment_thread_path_segment(comment_id))
+    return (thread_root, depth + 1, thread_path + comment_thread_path_segment(comment_id))
+
+
+def update_comment_thread_position(cur, comment_id):
+    """ compute the thread root, depth and path of a comment from its parent, and then do the
+    same for all the replies underneath it.  A comment whose parent isn't in the database (yet),
+    or would end up underneath itself, gets None for all three, and so do its replies.
+    :param cur: database cursor
+    :param comment_id: id of comment
+    """
+    cur.execute("SELECT entryid, parentid FROM comments WHERE id = ?", (comment_id,))
+    row = cur.fetchone()
+    if not row:
+        return
+    (entry_id, parent_id) = (row[0], comment_parent_id_or_none(row[1]))
+
+    # The comment and everything underneath it, in one query.  UNION skips rows it has
+    # already seen, so this ends even on a damaged thread that loops back on itself.
+    cur.execute("""
+        WITH RECURSIVE subtree(id) AS (
+            SELECT ?
+            UNION
+            SELECT comments.id FROM comments JOIN subtree
+                ON comments.entryid = ? AND comments.parentid = subtree.id
+        )
+        SELECT comments.id, comments.parentid,
+            comments.thread_root, comments.depth, comments.thread_path
+        FROM subtree JOIN comments ON comments.id = subtree.id""", (comment_id, entry_id))
+    old_positions = {}
+    replies_by_parent = {}
+    for row in cur.fetchall():
+        old_positions[row[0]] = (row[2], row[3], row[4])
+        if row[0] != comment_id:
+            reply_parent_id = comment_parent_id_or_none(row[1])
+            if not (reply_parent_id in replies_by_parent):
+                replies_by_parent[reply_parent_id] = []
+            replies_by_parent[reply_parent_id].append(row[0])
+
+    position = (None, None, None)
+    if parent_id is None:
+        position = (comment_id, 1, comment_thread_path_segment(comment_id))
+    elif not (parent_id in old_positions):
+        cur.execute("""
+            SELECT thread_root, depth, thread_path FROM comments
+            WHERE id = ? AND entryid = ?""", (parent_id, entry_id))
+        parent = cur.fetchone()
+        if parent:
+            position = comment_thread_position_below(parent, comment_id)
+
+    # Only the rows whose position actually changed are written.
+    changed = []
+    pending = [(comment_id, position)]
+    while len(pending) > 0:
+        (c_id, position) = pending.pop()
+        if position != old_positions[c_id]:
+            changed.append(position + (c_id,))
+        for reply_id in replies_by_parent.get(c_id, []):
+            pending.append((reply_id, comment_thread_position_below(position, reply_id)))
+    cur.executemany("""
+        UPDATE comments SET thread_root = ?, depth = ?, thread_path = ?
+        WHERE id = ?""", changed)
+
+
 def insert_or_update_comment(cur, verbose, comment):
     """ insert a new comment or update any preexisting one with a matching id
     :param cur: database cursor
@@ -562,7 +1703,7 @@ def insert_or_update_comment(cur, verbose, comment):
         comment['date'] = commenttime.isoformat()
         comment['date_unix'] = calendar.timegm(commenttime.utctimetuple())
 
-    cur.execute("SELECT id FROM comments WHERE id = :id", comment)
+    cur.execute("SELECT id, entryid FROM comments WHERE id = :id", comment)
     row = cur.fetchone()
     if not row:
         if verbose:
@@ -589,6 +1730,8 @@ def insert_or_update_comment(cur, verbose, comment):
 
                 :subject, :body, :state
             )""", comment)
+        update_comment_thread_position(cur, comment['id'])
+        refresh_entry_comment_count(cur, comment['entryid'])
         return True
     else:
         if verbose:
@@ -608,6 +1751,10 @@ def insert_or_update_comment(cur, verbose, comment):
                 state = :state
 
             WHERE id = :id""", comment)
+        update_comment_thread_position(cur, comment['id'])
+        if row[1] != comment['entryid']:
+            refresh_entry_comment_count(cur, row[1])
+        refresh_entry_comment_count(cur, comment['entryid'])
         return False
 
 
@@ -859,28 +2006,75 @@ def get_or_create_cached_image_record(cur, verbose, image_url, date_first_seen=N
         return data
 
 
-def report_image_as_attempted(cur, verbose, image_id):
-    """ update the record for an image showing that a fetch was recently attempted but failed.
+# Failed images are tried again after a day, then two, then four, and so on up to this many days.
+image_retry_max_days = 64
+# Images are given up on after this many failed attempts...
+image_max_attempts = 8
+# ...or this many, if the server keeps saying the image is gone, or sends something that isn't an image.
+image_gone_max_attempts = 3
+image_gone_errors = ['http 404', 'http 410', 'not an image']
+
+
+def report_image_as_attempted(cur, verbose, image_id, error=None, max_size=None):
+    """ update the record for an image showing that a fetch was recently attempted but failed,
+    and schedule the next attempt.  After enough failures the image is marked as failed for good.
+    An image that was too large is marked as failed for good right away, until the size limit
+    goes up (see allow_too_large_images_again).
     :param cur: database cursor
     :param verbose: whether we are verbose logging
     :param image_id: id of image
+    :param error: what went wrong: 'http <status>', 'dns', 'timeout', 'not an image', 'too large', or 'other'
+    :param max_size: the size limit in bytes the image was checked against (optional)
     """
     current_date = calendar.timegm(datetime.utcnow().utctimetuple())
+    max_attempts = image_max_attempts
+    if error in image_gone_errors:
+        max_attempts = image_gone_max_attempts
+    elif error == 'too large':
+        max_attempts = 1
+    cur.execute("SELECT attempt_count FROM cached_images WHERE id = :id", {"id": image_id})
+    row = cur.fetchone()
+    attempt_count = 1
+    if row:
+        attempt_count = row[0] + 1
     data = {
         "id": image_id,
-        "date_last_attempted": current_date
+        "date_last_attempted": current_date,
+        "next_attempt": current_date + 86400 * min(2 ** (attempt_count - 1), image_retry_max_days),
+        "attempt_count": attempt_count,
+        "last_error": error,
+        "failed_permanently": 1 if attempt_count >= max_attempts else 0,
+        "failed_max_size": max_size if error == 'too large' else None
     }
-    cur.execute("UPDATE cached_images SET date_last_attempted = :date_last_attempted WHERE id = :id", data)
+    if verbose and data['failed_permanently']:
+        print('Giving up on image %s after %s attempts (%s)' % (image_id, attempt_count, error))
+    cur.execute("""
+        UPDATE cached_images SET
+            date_last_attempted = :date_last_attempted,
+            next_attempt = :next_attempt,
+            attempt_count = :attempt_count,
+            last_error = :last_error,
+            failed_permanently = :failed_permanently,
+            failed_max_size = :failed_max_size
+        WHERE id = :id""", data)
 
 
-def report_image_as_cached(cur, verbose, image_id, filename, date_first_seen=None):
-    """ attempt to fetch an image cache record for the given url, or create and return one if none found.
-    The date_first_seen parameter is not used to uniquely identify the record and can be None.
+def report_image_as_cached(cur, verbose, image_id, filename, date_first_seen=None, content_hash=None, size=None, etag=None, last_modified=None, width=None, height=None):
+    """ mark an image as cached, record what's known about its file, and clear any earlier
+    failed attempts.  Images with the same content can share one file.
     :param cur: database cursor
     :param verbose: whether we are verbose logging
     :param image_id: id of image
-    :param date_first_seen: timestamp of entry in which url was first seen (optional)
+    :param filename: filename of the cached image, relative to the images folder
+    :param date_first_seen: date of the entry in which the image was first seen, as a datetime (optional)
+    :param content_hash: SHA-1 of the image file (optional)
+    :param size: size of the image file in bytes (optional)
+    :param etag: ETag header sent with the image (optional)
+    :param last_modified: Last-Modified header sent with the image (optional)
+    :param width: width of the image in pixels (optional)
+    :param height: height of the image in pixels (optional)
     """
+    date_or_none = None
     if date_first_seen:
         date_or_none = calendar.timegm(date_first_seen.utctimetuple())
     current_date = calendar.timegm(datetime.utcnow().utctimetuple())
@@ -888,7 +2082,13 @@ def report_image_as_cached(cur, verbose, image_id, filename, date_first_seen=Non
         "id": image_id,
         "filename": filename,
         "date_first_seen": date_or_none,
-        "date_last_attempted": current_date
+        "date_last_attempted": current_date,
+        "content_hash": content_hash,
+        "size": size,
+        "etag": etag,
+        "last_modified": last_modified,
+        "width": width,
+        "height": height
     }
     if verbose:
         print('Reporting image as cached: %s' % (filename))
@@ -897,10 +2097,379 @@ def report_image_as_cached(cur, verbose, image_id, filename, date_first_seen=Non
             filename = :filename,
             date_first_seen = :date_first_seen,
             date_last_attempted = :date_last_attempted,
+            next_attempt = NULL,
+            attempt_count = 0,
+            last_error = NULL,
+            failed_permanently = 0,
+            failed_max_size = NULL,
+            content_hash = :content_hash,
+            size = :size,
+            etag = :etag,
+            last_modified = :last_modified,
+            width = :width,
+            height = :height,
+            date_last_validated = :date_last_attempted,
             cached = 1
         WHERE id = :id""", data)
 
 
+def report_image_as_validated(cur, verbose, image_id):
+    """ update the record for a cached image showing that it was just checked against its source
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param image_id: id of image
+    """
+    current_date = calendar.timegm(datetime.utcnow().utctimetuple())
+    cur.execute("""
+        UPDATE cached_images SET date_last_validated = :date_last_validated
+        WHERE id = :id""", {"id": image_id, "date_last_validated": current_date})
+
+
+def get_images_to_revalidate(cur, verbose, validated_before, limit=None):
+    """ get cached images that can be checked for changes with a conditional request,
+    and haven't been checked since the given time, the ones checked longest ago first
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param validated_before: timestamp
+    :param limit: most images to return, or None for all of them
+    :return: An array of cache records, each with the url of the earliest entry that references it
+    """
+    data = {
+        'validated_before': validated_before,
+        'limit': -1
+    }
+    if limit is not None:
+        data['limit'] = limit
+    # SQLite takes the bare column e.url from the row that has the MIN.
+    cur.execute("""
+        SELECT ci.id, ci.url, ci.filename, ci.date_first_seen, ci.etag, ci.last_modified, MIN(e.eventtime_unix), e.url
+        FROM cached_images ci
+            LEFT JOIN entry_images ei ON ei.image_id = ci.id
+            LEFT JOIN entries e ON e.itemid = ei.entry_id
+        WHERE ci.cached = 1
+            AND (ci.date_last_validated IS NULL OR ci.date_last_validated < :validated_before)
+            AND (ci.etag IS NOT NULL OR ci.last_modified IS NOT NULL)
+        GROUP BY ci.id
+        ORDER BY ci.date_last_validated, ci.id
+        LIMIT :limit""", data)
+    images = []
+    for row in cur.fetchall():
+        image = {
+            "id": row[0],
+            "url": row[1],
+            "filename": row[2],
+            "date_first_seen": row[3],
+            "etag": row[4],
+            "last_modified": row[5],
+            "entry_url": row[7]
+        }
+        images.append(image)
+    return images
+
+
+def get_image_cache_size(cur, verbose):
+    """ get the space taken up by cached image files, counting each shared file once
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: Size in bytes
+    """
+    cur.execute("""
+        SELECT SUM(size) FROM (
+            SELECT MAX(size) AS size FROM cached_images
+            WHERE cached = 1
+            GROUP BY filename
+        )""")
+    row = cur.fetchone()
+    return row[0] or 0
+
+
+# The orders get_image_files_to_evict can return files in.
+image_eviction_orders = {
+    'largest': "size DESC, reference_count, filename",
+    'least_referenced': "reference_count, size DESC, filename"
+}
+
+
+def get_unsized_cached_image_filenames(cur, verbose):
+    """ get the files of cached images whose size isn't known yet
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: An array of filenames
+    """
+    cur.execute("SELECT DISTINCT filename FROM cached_images WHERE cached = 1 AND size IS NULL")
+    return [row[0] for row in cur.fetchall()]
+
+
+def report_image_file_size(cur, verbose, filename, size):
+    """ record the size of a cached image file, for every image that uses it and has no size yet
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param filename: name of the file in the images folder
+    :param size: size of the file in bytes
+    """
+    cur.execute("""
+        UPDATE cached_images SET size = :size
+        WHERE filename = :filename AND size IS NULL""", {"filename": filename, "size": size})
+
+
+def get_unmeasured_cached_image_filenames(cur, verbose):
+    """ get the files of cached images whose width and height haven't been looked for yet
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: An array of filenames
+    """
+    cur.execute("SELECT DISTINCT filename FROM cached_images WHERE cached = 1 AND width IS NULL")
+    return [row[0] for row in cur.fetchall()]
+
+
+def report_image_file_dimensions(cur, verbose, filename, width, height):
+    """ record the width and height of a cached image file, for every image that uses it
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param filename: name of the file in the images folder
+    :param width: width of the image in pixels, or 0 if it couldn't be worked out
+    :param height: height of the image in pixels, or 0 if it couldn't be worked out
+    """
+    cur.execute("""
+        UPDATE cached_images SET width = :width, height = :height
+        WHERE filename = :filename AND width IS NULL""", {"filename": filename, "width": width, "height": height})
+
+
+def get_image_files_to_evict(cur, verbose, order='least_referenced'):
+    """ get every cached image file, in the order they should be evicted
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param order: 'largest' for the biggest files first, or 'least_referenced' for the
+        files used by the fewest entries first
+    :return: An array of dicts with the filename, size, and reference_count of each file
+    """
+    cur.execute("""
+        SELECT ci.filename, MAX(ci.size) AS size, COUNT(DISTINCT ei.entry_id) AS reference_count
+        FROM cached_images ci
+            LEFT JOIN entry_images ei ON ei.image_id = ci.id
+        WHERE ci.cached = 1
+        GROUP BY ci.filename
+        ORDER BY %s""" % image_eviction_orders[order])
+    files = []
+    for row in cur.fetchall():
+        files.append({
+            "filename": row[0],
+            "size": row[1] or 0,
+            "reference_count": row[2]
+        })
+    return files
+
+
+def report_image_file_as_evicted(cur, verbose, filename):
+    """ mark every image using the given file as evicted from the cache
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param filename: filename of the image, relative to the images folder
+    """
+    if verbose:
+        print('Evicting image from cache: %s' % (filename))
+    cur.execute("""
+        UPDATE cached_images SET
+            cached = 0,
+            evicted = 1,
+            filename = NULL,
+            next_attempt = NULL,
+            attempt_count = 0,
+            last_error = NULL,
+            failed_permanently = 0,
+            failed_max_size = NULL
+        WHERE filename = ? AND cached = 1""", (filename,))
+
+
+def allow_evicted_images_again(cur, verbose):
+    """ put evicted images back in the queue of images to cache
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    """
+    cur.execute("UPDATE cached_images SET evicted = 0 WHERE evicted = 1")
+
+
+def allow_too_large_images_again(cur, verbose, max_size):
+    """ put images that were too large back in the queue of images to cache,
+    if the size limit is now higher than it was when they were given up on
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param max_size: the size limit in bytes for this run, or None for no limit
+    """
+    cur.execute("""
+        UPDATE cached_images SET
+            next_attempt = NULL,
+            attempt_count = 0,
+            last_error = NULL,
+            failed_permanently = 0,
+            failed_max_size = NULL
+        WHERE cached = 0 AND failed_permanently = 1 AND last_error = 'too large'
+            AND (:max_size IS NULL OR failed_max_size < :max_size)""", {'max_size': max_size})
+    if verbose and cur.rowcount > 0:
+        print('The image size limit went up, so %s images that were too large will be tried again' % cur.rowcount)
+
+
+def get_cached_image_filenames(cur, verbose):
+    """ get the filename of every cached image file
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: A set of filenames, relative to the images folder
+    """
+    cur.execute("SELECT DISTINCT filename FROM cached_images WHERE cached = 1 AND filename IS NOT NULL")
+    return set([row[0] for row in cur.fetchall()])
+
+
+def report_image_files_as_missing(cur, verbose, filenames):
+    """ mark every image using any of the given files as not cached, and due to be fetched again
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param filenames: filenames of the images, relative to the images folder
+    """
+    cur.executemany("""
+        UPDATE cached_images SET
+            cached = 0,
+            filename = NULL,
+            content_hash = NULL,
+            size = NULL,
+            etag = NULL,
+            last_modified = NULL,
+            next_attempt = NULL,
+            attempt_count = 0,
+            last_error = NULL,
+            failed_permanently = 0,
+            failed_max_size = NULL
+        WHERE filename = ? AND cached = 1""", [(filename,) for filename in filenames])
+
+
+def get_cached_image_file_use_count(cur, verbose, filename):
+    """ count the cached images that use the given file
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param filename: filename of the image, relative to the images folder
+    :return: The number of records
+    """
+    cur.execute("SELECT COUNT(*) FROM cached_images WHERE filename = ? AND cached = 1", (filename,))
+    return cur.fetchone()[0]
+
+
+def report_image_content(cur, verbose, image_id, content_hash, size, width=None, height=None):
+    """ record the content hash, size and dimensions of an image that's already cached
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param image_id: id of image
+    :param content_hash: SHA-1 of the image file
+    :param size: size of the image file in bytes
+    :param width: width of the image in pixels (optional)
+    :param height: height of the image in pixels (optional)
+    """
+    data = {
+        "id": image_id,
+        "content_hash": content_hash,
+        "size": size,
+        "width": width,
+        "height": height
+    }
+    cur.execute("""
+        UPDATE cached_images SET content_hash = :content_hash, size = :size, width = :width, height = :height
+        WHERE id = :id""", data)
+
+
+def get_cached_image_record_with_content(cur, verbose, content_hash):
+    """ find an image already cached with the given content, if there is one
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param content_hash: SHA-1 of the image file
+    :return: The cache record of the image, or None
+    """
+    cur.execute("""
+        SELECT id, url, filename FROM cached_images
+        WHERE content_hash = :content_hash AND cached = 1
+        ORDER BY id LIMIT 1""", {"content_hash": content_hash})
+    row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        "id": row[0],
+        "url": row[1],
+        "filename": row[2]
+    }
+
+
+def get_unhashed_cached_image_records(cur, verbose):
+    """ get the records of cached images that have no content hash yet
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: An array of cache records
+    """
+    cur.execute("""
+        SELECT id, url, filename FROM cached_images
+        WHERE cached = 1 AND content_hash IS NULL""")
+    images = []
+    for row in cur.fetchall():
+        image = {
+            "id": row[0],
+            "url": row[1],
+            "filename": row[2]
+        }
+        images.append(image)
+    return images
+
+
+# The orders get_images_to_cache can return images in.
+image_queue_orders = {
+    'oldest': "ci.first_entry_eventtime_unix, ci.id",
+    'newest': "ci.first_entry_eventtime_unix DESC, ci.id DESC",
+    'referenced': "ci.reference_count DESC, ci.first_entry_eventtime_unix, ci.id"
+}
+
+
+def get_images_to_cache(cur, verbose, now, retry=True, order='oldest', limit=None):
+    """ get the next images referenced by entries that are due to be fetched for the cache.
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param now: timestamp; images whose next attempt is later than this are left out
+    :param retry: whether to include images that have failed to cache before
+    :param order: 'oldest' or 'newest' to go by the date of the earliest entry with the image,
+        or 'referenced' for the images used in the most entries first
+    :param limit: most images to return, or None for all of them
+    :return: An array of image records, each with the date and url of the earliest entry
+        that references it
+    """
+    if verbose:
+        print('Fetching images that are due to be cached')
+    data = {
+        'now': now,
+        'max_attempts': -1,
+        'limit': -1
+    }
+    if retry == False:
+        data['max_attempts'] = 0
+    if limit is not None:
+        data['limit'] = limit
+    # The first three conditions pick out the part of the index the queue is read from.
+    # Images no entry uses any more have no first_entry_id, so the join leaves them out.
+    cur.execute("""
+        SELECT ci.id, ci.url, ci.first_entry_eventtime_unix, e.url, ci.reference_count
+        FROM cached_images ci
+            JOIN entries e ON e.itemid = ci.first_entry_id
+        WHERE ci.cached = 0 AND ci.failed_permanently = 0 AND ci.evicted = 0
+            AND (ci.next_attempt IS NULL OR ci.next_attempt <= :now)
+            AND (:max_attempts < 0 OR ci.attempt_count <= :max_attempts)
+        ORDER BY %s
+        LIMIT :limit""" % image_queue_orders[order], data)
+    images = []
+    for row in cur.fetchall():
+        image = {
+            "id": row[0],
+            "url": row[1],
+            "entry_eventtime_unix": row[2],
+            "entry_url": row[3],
+            "reference_count": row[4]
+        }
+        images.append(image)
+    return images
+
+
 def get_all_successfully_cached_image_records(cur, verbose):
     """ get all records in the image cache that report they have been cached successfully
     :param cur: database cursor
@@ -910,7 +2479,7 @@ def get_all_successfully_cached_image_records(cur, verbose):
     if verbose:
         print('Fetching all successfully cached images')
     cur.execute("""SELECT
-        id, url, filename, date_first_seen
+        id, url, filename, date_first_seen, width, height
         FROM cached_images WHERE cached = 1""")
     rows = cur.fetchall()
     images = []
@@ -919,12 +2488,83 @@ def get_all_successfully_cached_image_records(cur, verbose):
             "id": row[0],
             "url": row[1],
             "filename": row[2],
-            "date_first_seen": row[3]
+            "date_first_seen": row[3],
+            "width": row[4],
+            "height": row[5]
         }
         images.append(image)
     return images
 
 
+def get_build_manifest(cur, verbose):
+    """ get the input hashes recorded for all the HTML pages generated so far
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :return: A dictionary of page filenames to hashes
+    """
+    if verbose:
+        print('Fetching build manifest')
+    cur.execute("SELECT filename, input_hash FROM build_manifest")
+    manifest = {}
+    for row in cur.fetchall():
+        manifest[row[0]] = row[1]
+    return manifest
+
+
+def update_build_manifest(cur, verbose, hashes):
+    """ record input hashes for HTML pages that were just generated
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param hashes: dictionary of page filenames to hashes
+    """
+    if verbose:
+        print('Updating build manifest with %d pages' % len(hashes))
+    cur.executemany("""
+        INSERT OR REPLACE INTO build_manifest (filename, input_hash) VALUES (?, ?)""",
+        list(hashes.items()))
+
+
+def remove_pages_from_build_manifest(cur, verbose, filenames):
+    """ forget the input hashes for HTML pages that have been deleted
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param filenames: list of page filenames
+    """
+    if verbose:
+        print('Removing %d pages from build manifest' % len(filenames))
+    cur.executemany("DELETE FROM build_manifest WHERE filename = ?", [(filename,) for filename in filenames])
+
+
+def get_entry_fragment(cur, verbose, entry_id, input_hash):
+    """ get the stored HTML for an entry, if it was rendered from the same inputs
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param entry_id: ID of the entry
+    :param input_hash: hash of the inputs the HTML should have been rendered from
+    :return: The HTML as a string, or None if there isn't any stored for these inputs
+    """
+    if verbose:
+        print('Fetching rendered HTML for entry %s' % entry_id)
+    cur.execute("SELECT html FROM entry_fragments WHERE entry_id = ? AND input_hash = ?", (entry_id, input_hash))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return row[0]
+
+
+def update_entry_fragments(cur, verbose, fragments):
+    """ store rendered HTML for entries, replacing anything stored for them before
+    :param cur: database cursor
+    :param verbose: whether we are verbose logging
+    :param fragments: list of (entry ID, input hash, HTML) tuples
+    """
+    if verbose:
+        print('Storing rendered HTML for %d entries' % len(fragments))
+    cur.executemany("""
+        INSERT OR REPLACE INTO entry_fragments (entry_id, input_hash, html) VALUES (?, ?, ?)""",
+        fragments)
+
+
 def set_sync_status(cur, status):
     """ set values in the current status record
     :param cur: database cursor
@@ -940,4 +2580,24 @@ def finish_with_database(conn, cur):
     """
     cur.close()
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+
+
+# Schema migrations, in order.  Each is run once, when the database is found to be
+# at a lower version than the one it's paired with.
+schema_migrations = [
+    (1, migrate_raw_props_to_json),
+    (2, migrate_backfill_entry_tags),
+    (3, migrate_add_comment_threads),
+    (4, migrate_backfill_counts),
+    (5, migrate_backfill_entry_images),
+    (6, migrate_add_image_fetch_queue),
+    (7, migrate_add_image_content_hashes),
+    (8, migrate_add_image_validators),
+    (9, migrate_add_image_eviction),
+    (10, migrate_add_image_dimensions),
+    (11, migrate_add_image_queue_order),
+    (12, migrate_compact_comment_thread_paths),
+    (13, migrate_add_change_revisions),
+    (14, migrate_add_image_failed_max_size),
+]
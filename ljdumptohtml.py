@@ -27,9 +27,22 @@
 
 
 import sys, os, codecs, pprint, argparse, shutil, xml.dom.minidom
+import multiprocessing
+import http.client
+import socket
+import threading
+from time import monotonic, sleep
+import concurrent.futures
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.  Peak memory use just isn't reported there.
+    resource = None
 from getpass import getpass
 import urllib
+import hashlib
 import html
+import json
 import re
 import calendar
 from datetime import *
@@ -44,9 +57,72 @@ MimeExtensions = {
 }
 
 
+# Finds the address of every image referenced in an entry body.
+image_src_pattern = re.compile(r'img[^<>]*\ssrc\s?=\s?[\'\"](https?:/+[^\s\"\'()<>]+)[\'\"]', flags=re.IGNORECASE)
+# The stricter image_tag_src_pattern, which picks the images to download, is in ljdumpsqlite.
+line_break_pattern = re.compile("(\r\n|\r|\n)")
+# Everything transform_body rewrites: line breaks, and anything that could be an image URL.
+body_rewrite_pattern = re.compile(r'(\r\n|\r|\n)|(https?:/+[^\s\"\'()<>]+)')
+# The same, but with whole image tags picked out, so their attributes can be added to.
+body_image_tag_rewrite_pattern = re.compile(r'(\r\n|\r|\n)|((?i:<img\b[^<>]*>))|(https?:/+[^\s\"\'()<>]+)')
+image_size_attribute_pattern = re.compile(r'\s(width|height)\s*=', flags=re.IGNORECASE)
+image_loading_attribute_pattern = re.compile(r'\sloading\s*=', flags=re.IGNORECASE)
+
+
+# Bump this whenever a change to this script alters the HTML it produces,
+# so the next run knows it has to regenerate every page.
+TEMPLATE_VERSION = 3
+
+
 def write_html(filename, html_as_string):
     f = codecs.open(filename, "w", "UTF-8")
     f.write(html_as_string)
+    f.close()
+
+
+# Like write_html, but the page content is written out a piece at a time as it's produced,
+# between the same skeleton that render_page uses.
+# content_strings: Any iterable of HTML strings, e.g. a generator
+def write_html_page(filename, journal_short_name, title_text, content_strings, in_subfolder=True):
+    (prefix_parts, suffix) = page_skeleton(journal_short_name, in_subfolder)
+    f = codecs.open(filename, "w", "UTF-8")
+    f.write(escape_html_text(title_text).join(prefix_parts))
+    for content_string in content_strings:
+        f.write(content_string)
+    f.write(suffix)
+    f.close()
+
+
+# Reduce everything that goes into a page to a short string that will change if any of it changes.
+# inputs: Any combination of lists, dictionaries, strings, numbers, and dates
+def hash_page_inputs(inputs):
+    as_json = json.dumps([TEMPLATE_VERSION, inputs], sort_keys=True, default=str)
+    return hashlib.sha1(as_json.encode('utf-8')).hexdigest()
+
+
+# Whether the given page was generated last time from the exact same inputs, and is still there.
+# filename: Path of page relative to the journal folder
+# build_manifest: Dictionary of page filenames to input hashes from the last run
+def page_is_current(journal_short_name, filename, input_hash, build_manifest):
+    if build_manifest.get(filename) != input_hash:
+        return False
+    return os.path.exists("%s/%s" % (journal_short_name, filename))
+
+
+# Everything that affects how an entry is rendered in render_one_entry_container,
+# plus the entry body after transform_body.
+def entry_container_inputs(entry, comments_count, entry_body, icons_by_keyword, moods_by_id):
+    return [
+        entry,
+        comments_count,
+        entry_body,
+        icons_by_keyword.get(entry['props_picture_keyword'] or '*'),
+        moods_by_id.get(entry['props_current_moodid'])
+    ]
+
+
+def entry_container_hash(entry, comments_count, entry_body, icons_by_keyword, moods_by_id):
+    return hash_page_inputs(entry_container_inputs(entry, comments_count, entry_body, icons_by_keyword, moods_by_id))
 
 
 # journal_short_name: Name of journal
@@ -92,592 +168,992 @@ def create_template_page(journal_short_name, title_text, in_subfolder=True):
     return (page, inner_d)
 
 
-def render_comment_and_subcomments_containers(comment, comments_by_id, comment_children, icons_by_keyword, depth=1):
-    # Pre-entry separator
-    comment_and_thread_container = ET.Element('div',
-        attrib={
-            'data-comment-depth': ("%s" % depth),
-            'class': ('comment-thread comment-depth-indent-desktop comment-depth-indent-mobile comment-depth-odd comment-depth-mod5-%s comment-depth-%s' % (depth, depth)),
-            'style': ('--comment-depth: %s;' % (depth))})
-
-    comment_container = ET.SubElement(comment_and_thread_container, 'div',
-        attrib={
-            'id': ("cmt%s" % comment['id']),
-            'class': "dwexpcomment",
-            'style': ('margin-left: %spx; margin-top: 5px;' % ((depth-1)*25))})
-    comment_wrapper = ET.SubElement(comment_container, 'div',
-        attrib={'class': "comment-wrapper comment-wrapper-odd visible full has-userpic no-subject"})
-
-    sep_before = ET.SubElement(comment_wrapper, 'div', attrib={'class': 'separator separator-before'})
-    sep_before_inner = ET.SubElement(sep_before, 'div', attrib={'class': 'inner'})
-
-    comment_main = ET.SubElement(comment_wrapper, 'div',
-        attrib={'class': 'comment',
-                'id': ("comment-cmt%s" % (comment['id'])) })
+# These escape text and attribute values the same way ElementTree does when it
+# writes HTML, so pages put together from strings come out exactly the same.
+def escape_html_text(text):
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
 
-    # Post-comment separator
-    sep_after = ET.SubElement(comment_wrapper, 'div', attrib={'class': 'separator separator-after'})
-    sep_after_inner = ET.SubElement(sep_after, 'div', attrib={'class': 'inner'})
+
+def escape_html_attribute(value):
+    return value.replace(u"&", u"&amp;").replace(u">", u"&gt;").replace(u"\"", u"&quot;")
+
+
+# Cache of the HTML before and after the content area of a template page, keyed by
+# journal name and subfolder flag.  See page_skeleton.
+page_skeletons = {}
+
+
+# Render create_template_page once with markers in place of the title and the contents,
+# and split the result into the fixed strings around them.  Every page after that is
+# put together by joining strings, instead of building and serializing a new tree.
+# Returns (prefix_parts, suffix) where the title goes between each of the prefix parts.
+def page_skeleton(journal_short_name, in_subfolder=True):
+    key = (journal_short_name, in_subfolder)
+    if key not in page_skeletons:
+        page, content = create_template_page(journal_short_name, u"page-title-insertion-point", in_subfolder)
+        content.text = u"page-content-insertion-point"
+        html_as_string = ET.tostring(page, encoding="unicode", method="html")
+        (before_content, suffix) = html_as_string.split(u"page-content-insertion-point")
+        page_skeletons[key] = (before_content.split(u"page-title-insertion-point"), suffix)
+    return page_skeletons[key]
+
+
+# journal_short_name: Name of journal
+# title_text: Text to put in HTML title element
+# content_strings: List of HTML strings to place in the content area, in order
+# in_subfolder: Same as for create_template_page
+def render_page(journal_short_name, title_text, content_strings, in_subfolder=True):
+    (prefix_parts, suffix) = page_skeleton(journal_short_name, in_subfolder)
+    text_strings = [escape_html_text(title_text).join(prefix_parts)]
+    text_strings.extend(content_strings)
+    text_strings.append(suffix)
+    return ''.join(text_strings)
+
+
+# Top or bottom navigation bar, e.g. "previous" and "next" links.
+# position: "topnav" or "bottomnav"
+# previous_link, next_link: (href, text) tuples, or None to leave that side out
+def render_navigation_bar(position, previous_link, next_link):
+    text_strings = [u'<div class="navigation %s"><div class="inner"><ul>' % position]
+    if previous_link is not None:
+        text_strings.append(u'<li class="page-back"><a href="%s">%s</a></li>' %
+            (escape_html_attribute(previous_link[0]), escape_html_text(previous_link[1])))
+    if (previous_link is not None) and (next_link is not None):
+        text_strings.append(u'<li class="page-separator"> | </li>')
+    if next_link is not None:
+        text_strings.append(u'<li class="page-forward"><a href="%s">%s</a></li>' %
+            (escape_html_attribute(next_link[0]), escape_html_text(next_link[1])))
+    text_strings.append(u'</ul></div></div>')
+    return ''.join(text_strings)
+
+
+# Returns the HTML for the comment and the start of its thread container, with the
+# container left open so that replies can be written inside it.  The caller closes it.
+# thread_link: (href, number of replies) for a page with the rest of this thread, or None
+def render_one_comment_container(comment, thread_link=None):
+    depth = comment['depth']
+    text_strings = []
+    text_strings.append(
+        u'<div data-comment-depth="%s" class="comment-thread comment-depth-indent-desktop comment-depth-indent-mobile comment-depth-odd comment-depth-mod5-%s comment-depth-%s" style="--comment-depth: %s;">' %
+        (depth, depth, depth, depth))
+    text_strings.append(
+        u'<div id="cmt%s" class="dwexpcomment" style="margin-left: %spx; margin-top: 5px;">' % (comment['id'], (depth-1)*25))
+    text_strings.append(u'<div class="comment-wrapper comment-wrapper-odd visible full has-userpic no-subject">')
+    # Pre-comment separator
+    text_strings.append(u'<div class="separator separator-before"><div class="inner"></div></div>')
 
     # Middle wrapper for comment
-    comment_inner = ET.SubElement(comment_main, 'div', attrib={'class': 'inner'})
-
-    # Comment header area
-    comment_header = ET.SubElement(comment_inner, 'div', attrib={'class': 'header'})
-    comment_header_inner = ET.SubElement(comment_header, 'div', attrib={'class': 'inner'})
-
-    # Title of comment, with link to individual comment
-    title = comment['subject']
-    comment_title = ET.SubElement(comment_header_inner, 'h4', attrib={'class': 'comment-title'})
-    comment_title.text = title
-
-    # Datestamp
-    comment_date = ET.SubElement(comment_header_inner, 'span', attrib={'class': 'datetime'})
-    span_date = ET.SubElement(comment_date, 'span',
-        attrib={'class': 'comment-date-text'})
-    span_date.text = "Date: "
-    span_date_value = ET.SubElement(comment_date, 'span')
+    text_strings.append(u'<div class="comment" id="comment-cmt%s"><div class="inner">' % comment['id'])
+
+    # Comment header area, with title and datestamp
     if comment['date_unix']:
         d = datetime.utcfromtimestamp(comment['date_unix'])
         # If anybody has a way to get rid of the leading zero that works in MacOS and Windows 11, let me know.
         dh = int(f'{d:%I}')
-        span_date_value.text = html.escape(f'{d:%b}. {d.day}, {d:%Y} {dh}:{d:%M} {d:%p}')
+        comment_date = html.escape(f'{d:%b}. {d.day}, {d:%Y} {dh}:{d:%M} {d:%p}')
     else:
-        span_date_value.text = "(None)"
+        comment_date = "(None)"
+    text_strings.append(
+        u'<div class="header"><div class="inner"><h4 class="comment-title">%s</h4>'
+        u'<span class="datetime"><span class="comment-date-text">Date: </span><span>%s</span></span></div></div>' %
+        (escape_html_text(comment['subject'] or u''), escape_html_text(comment_date)))
 
     # Another comment inner wrapper
-    comment_div_contents = ET.SubElement(comment_inner, 'div', attrib={'class': 'contents'})
-    comment_div_contents_inner = ET.SubElement(comment_div_contents, 'div', attrib={'class': 'inner'})
+    text_strings.append(u'<div class="contents"><div class="inner">')
 
     # User icon (maybe custom, otherwise use the default)
-    div_userpic = ET.SubElement(comment_div_contents_inner, 'div', attrib={'class': 'userpic'})
     # Currently no way to get userpic chosen for comment from XML-RPC.
-    #userpic_k = comment['props_picture_keyword'] or '*'
-    #if userpic_k in icons_by_keyword:
-    #    icon = icons_by_keyword[userpic_k]
-    #    img_userpic = ET.SubElement(div_userpic, 'img',
-    #        attrib={'src': ("../userpics/%s" % (icon['filename']))})
+    text_strings.append(u'<div class="userpic"></div>')
 
     # Identify the poster (if it's not the owner)
-    span_poster = ET.SubElement(comment_div_contents_inner, 'span', attrib={'class': 'poster comment-poster'})
-    span_from = ET.SubElement(span_poster, 'span',
-        attrib={'class': 'comment-from-text'})
-    span_from.text = "From: "
-    span_user = ET.SubElement(span_poster, 'span',
-        attrib={'class': 'ljuser',
-                'style': 'white-space: nowrap;'})
-    img_user = ET.SubElement(span_user, 'img',
-        attrib={'src': '../user.png',
-                'style': 'vertical-align: text-bottom; border: 0; padding-right: 1px;',
-                'alt': '[personal profile]'})
+    text_strings.append(
+        u'<span class="poster comment-poster"><span class="comment-from-text">From: </span>'
+        u'<span class="ljuser" style="white-space: nowrap;">'
+        u'<img src="../user.png" style="vertical-align: text-bottom; border: 0; padding-right: 1px;" alt="[personal profile]">')
     if comment['user']:
-        a_user = ET.SubElement(span_user, 'a',
-            attrib={'href': ('https://www.dreamwidth.org/users/%s' % comment['user']),
-                    'style': 'font-weight:bold;'})
-        a_user.text = comment['user']
+        text_strings.append(u'<a href="https://www.dreamwidth.org/users/%s" style="font-weight:bold;">%s</a>' %
+            (escape_html_attribute(comment['user']), escape_html_text(comment['user'])))
     else:
-        a_user = ET.SubElement(span_user, 'span',
-            attrib={'style': 'font-weight:bold;'})
-        a_user.text = "(None)"
+        text_strings.append(u'<span style="font-weight:bold;">(None)</span>')
+    text_strings.append(u'</span></span>')
 
-    # This is an empty div that the comment body will be placed in later.
-    ET.SubElement(comment_div_contents_inner, 'div',
-            attrib={'id': ("comment-content-%s-insertion-point" % comment['id'])})
+    # Comment body.  Comments can contain just as much junk HTML as entries,
+    # so they go in exactly as they are, like entry bodies do.
+    text_strings.append(u'<div class="comment-content" id="comment-content-%s-insertion-point">' % comment['id'])
+    text_strings.append(line_break_pattern.sub("<br />", comment['body']))
+    text_strings.append(u'</div>')
 
-    # comment footer area
-    comment_footer = ET.SubElement(comment_inner, 'div', attrib={'class': 'footer'})
-    comment_footer_inner = ET.SubElement(comment_footer, 'div', attrib={'class': 'inner'})
+    text_strings.append(u'</div></div>')
 
+    # Comment footer area
     # There are no management links here because we can't get enough data from XML-RPC to
     # reconstruct them.
+    text_strings.append(u'<div class="footer"><div class="inner">')
+    if thread_link is not None:
+        (thread_href, reply_count) = thread_link
+        if reply_count > 1:
+            reply_text = u"%s replies" % reply_count
+        else:
+            reply_text = u"1 reply"
+        text_strings.append(u'<ul class="text-links"><li class="link commentthread"><a href="%s">Thread from here</a> (%s)</li></ul>' %
+            (escape_html_attribute(thread_href), reply_text))
+    text_strings.append(u'</div></div>')
 
-    if comment['id'] in comment_children:
-        for comment_id in comment_children[comment['id']]:
-            next_comment = comments_by_id[comment_id]
-            one_container = render_comment_and_subcomments_containers(
-                                comment=next_comment,
-                                comments_by_id=comments_by_id,
-                                comment_children=comment_children,
-                                icons_by_keyword=icons_by_keyword,
-                                depth=(depth+1)
-            )
-            comment_and_thread_container.append(one_container)
-
-    return comment_and_thread_container
-
-
-def render_comments_section(entry, comments, comments_by_id, icons_by_keyword):
-    wrapper = ET.Element('div',
-        attrib={'id': ("comments-wrapper-%s" % (entry['itemid'])) })
-    wrapper_inner = ET.SubElement(wrapper, 'div', attrib={'class': 'inner'})
-
-    # Sort by ID (creation order) rather than date, since some may have been edited
-    sorted_comments = sorted(comments, key=lambda x: x['id'], reverse=False)
-
-    # Get a list of top comments only
-    top_comments = []
-    for comment in sorted_comments:
-        if not comment['parentid']:
-            top_comments.append(comment)
-
-    # Create arrays of child comments for each comment ID.
-    # Since the source list was sorted, these will be too.
-    comment_children = {}
-    for comment in sorted_comments:
-        comment_children[comment['id']] = []
-    for comment in sorted_comments:
-        parent_id = comment['parentid']
-        if parent_id:
-            if not (parent_id in comment_children):
-                comment_children[parent_id] = []
-            comment_children[parent_id].append(comment['id'])
-
-    for comment in top_comments:
-        one_container = render_comment_and_subcomments_containers(
-                            comment=comment,
-                            comments_by_id=comments_by_id,
-                            comment_children=comment_children,
-                            icons_by_keyword=icons_by_keyword,
-                            depth=1
-        )
-        wrapper_inner.append(one_container)
+    text_strings.append(u'</div></div>')
+
+    # Post-comment separator
+    text_strings.append(u'<div class="separator separator-after"><div class="inner"></div></div>')
+    text_strings.append(u'</div></div>')
+    return ''.join(text_strings)
 
-    return wrapper
 
+# thread_links: Dictionary of comment IDs to thread_link values for render_one_comment_container,
+#   or None
+def render_comments_section(entry, comments, thread_links=None):
+    # Comments arrive in thread order (see get_comments_for_entry), so every comment
+    # comes after its parent, and after the replies to any earlier siblings.
+    # The whole section is written out in one pass: each comment container is left
+    # open, and then closed once all its replies are written out.
+    # Comments without a thread path have lost their parent and are not shown.
+    if thread_links is None:
+        thread_links = {}
+    text_strings = [u'<div id="comments-wrapper-%s"><div class="inner">' % entry['itemid']]
+    open_depth = 0
+    for comment in comments:
+        if comment['thread_path'] is None:
+            continue
+        depth = comment['depth']
+        while open_depth >= depth:
+            text_strings.append(u'</div>')
+            open_depth -= 1
+        text_strings.append(render_one_comment_container(
+                            comment=comment,
+                            thread_link=thread_links.get(comment['id'])
+        ))
+        open_depth = depth
+    while open_depth > 0:
+        text_strings.append(u'</div>')
+        open_depth -= 1
+    text_strings.append(u'</div></div>')
 
-def render_one_entry_container(journal_short_name, entry, comments_count, icons_by_keyword, moods_by_id):
-    wrapper = ET.Element('div',
-        attrib={'class': 'entry-wrapper entry-wrapper-odd security-public restrictions-none journal-type-P has-userpic has-subject',
-                'id': ("entry-wrapper-%s" % (entry['itemid'])) })
+    return ''.join(text_strings)
 
-    # Pre-entry separator
-    sep_before = ET.SubElement(wrapper, 'div', attrib={'class': 'separator separator-before'})
-    sep_before_inner = ET.SubElement(sep_before, 'div', attrib={'class': 'inner'})
 
-    entry_div = ET.SubElement(wrapper, 'div',
-        attrib={'class': 'entry',
-                'id': ("entry-%s" % (entry['itemid'])) })
+# Cache of the poster badge shown on every entry, keyed by journal name.
+entry_poster_fragments = {}
 
-    # Post-entry separator
-    sep_after = ET.SubElement(wrapper, 'div', attrib={'class': 'separator separator-after'})
-    sep_after_inner = ET.SubElement(sep_after, 'div', attrib={'class': 'inner'})
 
-    # Middle wrapper for entry
-    entry_inner = ET.SubElement(entry_div, 'div', attrib={'class': 'inner'})
+def render_entry_poster(journal_short_name):
+    if journal_short_name not in entry_poster_fragments:
+        entry_poster_fragments[journal_short_name] = (
+            u'<span class="poster entry-poster"><span class="ljuser" style="white-space: nowrap;">'
+            u'<img src="../user.png" style="vertical-align: text-bottom; border: 0; padding-right: 1px;" alt="[personal profile]">'
+            u'<a href="https://www.dreamwidth.org/users/%s" style="font-weight:bold;">%s</a></span></span>' %
+            (escape_html_attribute(journal_short_name), escape_html_text(journal_short_name)))
+    return entry_poster_fragments[journal_short_name]
 
-    # Entry header area
-    entry_header = ET.SubElement(entry_inner, 'div', attrib={'class': 'header'})
-    entry_header_inner = ET.SubElement(entry_header, 'div', attrib={'class': 'inner'})
 
-    # Title of entry, with link to individual entry
+# Entry header: title with a link to the individual entry, and the datestamp.
+def render_entry_header(entry):
     title = entry['subject']
-    entry_title = ET.SubElement(entry_header_inner, 'h3', attrib={'class': 'entry-title'})
-    entry_title_a = ET.SubElement(entry_title, 'a',
-        attrib={'title': title,
-                'href': ("../entries/entry-%s.html" % (entry['itemid']))})
-    entry_title_a.text = title
-
-    # Datestamp
-    entry_date = ET.SubElement(entry_header_inner, 'span', attrib={'class': 'datetime'})
     d = datetime.utcfromtimestamp(entry['eventtime_unix'])
     # If anybody has a way to get rid of the leading zero that works in MacOS and Windows 11, let me know.
     dh = int(f'{d:%I}')
-    entry_date.text = html.escape(f'{d:%b}. {d.day}, {d:%Y} {dh}:{d:%M} {d:%p}')
+    entry_date = html.escape(f'{d:%b}. {d.day}, {d:%Y} {dh}:{d:%M} {d:%p}')
+    return (u'<div class="header"><div class="inner"><h3 class="entry-title">'
+            u'<a title="%s" href="../entries/entry-%s.html">%s</a></h3>'
+            u'<span class="datetime">%s</span></div></div>' %
+            (escape_html_attribute(title), entry['itemid'], escape_html_text(title), escape_html_text(entry_date)))
+
+
+# entry_body: The entry contents as HTML, already passed through transform_body
+def render_one_entry_container(journal_short_name, entry, entry_body, comments_count, icons_by_keyword, moods_by_id):
+    text_strings = []
+    text_strings.append(
+        u'<div class="entry-wrapper entry-wrapper-odd security-public restrictions-none journal-type-P has-userpic has-subject" id="entry-wrapper-%s">' % entry['itemid'])
+    # Pre-entry separator
+    text_strings.append(u'<div class="separator separator-before"><div class="inner"></div></div>')
+    # Middle wrapper for entry
+    text_strings.append(u'<div class="entry" id="entry-%s"><div class="inner">' % entry['itemid'])
+    text_strings.append(render_entry_header(entry))
 
     # Another entry inner wrapper
-    entry_div = ET.SubElement(entry_inner, 'div')
-    entry_div_contents = ET.SubElement(entry_div, 'div', attrib={'class': 'contents'})
-    entry_div_contents_inner = ET.SubElement(entry_div_contents, 'div', attrib={'class': 'inner'})
+    text_strings.append(u'<div><div class="contents"><div class="inner">')
 
     # User icon (maybe custom, otherwise use the default)
-    div_userpic = ET.SubElement(entry_div_contents_inner, 'div', attrib={'class': 'userpic'})
+    text_strings.append(u'<div class="userpic">')
     userpic_k = entry['props_picture_keyword'] or '*'
     if userpic_k in icons_by_keyword:
         icon = icons_by_keyword[userpic_k]
-        img_userpic = ET.SubElement(div_userpic, 'img',
-            attrib={'src': ("../userpics/%s" % (icon['filename']))})
+        text_strings.append(u'<img src="../userpics/%s">' % escape_html_attribute(icon['filename']))
+    text_strings.append(u'</div>')
 
     # Identify the poster (if it's not the owner)
-    span_poster = ET.SubElement(entry_div_contents_inner, 'span', attrib={'class': 'poster entry-poster'})
-    span_user = ET.SubElement(span_poster, 'span',
-        attrib={'class': 'ljuser',
-                'style': 'white-space: nowrap;'})
-    img_user = ET.SubElement(span_user, 'img',
-        attrib={'src': '../user.png',
-                'style': 'vertical-align: text-bottom; border: 0; padding-right: 1px;',
-                'alt': '[personal profile]'})
-    a_user = ET.SubElement(span_user, 'a',
-        attrib={'href': ('https://www.dreamwidth.org/users/%s' % journal_short_name),
-                'style': 'font-weight:bold;'})
-    a_user.text = journal_short_name
-
-    # This is an empty div that the entry body will be placed in later.
-    ET.SubElement(entry_div_contents_inner, 'div',
-            attrib={'class': 'entry-content',
-                    'id': "entry-content-insertion-point"})
+    text_strings.append(render_entry_poster(journal_short_name))
+
+    # Entry body.  Journal entries often contain weird and broken HTML, and we can't
+    # rely on parsing them, so the body goes in exactly as it is.  This avoids the need
+    # to police the HTML skills of thousands of users whose entries render fine in Dreamwidth.
+    text_strings.append(u'<div class="entry-content" id="entry-content-insertion-point">')
+    text_strings.append(entry_body)
+    text_strings.append(u'</div>')
 
     # Entry metadata area
     if (entry['props_current_moodid'] is not None) or (entry['props_current_music'] is not None):
-        entry_metadata = ET.SubElement(entry_div_contents_inner, 'div',
-                attrib={'class': 'metadata bottom-metadata'})
-        entry_metadata_ul = ET.SubElement(entry_metadata, 'ul')
+        text_strings.append(u'<div class="metadata bottom-metadata"><ul>')
         # Current mood
         if entry['props_current_moodid'] is not None:
             if entry['props_current_moodid'] in moods_by_id:
-                mood_li = ET.SubElement(entry_metadata_ul, 'li',
-                        attrib={'class': 'metadata-mood'})
-                mood_label = ET.SubElement(mood_li, 'span',
-                        attrib={'class': 'metadata-label metadata-label-mood'})
-                mood_label.text = u"Current Mood: "
                 # Alas, there is no XML-RPC support for fetching which icon set a user has.
                 # There isn't even a console command for it.
-                mood_name = ET.SubElement(mood_li, 'span',
-                        attrib={'class': 'metadata-item metadata-item-mood'})
-                mood_name.text = moods_by_id[entry['props_current_moodid']]['name']
+                text_strings.append(
+                    u'<li class="metadata-mood"><span class="metadata-label metadata-label-mood">Current Mood: </span>'
+                    u'<span class="metadata-item metadata-item-mood">%s</span></li>' %
+                    escape_html_text(moods_by_id[entry['props_current_moodid']]['name'] or u''))
         # Current music
         if entry['props_current_music'] is not None:
-            music_li = ET.SubElement(entry_metadata_ul, 'li',
-                    attrib={'class': 'metadata-music'})
-            music_label = ET.SubElement(music_li, 'span',
-                    attrib={'class': 'metadata-label metadata-label-music'})
-            music_label.text = u"Current Music: "
-            music_name = ET.SubElement(music_li, 'span',
-                    attrib={'class': 'metadata-item metadata-item-music'})
-            music_name.text = entry['props_current_music']
+            text_strings.append(
+                u'<li class="metadata-music"><span class="metadata-label metadata-label-music">Current Music: </span>'
+                u'<span class="metadata-item metadata-item-music">%s</span></li>' %
+                escape_html_text(entry['props_current_music']))
+        text_strings.append(u'</ul></div>')
+
+    text_strings.append(u'</div></div></div>')
 
     # Entry footer area
-    entry_footer = ET.SubElement(entry_inner, 'div', attrib={'class': 'footer'})
-    entry_footer_inner = ET.SubElement(entry_footer, 'div', attrib={'class': 'inner'})
+    text_strings.append(u'<div class="footer"><div class="inner">')
 
     # Tags (if any)
-    taglist = entry['props_taglist']
-    if taglist is not None:
-        tags_div = ET.SubElement(entry_footer_inner, 'div', attrib={'class': 'tag'})
-        tags_span = ET.SubElement(tags_div, 'span', attrib={'class': 'tag-text'})
-        tags_span.text = u"Tags: "
-        tags_ul = ET.SubElement(tags_div, 'ul')
-        tags_split = taglist.split(', ')
-        if len(tags_split) > 1:
-            for i in range(0, len(tags_split)-1):
-                one_tag = tags_split[i]
-                tag_li = ET.SubElement(tags_ul, 'li')
-                tag_a = ET.SubElement(tag_li, 'a',
-                    attrib={'href': ("../index.html#%s" % one_tag),
-                            'rel': 'tag'})
-                tag_a.text = one_tag
-                tag_a.tail = u", "
-        one_tag = tags_split[-1]
-        tag_li = ET.SubElement(tags_ul, 'li')
-        tag_a = ET.SubElement(tag_li, 'a',
-            attrib={'href': ("../index.html#%s" % one_tag),
-                    'rel': 'tag'})
-        tag_a.text = one_tag
+    tags = entry['tags']
+    if len(tags) > 0:
+        text_strings.append(u'<div class="tag"><span class="tag-text">Tags: </span><ul>')
+        for i in range(0, len(tags)):
+            one_tag = tags[i]
+            text_strings.append(u'<li><a href="../%s" rel="tag">%s</a>' %
+                (escape_html_attribute(tag_page_filename(one_tag)), escape_html_text(one_tag)))
+            if i < len(tags) - 1:
+                text_strings.append(u', ')
+            text_strings.append(u'</li>')
+        text_strings.append(u'</ul></div>')
 
     # Management links
-    management_ul = ET.SubElement(entry_footer_inner, 'ul', attrib={'class': 'entry-interaction-links text-links'})
+    text_strings.append(u'<ul class="entry-interaction-links text-links">')
     # Permalink
-    permalink_li = ET.SubElement(management_ul, 'li', attrib={'class': 'entry-permalink first-item'})
-    permalink_a = ET.SubElement(permalink_li, 'a', attrib={'href': (entry['url'])})
-    permalink_a.text = u"Original"
+    text_strings.append(u'<li class="entry-permalink first-item"><a href="%s">Original</a></li>' %
+        escape_html_attribute(entry['url'] or u''))
     # Comments link
     if comments_count > 0:
-        comments_li = ET.SubElement(management_ul, 'li', attrib={'class': 'entry-permalink first-item'})
-        comments_a = ET.SubElement(comments_li, 'a', attrib={'href': ("../entries/entry-%s.html" % entry['itemid'])})
         if comments_count > 1:
-            comments_a.text = (u"%s comments" % comments_count)
+            comments_text = (u"%s comments" % comments_count)
         else:
-            comments_a.text = u"1 comment"
-
-    return wrapper
+            comments_text = u"1 comment"
+        text_strings.append(u'<li class="entry-permalink first-item"><a href="../entries/entry-%s.html">%s</a></li>' %
+            (entry['itemid'], comments_text))
+    text_strings.append(u'</ul>')
 
+    text_strings.append(u'</div></div>')
+    text_strings.append(u'</div></div>')
 
-def resolve_cached_image_references(content, image_urls_to_filenames):
-    # Find any image URLs
-    urls_found = re.findall(r'img[^<>]*\ssrc\s?=\s?[\'\"](https?:/+[^\s\"\'()<>]+)[\'\"]', content, flags=re.IGNORECASE)
-    # Build a regular expression to detect images hosted on Dreamwidth
-    dw_hosted_pattern = re.compile('^https://(\w+).dreamwidth.org/file/\d+x\d+/(.+)')
-    uncached_urls = []
+    # Post-entry separator
+    text_strings.append(u'<div class="separator separator-after"><div class="inner"></div></div>')
+    text_strings.append(u'</div>')
+    return ''.join(text_strings)
 
-    for image_url in urls_found:
-        url_in_cache = image_url
-        if dw_hosted_pattern.match(image_url):
-            dw_hosted = dw_hosted_pattern.search(image_url)
-            url_in_cache = 'https://' + dw_hosted.group(1) + '.dreamwidth.org/file/' + dw_hosted.group(2)
 
+# Rewrite an entry or comment body for display, in one pass: Line breaks become <br /> tags,
+# and references to images that have been cached locally are pointed at the local copies.
+# Image tags that now show a cached copy are also given its width and height, if known,
+# so the page doesn't jump around as it loads, and are marked to load lazily.
+# image_urls_to_filenames: Maps the URL of each cached image to (filename, width, height)
+# Returns the new body, and a list of the image URLs found that are not in the cache.
+def transform_body(content, image_urls_to_filenames):
+    replacements = {}
+    sizes = {}
+    uncached_urls = []
+    for image_url in image_src_pattern.findall(content):
+        url_in_cache = image_url_in_cache(image_url)
         if url_in_cache in image_urls_to_filenames:
-            filename = image_urls_to_filenames[url_in_cache]
-            content = content.replace(image_url, ("../images/%s" % filename))
+            (filename, width, height) = image_urls_to_filenames[url_in_cache]
+            replacements[image_url] = "../images/%s" % filename
+            if width and height:
+                sizes[image_url] = (width, height)
         else:
             uncached_urls.append(url_in_cache)
-    return (content, uncached_urls)
 
+    if len(replacements) == 0:
+        return (line_break_pattern.sub("<br />", content), uncached_urls)
+
+    def rewrite(match):
+        if match.group(1) is not None:
+            return "<br />"
+        if match.group(3) is not None:
+            return replacements.get(match.group(3), match.group(3))
+        tag = match.group(2)
+        src = image_src_pattern.search(tag)
+        tag = body_rewrite_pattern.sub(rewrite_in_tag, tag)
+        if (src is None) or (src.group(1) not in replacements):
+            return tag
+        attributes = ''
+        if (src.group(1) in sizes) and not image_size_attribute_pattern.search(tag):
+            attributes += ' width="%s" height="%s"' % sizes[src.group(1)]
+        if not image_loading_attribute_pattern.search(tag):
+            attributes += ' loading="lazy"'
+        if attributes == '':
+            return tag
+        if tag.endswith('/>'):
+            return '%s%s />' % (tag[:-2].rstrip(), attributes)
+        return '%s%s>' % (tag[:-1].rstrip(), attributes)
+
+    def rewrite_in_tag(match):
+        if match.group(1) is not None:
+            return "<br />"
+        return replacements.get(match.group(2), match.group(2))
+
+    return (body_image_tag_rewrite_pattern.sub(rewrite, content), uncached_urls)
+
+
+# Results of transform_body for each entry, so the entry page, the history page, and the
+# uncached image report don't each redo the work.  They're only good for one image cache
+# map, so they are thrown away if a different one is passed in.
+transformed_entry_bodies = {
+    'image_urls_to_filenames': None,
+    'bodies': {}
+}
 
-def create_single_entry_page(journal_short_name, entry, comments, image_urls_to_filenames, icons_by_keyword, moods_by_id, previous_entry=None, next_entry=None):
-    page, content = create_template_page(journal_short_name, "%s entry %s" % (journal_short_name, entry['itemid']), True)
 
-    # Top navigation area (e.g. "previous" and "next" links)
-    topnav_div = ET.SubElement(content, 'div', attrib={'class': 'navigation topnav' })
-    topnav_inner = ET.SubElement(topnav_div, 'div', attrib={'class': 'inner' })
-    topnav_ul = ET.SubElement(topnav_inner, 'ul')
-    if previous_entry is not None:
-        topnav_li = ET.SubElement(topnav_ul, 'li', attrib={'class': 'page-back' })
-        topnav_a = ET.SubElement(topnav_li, 'a', attrib={'href': ("entry-%s.html" % (previous_entry['itemid']))})
-        topnav_a.text = u"Previous Entry"
+def transform_entry_body(entry, image_urls_to_filenames):
+    cache = transformed_entry_bodies
+    if cache['image_urls_to_filenames'] is not image_urls_to_filenames:
+        cache['image_urls_to_filenames'] = image_urls_to_filenames
+        cache['bodies'] = {}
+    found = cache['bodies'].get(entry['itemid'])
+    if (found is not None) and (found[0] == entry['event']):
+        return found[1]
+    result = transform_body(entry['event'], image_urls_to_filenames)
+    cache['bodies'][entry['itemid']] = (entry['event'], result)
+    return result
+
+
+# Rendered entry containers, so an entry rendered for its own page can be reused on its
+# history page.  Each is kept with the hash of its inputs (see entry_container_hash), and
+# only reused if that still matches.  If a database cursor is set here, fragments are also
+# looked up in the database, and the ones rendered fresh are kept in 'rendered' until
+# they can be saved there with update_entry_fragments.
+entry_fragment_cache = {
+    'fragments': {},
+    'cur': None,
+    'rendered': []
+}
 
-    if (previous_entry is not None) and (next_entry is not None):
-        topnav_li = ET.SubElement(topnav_ul, 'li', attrib={'class': 'page-separator' })
-        topnav_li.text = u" | "
+# How many fragments rendered by worker processes to save to the database at once.
+worker_fragment_batch_size = 200
 
-    if next_entry is not None:
-        topnav_li = ET.SubElement(topnav_ul, 'li', attrib={'class': 'page-forward' })
-        topnav_a = ET.SubElement(topnav_li, 'a', attrib={'href': ("entry-%s.html" % (next_entry['itemid']))})
-        topnav_a.text = u"Next Entry"
 
-    wrapper = render_one_entry_container(
-                journal_short_name=journal_short_name,
-                entry=entry,
-                comments_count=len(comments),
-                icons_by_keyword=icons_by_keyword,
-                moods_by_id=moods_by_id
-    )
-    content.append(wrapper)
+def render_entry_fragment(journal_short_name, entry, comments_count, image_urls_to_filenames, icons_by_keyword, moods_by_id):
+    (entry_body, uncached) = transform_entry_body(entry, image_urls_to_filenames)
+    input_hash = entry_container_hash(entry, comments_count, entry_body, icons_by_keyword, moods_by_id)
+    cache = entry_fragment_cache
+    found = cache['fragments'].get(entry['itemid'])
+    if (found is not None) and (found[0] == input_hash):
+        return found[1]
 
-    # Create dictionary of comment ID to comment
-    comments_by_id = {}
-    for comment in comments:
-        comments_by_id[comment['id']] = comment
+    fragment = None
+    if cache['cur'] is not None:
+        fragment = get_entry_fragment(cache['cur'], False, entry['itemid'], input_hash)
+    if fragment is None:
+        fragment = render_one_entry_container(
+                    journal_short_name=journal_short_name,
+                    entry=entry,
+                    entry_body=entry_body,
+                    comments_count=comments_count,
+                    icons_by_keyword=icons_by_keyword,
+                    moods_by_id=moods_by_id
+        )
+        if cache['cur'] is not None:
+            cache['rendered'].append((entry['itemid'], input_hash, fragment))
+    cache['fragments'][entry['itemid']] = (input_hash, fragment)
+    return fragment
 
-    comments_container = render_comments_section(
-                entry=entry,
-                comments=comments,
-                comments_by_id=comments_by_id,
-                icons_by_keyword=icons_by_keyword,
-    )
-    content.append(comments_container)
-
-    # Bottom navigation area (e.g. "previous" and "next" links)
-    bottomnav_div = ET.SubElement(content, 'div', attrib={'class': 'navigation bottomnav' })
-    bottomnav_inner = ET.SubElement(bottomnav_div, 'div', attrib={'class': 'inner' })
-    bottomnav_ul = ET.SubElement(bottomnav_inner, 'ul')
-    if previous_entry is not None:
-        bottomnav_li = ET.SubElement(bottomnav_ul, 'li', attrib={'class': 'page-back' })
-        bottomnav_a = ET.SubElement(bottomnav_li, 'a', attrib={'href': ("entry-%s.html" % (previous_entry['itemid']))})
-        bottomnav_a.text = u"Previous Entry"
-
-    if (previous_entry is not None) and (next_entry is not None):
-        bottomnav_li = ET.SubElement(bottomnav_ul, 'li', attrib={'class': 'page-separator' })
-        bottomnav_li.text = u" | "
-
-    if next_entry is not None:
-        bottomnav_li = ET.SubElement(bottomnav_ul, 'li', attrib={'class': 'page-forward' })
-        bottomnav_a = ET.SubElement(bottomnav_li, 'a', attrib={'href': ("entry-%s.html" % (next_entry['itemid']))})
-        bottomnav_a.text = u"Next Entry"
-
-    # We're going to be weird here, because journal entries often contain weird and
-    # broken HTML.  We can't rely on parsing a journal entry into XML and then
-    # embedding it as elements.  There is also no clean way to slipstream string data
-    # into the XML during the rendering process (it either gets parsed as usual before
-    # insertion, or run through an escaper).  So we're going to render the document as
-    # text right here, and then do a text search (a split) to find the div with id
-    # "entry-content-insertion-point".  Then we'll interleave the entry contents and
-    # re-assemble the document.  It's hacky but it avoids the need to police the HTML
-    # skills of thousands of users whose entries render fine in Dreamwidth.
-    html_as_string = ET.tostring(page, encoding="utf-8", method="html").decode('utf-8')
-    html_split_on_entry_body = html_as_string.split(u'<div class="entry-content" id="entry-content-insertion-point"></div>')
 
-    text_strings = []
-    entry_body = entry['event']
-    (entry_body, uncached) = resolve_cached_image_references(entry_body, image_urls_to_filenames)
-    entry_body = re.sub("(\r\n|\r|\n)", "<br />", entry_body)
-    text_strings.append(html_split_on_entry_body[0])
-    text_strings.append(u'<div class="entry-content" id="entry-content-insertion-point">')
-    text_strings.append(entry_body)
-    text_strings.append(u'</div>')
+# Returns all the fragments rendered since the last call, and forgets them.
+def take_rendered_entry_fragments():
+    rendered = entry_fragment_cache['rendered']
+    entry_fragment_cache['rendered'] = []
+    return rendered
 
-    remainder = html_split_on_entry_body[-1]
 
-    # Use string substitution to insert comment bodies where they go.
-    # Same hacky tactic as above, but comments can contain just as much junk HTML as
-    # entries, so here we go.
-    for comment in comments:
-        marker = "<div id=\"comment-content-%s-insertion-point\"></div>"  % comment['id']
-        comment_body = re.sub("(\r\n|\r|\n)", "<br />", comment['body'])
-        wrapped_comment_body = ("<div class=\"comment-content\" id=\"comment-content-%s-insertion-point\">" % comment['id']) + comment_body + "</div>"
+def entry_page_filename(itemid, comment_page=1):
+    if comment_page > 1:
+        return "entries/entry-%s-p%s.html" % (itemid, comment_page)
+    return "entries/entry-%s.html" % itemid
 
-        remainder = remainder.replace(marker, wrapped_comment_body, 1)
 
-    text_strings.append(remainder)
-    return ''.join(text_strings)
+def thread_page_filename(itemid, comment_id):
+    return "entries/entry-%s-thread-%s.html" % (itemid, comment_id)
 
 
-def create_history_page(journal_short_name, entries, comments_grouped_by_entry, image_urls_to_filenames, icons_by_keyword, moods_by_id, page_number, previous_page_entry_count=0, next_page_entry_count=0):
-    page, content = create_template_page(journal_short_name, "%s entries page %s" % (journal_short_name, page_number), True)
+# Matches the filename of any page made by entry_page_filename or thread_page_filename,
+# with the ID of the entry in the first group.
+entry_page_filename_pattern = re.compile(r'^entries/entry-(\d+)(-p\d+|-thread-\d+)?\.html$')
 
-    # Top navigation area (e.g. "previous" and "next" links)
-    topnav_div = ET.SubElement(content, 'div', attrib={'class': 'navigation topnav' })
-    topnav_inner = ET.SubElement(topnav_div, 'div', attrib={'class': 'inner' })
-    topnav_ul = ET.SubElement(topnav_inner, 'ul')
-    if previous_page_entry_count > 0:
-        topnav_li = ET.SubElement(topnav_ul, 'li', attrib={'class': 'page-back' })
-        topnav_a = ET.SubElement(topnav_li, 'a', attrib={'href': ("page-%s.html" % (page_number-1))})
-        topnav_a.text = (u"Previous %s" % (previous_page_entry_count))
 
-    if previous_page_entry_count > 0 and next_page_entry_count > 0:
-        topnav_li = ET.SubElement(topnav_ul, 'li', attrib={'class': 'page-separator' })
-        topnav_li.text = u" | "
+# Group the pages for each entry listed in the build manifest.
+# Returns a dictionary of entry IDs to lists of page filenames.
+def entry_pages_in_manifest(build_manifest):
+    pages_by_entry = {}
+    for filename in build_manifest.keys():
+        match = entry_page_filename_pattern.match(filename)
+        if match:
+            itemid = int(match.group(1))
+            if not (itemid in pages_by_entry):
+                pages_by_entry[itemid] = []
+            pages_by_entry[itemid].append(filename)
+    return pages_by_entry
+
+
+# Whether all the pages for an entry were generated last time from the exact same inputs,
+# and are still there.  They all share one hash.
+# filenames: The entry's pages from entry_pages_in_manifest
+def entry_pages_are_current(journal_short_name, itemid, filenames, input_hash, build_manifest):
+    if not (entry_page_filename(itemid) in filenames):
+        return False
+    for filename in filenames:
+        if not page_is_current(journal_short_name, filename, input_hash, build_manifest):
+            return False
+    return True
+
+
+# Split comments into pages of at most comments_per_page, breaking only between top-level
+# threads.  A thread too big for one page gets a page to itself.
+# comments: Comments in thread order, all with a thread path
+def split_comments_into_pages(comments, comments_per_page):
+    threads = []
+    for comment in comments:
+        if (len(threads) == 0) or (comment['depth'] <= threads[-1][0]['depth']):
+            threads.append([])
+        threads[-1].append(comment)
+
+    pages = [[]]
+    for thread in threads:
+        if (len(pages[-1]) > 0) and (len(pages[-1]) + len(thread) > comments_per_page):
+            pages.append([])
+        pages[-1].extend(thread)
+    return pages
+
+
+# Take the replies deeper than max_depth out of a list of comments, so they can go on pages
+# of their own, like Dreamwidth's "Thread from here" links.
+# comments: Comments in thread order, all with a thread path
+# Returns (comments to show, subthreads), where subthreads is a list of the comments left at
+# max_depth that had replies taken out, each with a list of the comments for its own page.
+# Those start with the comment itself, and have their depths shifted so it is at depth 1.
+def collapse_deep_threads(comments, max_depth):
+    shown = []
+    subthreads = []
+    subthread_root_depth = None
+    for comment in comments:
+        if (subthread_root_depth is not None) and (comment['depth'] > subthread_root_depth):
+            subthreads[-1][1].append(dict(comment, depth=comment['depth'] - subthread_root_depth + 1))
+            continue
+        subthread_root_depth = None
+        shown.append(comment)
+        if comment['depth'] == max_depth:
+            subthread_root_depth = max_depth
+            subthreads.append((comment, [dict(comment, depth=1)]))
+    return (shown, [(root, thread) for (root, thread) in subthreads if len(thread) > 1])
+
+
+# Work out all the pages needed for one entry: The entry page itself, more pages when there
+# are more comments than comments_per_page, and pages for threads deeper than thread_depth.
+# With neither limit set, there is just one page with all the comments.
+# Returns a list of page objects, with the comments and links to put on each.
+def plan_entry_pages(entry, comments, comments_per_page=None, thread_depth=None):
+    # Comments without a thread path have lost their parent and are not shown.
+    comments = [comment for comment in comments if comment['thread_path'] is not None]
+    # A thread page starts with its comment at depth 1, so collapsing at depth 1 would never end.
+    if thread_depth is not None:
+        thread_depth = max(2, thread_depth)
+    pages = []
+    # Each of these is (comments, page filename, filename of the page that links to it, title suffix)
+    to_plan = [(comments, None, None, None)]
+    while len(to_plan) > 0:
+        (page_comments, filename, parent_filename, thread_root_id) = to_plan.pop(0)
+        subthreads = []
+        if thread_depth is not None:
+            (page_comments, subthreads) = collapse_deep_threads(page_comments, thread_depth)
+
+        if thread_root_id is None:
+            if comments_per_page is not None:
+                split_pages = split_comments_into_pages(page_comments, comments_per_page)
+            else:
+                split_pages = [page_comments]
+        else:
+            split_pages = [page_comments]
+
+        comment_page_by_id = {}
+        for i in range(0, len(split_pages)):
+            page = {
+                'comments': split_pages[i],
+                'thread_links': {},
+                'comment_page': i + 1,
+                'comment_page_count': len(split_pages),
+                'thread_root_id': thread_root_id,
+                'parent_filename': parent_filename
+            }
+            if thread_root_id is None:
+                page['filename'] = entry_page_filename(entry['itemid'], i + 1)
+            else:
+                page['filename'] = filename
+            for comment in split_pages[i]:
+                comment_page_by_id[comment['id']] = page
+            pages.append(page)
+
+        for (root, thread) in subthreads:
+            root_page = comment_page_by_id[root['id']]
+            thread_filename = thread_page_filename(entry['itemid'], root['id'])
+            root_page['thread_links'][root['id']] = (os.path.basename(thread_filename), len(thread) - 1)
+            to_plan.append((thread, thread_filename, root_page['filename'], root['id']))
+    return pages
+
+
+# Links between the pages of comments for an entry, or back from a thread page.
+# position: "toppages" or "bottompages"
+def render_comment_pages_navigation(position, entry, page):
+    if page['thread_root_id'] is not None:
+        links = u'<a href="%s#cmt%s">Back to all comments</a>' % (
+            escape_html_attribute(os.path.basename(page['parent_filename'])), page['thread_root_id'])
+    else:
+        text_strings = [u'Page %s of %s<br />' % (page['comment_page'], page['comment_page_count'])]
+        for n in range(1, page['comment_page_count'] + 1):
+            if n > 1:
+                text_strings.append(u' ')
+            if n == page['comment_page']:
+                text_strings.append(u'<b>[%s]</b>' % n)
+            else:
+                text_strings.append(u'<a href="%s">[%s]</a>' %
+                    (escape_html_attribute(os.path.basename(entry_page_filename(entry['itemid'], n))), n))
+        links = ''.join(text_strings)
+    return u'<div class="comment-pages %s"><div class="comment-page-list">%s</div></div>' % (position, links)
+
+
+# comments: All comments for the entry, in thread order (see get_comments_for_entry)
+# previous_itemid, next_itemid: IDs of the entries before and after this one, or None
+# page: One of the pages from plan_entry_pages, or None to put all the comments on one page
+def create_single_entry_page(journal_short_name, entry, comments, image_urls_to_filenames, icons_by_keyword, moods_by_id, previous_itemid=None, next_itemid=None, page=None):
+    previous_link = None
+    if previous_itemid is not None:
+        previous_link = ("entry-%s.html" % previous_itemid, u"Previous Entry")
+    next_link = None
+    if next_itemid is not None:
+        next_link = ("entry-%s.html" % next_itemid, u"Next Entry")
+
+    if page is None:
+        page = plan_entry_pages(entry, comments)[0]
+
+    comments_section = render_comments_section(
+                entry=entry,
+                comments=page['comments'],
+                thread_links=page['thread_links']
+    )
+
+    content_strings = [
+        render_navigation_bar('topnav', previous_link, next_link),
+        render_entry_fragment(
+                journal_short_name=journal_short_name,
+                entry=entry,
+                comments_count=len(comments),
+                image_urls_to_filenames=image_urls_to_filenames,
+                icons_by_keyword=icons_by_keyword,
+                moods_by_id=moods_by_id
+        )
+    ]
+    # Only show links between comment pages if there's more than one.
+    if (page['comment_page_count'] > 1) or (page['thread_root_id'] is not None):
+        content_strings.append(render_comment_pages_navigation('toppages', entry, page))
+        content_strings.append(comments_section)
+        content_strings.append(render_comment_pages_navigation('bottompages', entry, page))
+    else:
+        content_strings.append(comments_section)
+    content_strings.append(render_navigation_bar('bottomnav', previous_link, next_link))
+
+    title_text = "%s entry %s" % (journal_short_name, entry['itemid'])
+    if page['thread_root_id'] is not None:
+        title_text = "%s thread %s" % (title_text, page['thread_root_id'])
+    elif page['comment_page'] > 1:
+        title_text = "%s comments page %s" % (title_text, page['comment_page'])
+    return render_page(journal_short_name, title_text, content_strings, True)
+
+
+# Render all the pages for one entry, as planned by plan_entry_pages, and write them out.
+def write_entry_pages(journal_short_name, entry, comments, pages, image_urls_to_filenames, icons_by_keyword, moods_by_id, previous_itemid=None, next_itemid=None):
+    for page in pages:
+        html_as_string = create_single_entry_page(
+                    journal_short_name=journal_short_name,
+                    entry=entry,
+                    comments=comments,
+                    image_urls_to_filenames=image_urls_to_filenames,
+                    icons_by_keyword=icons_by_keyword,
+                    moods_by_id=moods_by_id,
+                    previous_itemid=previous_itemid,
+                    next_itemid=next_itemid,
+                    page=page
+                )
+        write_html("%s/%s" % (journal_short_name, page['filename']), html_as_string)
+
 
+def create_history_page(journal_short_name, entries, comment_counts_by_entry, image_urls_to_filenames, icons_by_keyword, moods_by_id, page_number, previous_page_entry_count=0, next_page_entry_count=0):
+    previous_link = None
+    if previous_page_entry_count > 0:
+        previous_link = ("page-%s.html" % (page_number-1), u"Previous %s" % (previous_page_entry_count))
+    next_link = None
     if next_page_entry_count > 0:
-        topnav_li = ET.SubElement(topnav_ul, 'li', attrib={'class': 'page-forward' })
-        topnav_a = ET.SubElement(topnav_li, 'a', attrib={'href': ("page-%s.html" % (page_number+1))})
-        topnav_a.text = (u"Next %s" % (next_page_entry_count))
+        next_link = ("page-%s.html" % (page_number+1), u"Next %s" % (next_page_entry_count))
 
+    content_strings = [render_navigation_bar('topnav', previous_link, next_link)]
     for entry in entries:
-        wrapper = render_one_entry_container(
+        content_strings.append(render_entry_fragment(
                     journal_short_name=journal_short_name,
                     entry=entry,
-                    comments_count=len(comments_grouped_by_entry[entry['itemid']]),
+                    comments_count=comment_counts_by_entry.get(entry['itemid'], 0),
+                    image_urls_to_filenames=image_urls_to_filenames,
                     icons_by_keyword=icons_by_keyword,
                     moods_by_id=moods_by_id
-        )
-        content.append(wrapper)
+        ))
+    content_strings.append(render_navigation_bar('bottomnav', previous_link, next_link))
 
-    # Bottom navigation area (e.g. "previous" and "next" links)
-    bottomnav_div = ET.SubElement(content, 'div', attrib={'class': 'navigation bottomnav' })
-    bottomnav_inner = ET.SubElement(bottomnav_div, 'div', attrib={'class': 'inner' })
-    bottomnav_ul = ET.SubElement(bottomnav_inner, 'ul')
-    if previous_page_entry_count > 0:
-        bottomnav_li = ET.SubElement(bottomnav_ul, 'li', attrib={'class': 'page-back' })
-        bottomnav_a = ET.SubElement(bottomnav_li, 'a', attrib={'href': ("page-%s.html" % (page_number-1))})
-        bottomnav_a.text = (u"Previous %s" % (previous_page_entry_count))
+    return render_page(journal_short_name, "%s entries page %s" % (journal_short_name, page_number), content_strings, True)
 
-    if previous_page_entry_count > 0 and next_page_entry_count > 0:
-        bottomnav_li = ET.SubElement(bottomnav_ul, 'li', attrib={'class': 'page-separator' })
-        bottomnav_li.text = u" | "
 
-    if next_page_entry_count > 0:
-        bottomnav_li = ET.SubElement(bottomnav_ul, 'li', attrib={'class': 'page-forward' })
-        bottomnav_a = ET.SubElement(bottomnav_li, 'a', attrib={'href': ("page-%s.html" % (page_number+1))})
-        bottomnav_a.text = (u"Next %s" % (next_page_entry_count))
-
-    # We're going to be weird here, because journal entries often contain weird and
-    # broken HTML.  We really can't rely on parsing a journal entry into XML and then
-    # embedding it as elements.  There is also no clean way to slipstream string data
-    # into the XML during the rendering process (it either gets parsed as usual before
-    # insertion, or run through an escaper).  So we're going to render the document as
-    # text right here, and then do a text search (a split) to find all the divs with id
-    # "entry-content-insertion-point".  Then we'll interleave the entry contents and
-    # re-assemble the document.  It's hacky but it avoids the need to police the HTML
-    # skills of thousands of users whose entires render fine in Dreamwidth.
-    html_as_string = ET.tostring(page, encoding="utf-8", method="html").decode('utf-8')
-    html_split_on_insertion_points = html_as_string.split(u'<div class="entry-content" id="entry-content-insertion-point"></div>')
+# Entries are listed in the table of contents and the reports as (itemid, eventtime_unix, subject)
+# tuples, which take up much less memory than the entries themselves.
+def toc_entry(entry):
+    return (entry['itemid'], entry['eventtime_unix'], entry['subject'])
 
-    text_strings = []
-    for i in range(0, len(entries)):
-        e = entries[i]
-        entry_body = e['event']
-        (entry_body, uncached) = resolve_cached_image_references(entry_body, image_urls_to_filenames)
-        entry_body = re.sub("(\r\n|\r|\n)", "<br />", entry_body)
-        text_strings.append(html_split_on_insertion_points[i])
-        text_strings.append(u'<div class="entry-content" id="entry-content-insertion-point">')
-        text_strings.append(entry_body)
-        text_strings.append(u'</div>')
-    # Add the tail end of the rendered HTML
-    text_strings.append(html_split_on_insertion_points[-1])
 
-    return ''.join(text_strings)
+def toc_entry_filename(toc):
+    return "entries/entry-%s.html" % toc[0]
+
+
+# Tags can contain anything, so their page names are made from a simplified version of the
+# tag, plus a bit of a hash if that lost anything, so no two tags end up sharing a page.
+# Returns the path of the page relative to the journal folder.
+def tag_page_filename(tag):
+    simplified = re.sub(r'[^a-z0-9]+', '-', tag.lower()).strip('-')
+    if simplified != tag:
+        tag_hash = hashlib.sha1(tag.encode('utf-8')).hexdigest()[:8]
+        if simplified:
+            simplified = "%s-%s" % (simplified, tag_hash)
+        else:
+            simplified = tag_hash
+    return "tags/%s.html" % simplified
+
+
+def year_page_filename(year):
+    return "archive/%04d.html" % year
+
 
+def month_page_filename(year, month):
+    return "archive/%04d-%02d.html" % (year, month)
 
-def create_table_of_contents_page(journal_short_name, entry_count, entries_table_of_contents, history_page_table_of_contents, tags_encountered, entries_by_tag):
-    page, content = create_template_page(journal_short_name, "%s archive" % journal_short_name, False)
 
-    toc_banner = ET.SubElement(content, 'h1')
-    toc_banner.text = 'Number of entries: %s' % entry_count
+def month_name(year, month):
+    return datetime(year, month, 1).strftime("%Y %B")
+
+
+# The pieces of the table of contents page, in order.  It links to the history pages,
+# and to a page for each tag and each year.  The entries themselves are listed on those.
+# month_entry_counts: List of ((year, month), entry count) tuples, oldest to newest
+# tag_entry_counts: Dictionary of tag names to entry counts
+def render_table_of_contents(entry_count, month_entry_counts, history_page_table_of_contents, tags_encountered, tag_entry_counts):
+    yield u'<h1>Number of entries: %s</h1>' % entry_count
 
     sections = [("Entries As History Pages", "#history"),
                 ("Entries By Tag", "#bytag"),
-                ("All Entries By Month", "#bymonth"),
+                ("Entries By Year", "#byyear"),
                 ("Uncached Image Report", "uncached_images_report.html")]
     for section in sections:
         (section_name, section_url) = section
-        toc_section_p = ET.SubElement(content, 'p')
-        toc_section_a = ET.SubElement(toc_section_p, 'a', attrib={ 'href': section_url })
-        toc_section_a.text = section_name
+        yield u'<p><a href="%s">%s</a></p>' % (escape_html_attribute(section_url), escape_html_text(section_name))
 
-    tag_toc_banner = ET.SubElement(content, 'h2', attrib={'id': 'history' })
-    tag_toc_banner.text = 'Entries As History Pages'
-
-    history_ul = ET.SubElement(content, 'ul')
+    yield u'<h2 id="history">Entries As History Pages</h2>'
 
+    text_strings = [u'<ul>']
     for toc in history_page_table_of_contents:
-        history_li = ET.SubElement(history_ul, 'li')
-        history_a = ET.SubElement(history_li, 'a', attrib={ 'href': toc['filename'] })
         d_from = html.escape(toc['from'].strftime("%Y %b %e"))
         d_to = html.escape(toc['to'].strftime("%Y %b %e"))
-        history_a.text = "%s ... %s" % (d_from, d_to)
+        text_strings.append(u'<li><a href="%s">%s</a></li>' %
+            (escape_html_attribute(toc['filename']), escape_html_text("%s ... %s" % (d_from, d_to))))
+    text_strings.append(u'</ul>')
+    yield ''.join(text_strings)
 
-    tag_toc_banner = ET.SubElement(content, 'h2', attrib={'id': 'bytag' })
-    tag_toc_banner.text = 'Entries By Tag'
+    yield u'<h2 id="bytag">Entries By Tag</h2>'
 
+    text_strings = [u'<ul>']
     for tag in tags_encountered:
-        tag_banner_a = ET.SubElement(content, 'a', attrib={ 'name': tag, 'id': tag })
-        tag_banner = ET.SubElement(tag_banner_a, 'h3')
-        tag_banner.text = html.escape(tag)
-        tag_ul = ET.SubElement(content, 'ul')
-
-        for toc in entries_by_tag[tag]:
-            tag_li = ET.SubElement(tag_ul, 'li')
-            tag_a = ET.SubElement(tag_li, 'a', attrib={ 'href': toc['filename'] })
-            d = toc['date']
-            dh = int(f'{d:%I}')
-            e_date = html.escape(f'{d:%b}. {d.day}, {d:%Y} {dh}:{d:%M} {d:%p}')
-            tag_a.text = "%s:" % e_date
-            tag_a.tail = " %s" % toc['subject']
-
-    entries_toc_banner = ET.SubElement(content, 'h2', attrib={'id': 'bymonth' })
-    entries_toc_banner.text = 'All Entries By Month'
-
-    for toc_group in entries_table_of_contents:
-        month_banner = ET.SubElement(content, 'h4')
-        month_banner.text = html.escape(toc_group[0]['date'].strftime("%Y %B"))
-        month_ul = ET.SubElement(content, 'ul')
-
-        for toc in toc_group:
-            month_li = ET.SubElement(month_ul, 'li')
-            month_a = ET.SubElement(month_li, 'a', attrib={ 'href': toc['filename'] })
-            d = toc['date']
-            dh = int(f'{d:%I}')
-            e_date = html.escape(f'{d:%b}. {d.day}, {d:%Y} {dh}:{d:%M} {d:%p}')
-            month_a.text = "%s:" % e_date
-            month_a.tail = " %s" % toc['subject']
-
-    html_as_string = ET.tostring(page, encoding="utf-8", method="html").decode('utf-8')
-    return html_as_string
-
-
-def create_uncached_images_report_page(journal_short_name, entries):
-    page, content = create_template_page(journal_short_name, "%s uncached images" % journal_short_name, False)
-
-    toc_banner = ET.SubElement(content, 'h1')
-    toc_banner.text = 'Number of entries with uncached (possibly broken) images: %s' % len(entries)
-
-    history_ul = ET.SubElement(content, 'ul')
-
-    ul = ET.SubElement(content, 'ul')
-    for toc_urls in entries:
-        (toc, urls) = toc_urls
-        li = ET.SubElement(ul, 'li')
-        a = ET.SubElement(li, 'a', attrib={ 'href': toc['filename'] })
-        d = toc['date']
-        dh = int(f'{d:%I}')
-        e_date = html.escape(f'{d:%b}. {d.day}, {d:%Y} {dh}:{d:%M} {d:%p}')
-        a.text = "%s:" % e_date
-        a.tail = " %s (%s)" % (toc['subject'], len(urls))
+        text_strings.append(u'<li><a href="%s">%s</a> (%s)</li>' %
+            (escape_html_attribute(tag_page_filename(tag)), escape_html_text(tag), tag_entry_counts[tag]))
+    text_strings.append(u'</ul>')
+    yield ''.join(text_strings)
+
+    yield u'<h2 id="byyear">Entries By Year</h2>'
+
+    text_strings = []
+    for ((year, month), count) in month_entry_counts:
+        if (len(text_strings) == 0) or (year != current_year):
+            if len(text_strings) > 0:
+                text_strings.append(u'</ul>')
+                yield ''.join(text_strings)
+            current_year = year
+            text_strings = [u'<h3><a href="%s">%s</a></h3><ul>' % (escape_html_attribute(year_page_filename(year)), year)]
+        text_strings.append(u'<li><a href="%s">%s</a> (%s)</li>' %
+            (escape_html_attribute(month_page_filename(year, month)), escape_html_text(month_name(year, month)), count))
+    if len(text_strings) > 0:
+        text_strings.append(u'</ul>')
+        yield ''.join(text_strings)
+
+
+# The pieces of a page for one year, linking to the pages for each of its months.
+# months: List of ((year, month), entry count) tuples for this year
+# previous_year, next_year: Neighboring years that have entries, or None
+def render_year_page(year, months, previous_year, next_year):
+    previous_link = None
+    if previous_year is not None:
+        previous_link = ("../%s" % year_page_filename(previous_year), u"%s" % previous_year)
+    next_link = None
+    if next_year is not None:
+        next_link = ("../%s" % year_page_filename(next_year), u"%s" % next_year)
+
+    yield render_navigation_bar('topnav', previous_link, next_link)
+    yield u'<p><a href="../index.html">Table of contents</a></p>'
+    yield u'<h1>%s</h1>' % year
+    text_strings = [u'<ul>']
+    for ((y, month), count) in months:
+        text_strings.append(u'<li><a href="%s">%s</a> (%s)</li>' %
+            (escape_html_attribute("../%s" % month_page_filename(year, month)), escape_html_text(month_name(year, month)), count))
+    text_strings.append(u'</ul>')
+    yield ''.join(text_strings)
+    yield render_navigation_bar('bottomnav', previous_link, next_link)
+
+
+# The pieces of a page listing all the entries from one month.
+# previous_month, next_month: Neighboring (year, month) tuples that have entries, or None
+def render_month_page(year, month, tocs, previous_month, next_month):
+    previous_link = None
+    if previous_month is not None:
+        previous_link = ("../%s" % month_page_filename(*previous_month), month_name(*previous_month))
+    next_link = None
+    if next_month is not None:
+        next_link = ("../%s" % month_page_filename(*next_month), month_name(*next_month))
+
+    yield render_navigation_bar('topnav', previous_link, next_link)
+    yield u'<p><a href="../index.html">Table of contents</a> | <a href="%s">%s</a></p>' % (
+        escape_html_attribute("../%s" % year_page_filename(year)), year)
+    yield u'<h1>%s</h1>' % escape_html_text(month_name(year, month))
+    text_strings = [u'<ul>']
+    for toc in tocs:
+        text_strings.append(render_toc_entry_item(toc, path_prefix=u'../'))
+    text_strings.append(u'</ul>')
+    yield ''.join(text_strings)
+    yield render_navigation_bar('bottomnav', previous_link, next_link)
+
+
+# The pieces of a page listing all the entries with one tag.
+def render_tag_page(tag, tocs):
+    yield u'<p><a href="../index.html#bytag">Table of contents</a></p>'
+    yield u'<h1>%s</h1>' % escape_html_text(tag)
+    text_strings = [u'<ul>']
+    for toc in tocs:
+        text_strings.append(render_toc_entry_item(toc, path_prefix=u'../'))
+    text_strings.append(u'</ul>')
+    yield ''.join(text_strings)
+
+
+# One entry in a list on an index or report page: a link with the date,
+# followed by the subject, and anything else given.
+# path_prefix: What to put in front of the link to get to the entry from the page
+def render_toc_entry_item(toc, after_subject=u'', path_prefix=u''):
+    (itemid, eventtime_unix, subject) = toc
+    d = datetime.utcfromtimestamp(eventtime_unix)
+    dh = int(f'{d:%I}')
+    e_date = html.escape(f'{d:%b}. {d.day}, {d:%Y} {dh}:{d:%M} {d:%p}')
+    return u'<li><a href="%s">%s:</a>%s</li>' % (
+        escape_html_attribute(path_prefix + toc_entry_filename(toc)),
+        escape_html_text(e_date),
+        escape_html_text(" %s%s" % (subject, after_subject)))
 
-    html_as_string = ET.tostring(page, encoding="utf-8", method="html").decode('utf-8')
-    return html_as_string
 
+# entries: List of (toc, uncached image URLs) tuples
+def render_uncached_images_report(entries):
+    yield u'<h1>Number of entries with uncached (possibly broken) images: %s</h1>' % len(entries)
 
-def download_entry_image(img_url, journal_short_name, subfolder, image_id, entry_url, ljuniq):
+    yield u'<ul></ul>'
+
+    yield u'<ul>'
+    for toc_urls in entries:
+        (toc, urls) = toc_urls
+        yield render_toc_entry_item(toc, u" (%s)" % len(urls))
+    yield u'</ul>'
+
+
+# Shared state for each worker process when rendering pages with more than one job.
+# It's set up once per process by init_render_worker, so the lookup tables only
+# have to be sent over once, and each worker reads entries from its own connection.
+render_worker_context = None
+
+
+def init_render_worker(journal_short_name, image_urls_to_filenames, icons_by_keyword, moods_by_id, cache_fragments, comments_per_page, thread_depth):
+    global render_worker_context
+    conn = connect_to_local_journal_db("%s/journal.db" % journal_short_name, False, read_only=True)
+    # Workers can look up stored fragments but not save them.  They hand back what they
+    # rendered instead, and the parent process saves it.
+    entry_fragment_cache['fragments'] = {}
+    entry_fragment_cache['rendered'] = []
+    entry_fragment_cache['cur'] = None
+    if cache_fragments:
+        entry_fragment_cache['cur'] = conn.cursor()
+    render_worker_context = {
+        'journal_short_name': journal_short_name,
+        'image_urls_to_filenames': image_urls_to_filenames,
+        'icons_by_keyword': icons_by_keyword,
+        'moods_by_id': moods_by_id,
+        'comments_per_page': comments_per_page,
+        'thread_depth': thread_depth,
+        'cur': conn.cursor()
+    }
+
+
+# Returns the entry ID, the filenames of the pages written, and any fragments rendered.
+def render_entry_page_in_worker(itemid):
+    c = render_worker_context
+    entry = get_event(c['cur'], False, itemid)
+    (previous_entry, next_entry) = get_neighbor_events(c['cur'], False, entry)
+    comments = get_comments_for_entry(c['cur'], False, itemid)
+    pages = plan_entry_pages(entry, comments, c['comments_per_page'], c['thread_depth'])
+    write_entry_pages(
+                journal_short_name=c['journal_short_name'],
+                entry=entry,
+                comments=comments,
+                pages=pages,
+                image_urls_to_filenames=c['image_urls_to_filenames'],
+                icons_by_keyword=c['icons_by_keyword'],
+                moods_by_id=c['moods_by_id'],
+                previous_itemid=previous_entry['itemid'] if previous_entry else None,
+                next_itemid=next_entry['itemid'] if next_entry else None
+            )
+    return (itemid, [page['filename'] for page in pages], take_rendered_entry_fragments())
+
+
+def render_history_page_in_worker(page_number, itemids, previous_count, next_count):
+    c = render_worker_context
+    entries = []
+    comment_counts_by_entry = {}
+    for itemid in itemids:
+        entries.append(get_event(c['cur'], False, itemid))
+        comment_counts_by_entry[itemid] = get_comment_count_for_entry(c['cur'], False, itemid)
+    page = create_history_page(
+                journal_short_name=c['journal_short_name'],
+                entries=entries,
+                comment_counts_by_entry=comment_counts_by_entry,
+                image_urls_to_filenames=c['image_urls_to_filenames'],
+                icons_by_keyword=c['icons_by_keyword'],
+                moods_by_id=c['moods_by_id'],
+                page_number=page_number,
+                previous_page_entry_count=previous_count,
+                next_page_entry_count=next_count
+            )
+    write_html("%s/history/page-%s.html" % (c['journal_short_name'], page_number), page)
+    return take_rendered_entry_fragments()
+
+
+# How much of the start of each image to keep for image_dimensions.  The size of a JPEG
+# can come after its embedded thumbnail, so this is generous.
+image_probe_size = 262144
+
+# The JPEG markers that start a frame header, which holds the image size.
+jpeg_frame_markers = [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]
+
+
+# Work out the width and height of a GIF, PNG, or JPEG image from the first bytes of its file.
+# A JPEG that's meant to be turned on its side is measured the way browsers show it.
+# Returns (width, height), or None if the size can't be found.
+def image_dimensions(head):
+    size = None
+    if (head[:6] in [b'GIF87a', b'GIF89a']) and (len(head) >= 10):
+        size = (int.from_bytes(head[6:8], 'little'), int.from_bytes(head[8:10], 'little'))
+    elif (head[:8] == b'\x89PNG\r\n\x1a\n') and (head[12:16] == b'IHDR') and (len(head) >= 24):
+        size = (int.from_bytes(head[16:20], 'big'), int.from_bytes(head[20:24], 'big'))
+    elif head[:2] == b'\xff\xd8':
+        size = jpeg_dimensions(head)
+    if (size is None) or (size[0] == 0) or (size[1] == 0):
+        return None
+    return size
+
+
+# Walk the segments at the start of a JPEG file until the frame header turns up.
+def jpeg_dimensions(head):
+    rotated = False
+    position = 2
+    while position + 4 <= len(head):
+        if head[position] != 0xff:
+            return None
+        marker = head[position + 1]
+        # Padding, and markers that have no segment after them
+        if marker == 0xff:
+            position += 1
+            continue
+        if (marker == 0x01) or (0xd0 <= marker <= 0xd7):
+            position += 2
+            continue
+        # Image data starts here, so there was no frame header
+        if marker in [0xd9, 0xda]:
+            return None
+        length = int.from_bytes(head[position + 2:position + 4], 'big')
+        segment = head[position + 4:position + 2 + length]
+        if (marker == 0xe1) and (segment[:6] == b'Exif\x00\x00'):
+            # Orientations 5 to 8 turn the picture a quarter turn
+            rotated = exif_orientation(segment[6:]) in [5, 6, 7, 8]
+        elif (marker in jpeg_frame_markers) and (len(segment) >= 5):
+            height = int.from_bytes(segment[1:3], 'big')
+            width = int.from_bytes(segment[3:5], 'big')
+            if rotated:
+                return (height, width)
+            return (width, height)
+        position += 2 + length
+    return None
+
+
+# Find the orientation tag in the first directory of the EXIF data in a JPEG.
+def exif_orientation(tiff):
+    if tiff[:2] == b'II':
+        byte_order = 'little'
+    elif tiff[:2] == b'MM':
+        byte_order = 'big'
+    else:
+        return None
+    directory = int.from_bytes(tiff[4:8], byte_order)
+    entry_count = int.from_bytes(tiff[directory:directory + 2], byte_order)
+    for i in range(entry_count):
+        entry = directory + 2 + (i * 12)
+        if entry + 12 > len(tiff):
+            break
+        if int.from_bytes(tiff[entry:entry + 2], byte_order) == 0x0112:
+            return int.from_bytes(tiff[entry + 8:entry + 10], byte_order)
+    return None
+
+
+# Returns (error, image), where image is a dict with the filename, content hash, size,
+# ETag and Last-Modified date, and width and height (or 0) of the new file,
+# or None if there's an error.  Both are None if the byte budget for the run ran out
+# partway through; the partial file is kept for next time.
+# Downloads are written to a partial file named after the image id, and only moved into
+# place once they're complete.  If a download is cut off, the partial file is kept, and
+# the next attempt asks the server for just the rest of it.
+# If validators (the 'etag' and 'last_modified' of a cached copy) are given, the request
+# is conditional, and an unchanged image comes back as the error 'not modified'.  A changed
+# one is saved under a new filename, so the old file is untouched until it's let go of.
+# max_size: Bytes, or None
+def download_entry_image(img_url, journal_short_name, subfolder, image_id, entry_url, ljuniq, max_size=None, validators=None):
+    partial_filename = "%s/images/partial/%s" % (journal_short_name, image_id)
     try:
         headers = {}
         # A URL is not mandatory in the journal data, so we need to check that.
@@ -685,12 +1161,45 @@ def download_entry_image(img_url, journal_short_name, subfolder, image_id, entry
             # Only necessary for Dreamwidth-hosted images, but does no harm generally.
             headers = {'Referer': entry_url, 'Cookie': "ljuniq="+ljuniq}
 
-        image_req = urllib.request.urlopen(urllib.request.Request(img_url, headers = headers), timeout = 4)
+        resume_from = 0
+        if validators is not None:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        elif os.path.exists(partial_filename):
+            resume_from = os.path.getsize(partial_filename)
+        if resume_from > 0:
+            headers['Range'] = 'bytes=%s-' % resume_from
+
+        try:
+            image_req = urllib.request.urlopen(urllib.request.Request(img_url, headers = headers), timeout = 4)
+        except urllib.error.HTTPError as e:
+            # The partial file doesn't fit what the server has now, so start over next time.
+            if e.code == 416:
+                os.remove(partial_filename)
+            if e.code == 304:
+                e.close()
+                return ('not modified', None)
+            raise
+        if image_req.status != 206:
+            # The server sent the whole image, not just the rest of it.
+            resume_from = 0
         if image_req.headers.get_content_maintype() != 'image':
+            image_req.close()
             print('Content type %s not expected, image skipped: %s' % (image_req.headers.get_content_maintype(), img_url))
-            return (1, None)
+            return ('not an image', None)
         extension = MimeExtensions.get(image_req.info()["Content-Type"], "")
 
+        expected_size = None
+        content_length = image_req.headers.get('Content-Length')
+        if (content_length is not None) and content_length.isdigit():
+            expected_size = resume_from + int(content_length)
+        if (max_size is not None) and (expected_size is not None) and (expected_size > max_size):
+            image_req.close()
+            print('Image is %s bytes, more than the limit of %s, skipped: %s' % (expected_size, max_size, img_url))
+            return ('too large', None)
+
         # Try and decode any utf-8 in the URL
         try:
             filename = codecs.utf_8_decode(img_url)[0]
@@ -706,36 +1215,637 @@ def download_entry_image(img_url, journal_short_name, subfolder, image_id, entry
         filename = filename.lstrip("_")
         filename = "%s/%s-%s%s" % (subfolder, image_id, filename, extension)
 
-        # Make sure our cache folder and subfolder exist
-        try:
-            os.mkdir("%s/images" % (journal_short_name))
-        except OSError as e:
-            if e.errno == 17:   # Folder already exists
-                pass
+        # Make sure our cache folder and subfolders exist
+        for folder in ["images", "images/%s" % subfolder, "images/partial"]:
+            try:
+                os.mkdir("%s/%s" % (journal_short_name, folder))
+            except OSError as e:
+                if e.errno == 17:   # Folder already exists
+                    pass
+
+        # Copy the file stream into the partial file, hashing the content and counting the
+        # bytes against the budget for this run as they go by.  The start of the file is
+        # kept to measure the image.  When resuming, the part already on disk is read first.
+        content_hash = hashlib.sha1()
+        head = b''
+        size = resume_from
+        if resume_from > 0:
+            with open(partial_filename, "rb") as pic_file:
+                while True:
+                    chunk = pic_file.read(65536)
+                    if not chunk:
+                        break
+                    content_hash.update(chunk)
+                    if len(head) < image_probe_size:
+                        head += chunk[:image_probe_size - len(head)]
+        out_of_budget = False
+        pic_file = open(partial_filename, "ab" if resume_from > 0 else "wb")
         try:
-            os.mkdir("%s/images/%s" % (journal_short_name, subfolder))
-        except OSError as e:
-            if e.errno == 17:   # Folder already exists
-                pass
-
-        # Copy the file stream directly into the file and close both
-        pic_file = open("%s/images/%s" % (journal_short_name, filename), "wb")
-        shutil.copyfileobj(image_req, pic_file)
-        image_req.close()
-        pic_file.close()
-        return (0, filename)
+            while True:
+                chunk = image_req.read(65536)
+                if not chunk:
+                    break
+                if not count_downloaded_image_bytes(len(chunk)):
+                    out_of_budget = True
+                    break
+                pic_file.write(chunk)
+                content_hash.update(chunk)
+                if len(head) < image_probe_size:
+                    head += chunk[:image_probe_size - len(head)]
+                size += len(chunk)
+                throttle_download(len(chunk))
+                if (max_size is not None) and (size > max_size):
+                    break
+        finally:
+            pic_file.close()
+            image_req.close()
+
+        if out_of_budget:
+            return (None, None)
+        if (max_size is not None) and (size > max_size):
+            os.remove(partial_filename)
+            print('Image is more than the limit of %s bytes, skipped: %s' % (max_size, img_url))
+            return ('too large', None)
+        if (expected_size is not None) and (size != expected_size):
+            print('Download stopped after %s of %s bytes, will resume later: %s' % (size, expected_size, img_url))
+            return ('incomplete', None)
+
+        content_hash = content_hash.hexdigest()
+        if validators is not None:
+            filename = "%s-%s%s" % (filename[:len(filename) - len(extension)], content_hash[:8], extension)
+        os.replace(partial_filename, "%s/images/%s" % (journal_short_name, filename))
+        (width, height) = image_dimensions(head) or (0, 0)
+        image = {
+            'filename': filename,
+            'content_hash': content_hash,
+            'size': size,
+            'etag': image_req.headers.get('ETag'),
+            'last_modified': image_req.headers.get('Last-Modified'),
+            'width': width,
+            'height': height
+        }
+        return (None, image)
     except urllib.error.HTTPError as e:
         print(e)
-        return (e.code, None)
+        return ('http %s' % e.code, None)
     except urllib.error.URLError as e:
         print(e)
-        return (2, None)
+        if isinstance(e.reason, socket.timeout):
+            return ('timeout', None)
+        if isinstance(e.reason, socket.gaierror):
+            return ('dns', None)
+        return ('other', None)
+    except socket.timeout as e:
+        print(e)
+        return ('timeout', None)
+    except http.client.IncompleteRead as e:
+        print(e)
+        return ('incomplete', None)
     except Exception as e:
         print(e)
-        return (1, None)
+        return ('other', None)
+
+
+# A cap on download speed, shared by every image and userpic download in the run, so
+# caching doesn't crowd out everything else on the connection.
+# rate: Bytes per second, or None for no cap
+# hours: (start, end) in minutes after midnight, local time, when the cap applies, or None
+#   for all day.  The end can come before the start, for hours that span midnight.
+# next_free: When everything downloaded so far will have been paid for at the capped rate
+# waiting, wait_started, waited: How many downloads are being held back right now, since
+#   when, and the total seconds that at least one has been held back
+download_throttle = {
+    'lock': threading.Lock(),
+    'rate': None,
+    'hours': None,
+    'next_free': 0,
+    'waiting': 0,
+    'wait_started': None,
+    'waited': 0
+}
+
+
+# Takes a range of times like "08:00-23:30", and returns (start, end) in minutes after midnight.
+def parse_download_hours(text):
+    match = re.match(r'^\s*(\d{1,2}):(\d\d)\s*-\s*(\d{1,2}):(\d\d)\s*$', text)
+    if match is None:
+        raise argparse.ArgumentTypeError("expected a range of times like 08:00-23:30, not '%s'" % text)
+    (start_hour, start_minute, end_hour, end_minute) = [int(g) for g in match.groups()]
+    if (start_hour > 23) or (end_hour > 24) or (start_minute > 59) or (end_minute > 59):
+        raise argparse.ArgumentTypeError("'%s' is not a time of day" % text)
+    return (start_hour * 60 + start_minute, end_hour * 60 + end_minute)
+
+
+# Set the cap on download speed.
+# rate_limit: Kilobytes per second, or None
+# hours: As returned by parse_download_hours, or None for all day
+def set_download_throttle(rate_limit, hours=None):
+    throttle = download_throttle
+    with throttle['lock']:
+        throttle['rate'] = None
+        if rate_limit:
+            throttle['rate'] = rate_limit * 1024
+        throttle['hours'] = hours
+        throttle['next_free'] = 0
+
+
+def download_throttle_applies():
+    throttle = download_throttle
+    if throttle['rate'] is None:
+        return False
+    if throttle['hours'] is None:
+        return True
+    now = datetime.now()
+    minute = now.hour * 60 + now.minute
+    (start, end) = throttle['hours']
+    if start <= end:
+        return start <= minute < end
+    return (minute >= start) or (minute < end)
+
+
+# Called as each chunk of a download arrives.  If all the downloads together are going
+# faster than the cap, this waits until they're back under it.  A second's worth of
+# bytes can come through at once after a pause.
+def throttle_download(byte_count):
+    if not download_throttle_applies():
+        return
+    throttle = download_throttle
+    with throttle['lock']:
+        now = monotonic()
+        throttle['next_free'] = max(throttle['next_free'], now - 1) + byte_count / throttle['rate']
+        delay = throttle['next_free'] - now
+        if delay <= 0:
+            return
+        if throttle['waiting'] == 0:
+            throttle['wait_started'] = now
+        throttle['waiting'] += 1
+    sleep(delay)
+    with throttle['lock']:
+        throttle['waiting'] -= 1
+        if throttle['waiting'] == 0:
+            throttle['waited'] += monotonic() - throttle['wait_started']
+
+
+# A line for the run summary, saying how fast some downloads went, and how long the cap
+# held them back.  waited_before is download_throttle['waited'] from when they started.
+def describe_download_rate(byte_count, started, waited_before):
+    elapsed = max(monotonic() - started, 0.001)
+    text = "Downloaded at an average of %.0f KB/s" % (byte_count / 1024 / elapsed)
+    waited = download_throttle['waited'] - waited_before
+    if waited >= 1:
+        text += ", held back for %.0f seconds by the download rate limit" % waited
+    return text + "."
+
+
+# Shared by the threads that download images.  Each host gets a semaphore so no one
+# server sees more than a few requests from us at once, and everything read is added
+# to one total so the whole run can stay inside a time and byte budget.
+image_download_state = {
+    'lock': threading.Lock(),
+    'host_slots': {},
+    'jobs_per_host': 2,
+    'bytes_read': 0,
+    'out_of_bytes': False,
+    'byte_budget': None,
+    'deadline': None,
+    'max_size': None,
+    'started': None,
+    'waited_before': 0
+}
+
+
+# Count bytes read against the budget for this run.  Returns False, without counting
+# them, if they would go over it, so the download can stop before writing them.
+def count_downloaded_image_bytes(byte_count):
+    state = image_download_state
+    with state['lock']:
+        if (state['byte_budget'] is not None) and (state['bytes_read'] + byte_count > state['byte_budget']):
+            state['out_of_bytes'] = True
+            return False
+        state['bytes_read'] += byte_count
+        return True
+
+
+# True if there's still time and bandwidth left in this run to start another download.
+def image_download_budget_left():
+    state = image_download_state
+    if (state['deadline'] is not None) and (monotonic() >= state['deadline']):
+        return False
+    if state['out_of_bytes'] or ((state['byte_budget'] is not None) and (state['bytes_read'] >= state['byte_budget'])):
+        return False
+    return True
+
+
+def image_host_slot(img_url):
+    host = urllib.parse.urlsplit(img_url).hostname or ''
+    state = image_download_state
+    with state['lock']:
+        if host not in state['host_slots']:
+            state['host_slots'][host] = threading.BoundedSemaphore(state['jobs_per_host'])
+        return state['host_slots'][host]
+
+
+# Set up the shared state for a round of downloads.
+# jobs_per_host: Downloads at once from one server
+# time_budget: Minutes, or None
+# byte_budget: Megabytes, or None
+# max_size: Megabytes, or None
+def start_image_downloads(jobs_per_host, time_budget, byte_budget, max_size):
+    state = image_download_state
+    state['host_slots'] = {}
+    state['jobs_per_host'] = max(1, jobs_per_host)
+    state['bytes_read'] = 0
+    state['out_of_bytes'] = False
+    state['byte_budget'] = None
+    if byte_budget is not None:
+        state['byte_budget'] = byte_budget * 1024 * 1024
+    state['max_size'] = None
+    if max_size is not None:
+        state['max_size'] = int(max_size * 1024 * 1024)
+    state['deadline'] = None
+    if time_budget is not None:
+        state['deadline'] = monotonic() + time_budget * 60
+    state['started'] = monotonic()
+    state['waited_before'] = download_throttle['waited']
+
+
+def describe_image_download_rate():
+    state = image_download_state
+    return describe_download_rate(state['bytes_read'], state['started'], state['waited_before'])
+
+
+# Runs in a download thread.  It never touches the database; the main thread records
+# the result, so there's only ever one writer.
+# A job is a dict with the image 'id', 'url', and 'subfolder', the 'entry_url' to give as
+# the referrer, and optionally the 'validators' of a cached copy (see download_entry_image).
+# Returns (job, error, image), as download_entry_image.  Both error and image are None if
+# the budget ran out before the download could finish.
+def download_entry_image_in_thread(job, journal_short_name, ljuniq):
+    with image_host_slot(job['url']):
+        if not image_download_budget_left():
+            return (job, None, None)
+        (error, image) = download_entry_image(job['url'], journal_short_name, job['subfolder'], job['id'], job['entry_url'], ljuniq, image_download_state['max_size'], job.get('validators'))
+    return (job, error, image)
+
+
+# Run download jobs on a pool of threads, until there are none left or the budget runs out.
+# get_jobs(limit) returns up to limit jobs in the order they should go.  It's called again
+# as threads free up, so it may return jobs already started; those are skipped.
+# record_result(job, error, image) is called on the main thread for each finished job.
+def run_image_downloads(get_jobs, record_result, journal_short_name, ljuniq, image_jobs):
+    image_jobs = max(1, image_jobs)
+    # Enough queued work to keep every thread busy, without getting far ahead of them.
+    max_pending = image_jobs * 4
+    pending = set()
+    queued_ids = set()
+
+    def record_results(done):
+        for future in done:
+            (job, error, image) = future.result()
+            if (error is not None) or (image is not None):
+                record_result(job, error, image)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=image_jobs)
+    try:
+        while image_download_budget_left():
+            # Jobs still running may be returned again, so ask for enough to get past them.
+            jobs = [job for job in get_jobs(len(pending) + max_pending) if not (job['id'] in queued_ids)]
+            if len(jobs) == 0:
+                break
+            for job in jobs:
+                if not image_download_budget_left():
+                    break
+                queued_ids.add(job['id'])
+                pending.add(executor.submit(download_entry_image_in_thread, job, journal_short_name, ljuniq))
+                if len(pending) >= max_pending:
+                    (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    record_results(done)
+        (done, pending) = concurrent.futures.wait(pending)
+        record_results(done)
+    finally:
+        executor.shutdown(wait=True)
+
+
+# Record a newly downloaded image.  Identical pictures often turn up under different
+# addresses, so only the first copy is kept, and every image with the same content
+# points at that file.
+# Returns the number of bytes saved by not keeping the new file.
+def record_downloaded_image(cur, verbose, journal_short_name, image_id, image, entry_date):
+    img_filename = image['filename']
+    saved = 0
+    same_content = get_cached_image_record_with_content(cur, verbose, image['content_hash'])
+    if (same_content is not None) and (same_content['id'] != image_id) and (same_content['filename'] != img_filename):
+        os.remove("%s/images/%s" % (journal_short_name, img_filename))
+        img_filename = same_content['filename']
+        saved = image['size']
+    report_image_as_cached(cur, verbose, image_id, img_filename, entry_date, image['content_hash'], image['size'], image['etag'], image['last_modified'], image['width'], image['height'])
+    return saved
+
+
+# Work out the content hash, size, and dimensions of images cached before those were kept,
+# so new downloads can be matched against them, and pages can give their size.
+def hash_cached_image_files(cur, verbose, journal_short_name):
+    hashed = 0
+    for record in get_unhashed_cached_image_records(cur, verbose):
+        if not image_download_budget_left():
+            break
+        content_hash = hashlib.sha1()
+        head = b''
+        size = 0
+        try:
+            with open("%s/images/%s" % (journal_short_name, record['filename']), "rb") as pic_file:
+                while True:
+                    chunk = pic_file.read(65536)
+                    if not chunk:
+                        break
+                    content_hash.update(chunk)
+                    if len(head) < image_probe_size:
+                        head += chunk[:image_probe_size - len(head)]
+                    size += len(chunk)
+        except OSError:
+            continue
+        (width, height) = image_dimensions(head) or (0, 0)
+        report_image_content(cur, verbose, record['id'], content_hash.hexdigest(), size, width, height)
+        hashed += 1
+    if hashed > 0:
+        print("Hashed %s images cached by earlier versions." % hashed)
+
+
+# Download the images referenced in entries that are due to be cached, several at a time,
+# until there are none left or the budget runs out.
+# image_order: 'oldest', 'newest', or 'referenced' (see get_images_to_cache)
+# image_time_budget: Minutes, or None
+# image_byte_budget: Megabytes, or None
+# image_max_size: Megabytes, or None
+# image_disk_budget: Megabytes, or None
+def cache_entry_images(cur, verbose, journal_short_name, ljuniq, retry_images, image_jobs, image_jobs_per_host, image_time_budget, image_byte_budget, image_order='oldest', image_max_size=None, image_disk_budget=None):
+    started = monotonic()
+    start_image_downloads(image_jobs_per_host, image_time_budget, image_byte_budget, image_max_size)
+    counts = {'cached': 0, 'failed': 0, 'duplicates': 0, 'duplicate_bytes': 0}
+
+    hash_cached_image_files(cur, verbose, journal_short_name)
+    allow_too_large_images_again(cur, verbose, image_download_state['max_size'])
+
+    # Only download as much as will fit in the disk budget.  Images evicted earlier can
+    # come back once there's a good amount of room, but not before, or the ones fetched
+    # last would be the first to be evicted again.
+    limited_by_disk_budget = False
+    if image_disk_budget is None:
+        allow_evicted_images_again(cur, verbose)
+    else:
+        measure_unsized_image_files(cur, verbose, journal_short_name)
+        budget = image_disk_budget * 1024 * 1024
+        room = budget - get_image_cache_size(cur, verbose)
+        if room > budget * image_eviction_margin:
+            allow_evicted_images_again(cur, verbose)
+        room = max(0, room)
+        state = image_download_state
+        if (state['byte_budget'] is None) or (state['byte_budget'] > room):
+            state['byte_budget'] = room
+            limited_by_disk_budget = True
+
+    now = int(calendar.timegm(datetime.utcnow().utctimetuple()))
+
+    def get_jobs(limit):
+        jobs = []
+        for image in get_images_to_cache(cur, verbose, now, retry=retry_images, order=image_order, limit=limit):
+            entry_date = datetime.utcfromtimestamp(image['entry_eventtime_unix'])
+            jobs.append({
+                'id': image['id'],
+                'url': image['url'],
+                'subfolder': entry_date.strftime("%Y-%m"),
+                'entry_date': entry_date,
+                'entry_url': image['entry_url']
+            })
+        return jobs
+
+    def record_result(job, error, image):
+        if image is not None:
+            saved = record_downloaded_image(cur, verbose, journal_short_name, job['id'], image, job['entry_date'])
+            if saved > 0:
+                counts['duplicates'] += 1
+                counts['duplicate_bytes'] += saved
+            counts['cached'] += 1
+        else:
+            report_image_as_attempted(cur, verbose, job['id'], error, image_download_state['max_size'])
+            counts['failed'] += 1
+
+    run_image_downloads(get_jobs, record_result, journal_short_name, ljuniq, image_jobs)
+
+    elapsed = monotonic() - started
+    print("Cached %s images (%.1f MB) in %.0f seconds, %s failed." % (counts['cached'], image_download_state['bytes_read'] / (1024 * 1024), elapsed, counts['failed']))
+    if counts['duplicates'] > 0:
+        print("%s of them were copies of images already cached, saving %.1f MB of disk." % (counts['duplicates'], counts['duplicate_bytes'] / (1024 * 1024)))
+    if image_download_state['bytes_read'] > 0:
+        print(describe_image_download_rate())
+    if not image_download_budget_left():
+        state = image_download_state
+        if limited_by_disk_budget and (state['out_of_bytes'] or (state['bytes_read'] >= state['byte_budget'])):
+            print("The image cache is at its disk budget of %s MB.  Raise --image_disk_budget to cache more." % image_disk_budget)
+        else:
+            print("The image budget for this run was used up.  Run again to cache more.")
+
+
+# Work out the width and height of cached images that were saved before sizes were kept.
+# Only the start of each file is read, and usually much less than image_probe_size.
+def measure_cached_image_dimensions(cur, verbose, journal_short_name):
+    measured = 0
+    for filename in get_unmeasured_cached_image_filenames(cur, verbose):
+        try:
+            with open("%s/images/%s" % (journal_short_name, filename), "rb") as pic_file:
+                head = pic_file.read(65536)
+                size = image_dimensions(head)
+                if (size is None) and (len(head) == 65536):
+                    head += pic_file.read(image_probe_size - len(head))
+                    size = image_dimensions(head)
+        except OSError:
+            continue
+        (width, height) = size or (0, 0)
+        report_image_file_dimensions(cur, verbose, filename, width, height)
+        measured += 1
+    if measured > 0:
+        print("Measured %s image files cached by earlier versions." % measured)
+
+
+# The share of the disk budget that has to be free before evicted images are fetched again.
+image_eviction_margin = 0.1
+
+
+# Images cached before sizes were kept, and not hashed yet, have no size in the database.
+# Take it from the files, so the size of the cache isn't undercounted.
+def measure_unsized_image_files(cur, verbose, journal_short_name):
+    for filename in get_unsized_cached_image_filenames(cur, verbose):
+        try:
+            size = os.path.getsize("%s/images/%s" % (journal_short_name, filename))
+        except OSError:
+            continue
+        report_image_file_size(cur, verbose, filename, size)
+
+
+# If the image cache is bigger than the disk budget, delete image files until it fits,
+# marking their records so the pages link to the originals instead.
+# image_eviction: 'largest' or 'least_referenced' (see get_image_files_to_evict)
+# image_disk_budget: Megabytes
+def evict_images_over_budget(cur, verbose, journal_short_name, image_disk_budget, image_eviction='least_referenced'):
+    budget = image_disk_budget * 1024 * 1024
+    measure_unsized_image_files(cur, verbose, journal_short_name)
+    cache_size = get_image_cache_size(cur, verbose)
+    evicted = 0
+    evicted_bytes = 0
+    if cache_size > budget:
+        for image_file in get_image_files_to_evict(cur, verbose, image_eviction):
+            if cache_size <= budget:
+                break
+            try:
+                os.remove("%s/images/%s" % (journal_short_name, image_file['filename']))
+            except OSError:
+                pass
+            report_image_file_as_evicted(cur, verbose, image_file['filename'])
+            cache_size -= image_file['size']
+            evicted += 1
+            evicted_bytes += image_file['size']
+    if evicted > 0:
+        print("Evicted %s image files (%.1f MB) to stay inside the disk budget." % (evicted, evicted_bytes / (1024 * 1024)))
+    print("Image cache is using %.1f MB of %s MB." % (cache_size / (1024 * 1024), image_disk_budget))
+
+
+# Folders in the image cache are named for the month the images are from.
+image_subfolder_pattern = re.compile(r'^\d{4}-\d{2}$')
+
+
+# Compare the files in the image cache with the database, in case some were deleted or
+# moved.  Images whose files are missing are queued to be fetched again, and files no
+# image uses any more are deleted.  Only the month folders are looked at, so partial
+# downloads and anything else kept in the images folder are left alone.
+def reconcile_image_cache(cur, verbose, journal_short_name):
+    started = monotonic()
+    images_folder = "%s/images" % journal_short_name
+    on_disk = {}
+    if os.path.isdir(images_folder):
+        with os.scandir(images_folder) as folders:
+            for folder in folders:
+                if not (folder.is_dir() and image_subfolder_pattern.match(folder.name)):
+                    continue
+                with os.scandir(folder.path) as files:
+                    for image_file in files:
+                        if image_file.is_file():
+                            on_disk[folder.name + '/' + image_file.name] = image_file
+    in_database = get_cached_image_filenames(cur, verbose)
+
+    missing = in_database.difference(on_disk.keys())
+    report_image_files_as_missing(cur, verbose, missing)
+
+    orphaned_bytes = 0
+    orphaned = [filename for filename in on_disk.keys() if not (filename in in_database)]
+    for filename in orphaned:
+        try:
+            orphaned_bytes += on_disk[filename].stat().st_size
+            os.remove(on_disk[filename].path)
+        except OSError:
+            pass
+
+    print("Checked %s image files in %.1f seconds: %s missing (queued to download again), %s orphaned files deleted (%.1f MB)." % (len(on_disk), monotonic() - started, len(missing), len(orphaned), orphaned_bytes / (1024 * 1024)))
+
+
+# Cached images are checked against their sources at most this often, in seconds.
+image_revalidate_interval = 7 * 86400
+
+
+# Check cached images against their sources with conditional requests, oldest check first,
+# and fetch the ones that have changed.  Images that haven't changed cost only a request
+# and a "304 Not Modified" reply.  Only images whose server gave an ETag or Last-Modified
+# date can be checked this way.
+# image_time_budget: Minutes, or None
+# image_max_size: Megabytes, or None
+def revalidate_cached_images(cur, verbose, journal_short_name, ljuniq, image_jobs, image_jobs_per_host, image_time_budget, image_max_size=None):
+    started = monotonic()
+    start_image_downloads(image_jobs_per_host, image_time_budget, None, image_max_size)
+    counts = {'unchanged': 0, 'updated': 0, 'failed': 0}
+
+    now = int(calendar.timegm(datetime.utcnow().utctimetuple()))
+
+    def get_jobs(limit):
+        jobs = []
+        for image in get_images_to_revalidate(cur, verbose, now - image_revalidate_interval, limit):
+            jobs.append({
+                'id': image['id'],
+                'url': image['url'],
+                'subfolder': image['filename'].split('/')[0],
+                'entry_date': None,
+                'entry_url': image['entry_url'],
+                'validators': image,
+                'filename': image['filename'],
+                'date_first_seen': image['date_first_seen']
+            })
+        return jobs
+
+    def record_result(job, error, image):
+        if image is not None:
+            entry_date = None
+            if job['date_first_seen'] is not None:
+                entry_date = datetime.utcfromtimestamp(job['date_first_seen'])
+            record_downloaded_image(cur, verbose, journal_short_name, job['id'], image, entry_date)
+            # Let go of the old file, unless other images are still using it.
+            if get_cached_image_file_use_count(cur, verbose, job['filename']) == 0:
+                try:
+                    os.remove("%s/images/%s" % (journal_short_name, job['filename']))
+                except OSError:
+                    pass
+            counts['updated'] += 1
+        elif error == 'not modified':
+            counts['unchanged'] += 1
+        else:
+            # The cached copy is kept, even if the original is gone.
+            counts['failed'] += 1
+        report_image_as_validated(cur, verbose, job['id'])
+
+    run_image_downloads(get_jobs, record_result, journal_short_name, ljuniq, image_jobs)
+
+    elapsed = monotonic() - started
+    print("Checked %s cached images in %.0f seconds: %s unchanged, %s updated (%.1f MB), %s could not be checked." % (counts['unchanged'] + counts['updated'] + counts['failed'], elapsed, counts['unchanged'], counts['updated'], image_download_state['bytes_read'] / (1024 * 1024), counts['failed']))
+    if image_download_state['bytes_read'] > 0:
+        print(describe_image_download_rate())
+    if not image_download_budget_left():
+        print("The time budget for this run was used up.  Run again to check more.")
+
+
+# How many entries to read from the database at a time.  Without a memory budget this is
+# a fixed number.  With one, the size of the database file is used to guess how big an
+# average entry is (comments included), and the batch is sized to use a quarter of the
+# budget, leaving the rest for rendering.
+# memory_budget: Megabytes, or None
+def entry_batch_size(db_file, entry_count, memory_budget):
+    if (memory_budget is None) or (entry_count == 0):
+        return 200
+    bytes_per_entry = max(1, os.path.getsize(db_file) // entry_count)
+    return max(20, min(5000, (memory_budget * 1024 * 1024 // 4) // bytes_per_entry))
+
+
+# Let go of the cached body and container for an entry that no more pages need.
+def forget_rendered_entry(itemid):
+    transformed_entry_bodies['bodies'].pop(itemid, None)
+    entry_fragment_cache['fragments'].pop(itemid, None)
+
+
+# Print the most memory this process has used at once, if the platform can tell us.
+# memory_budget: Megabytes, or None
+def report_peak_memory(memory_budget):
+    if resource is None:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # MacOS reports this in bytes, everything else in kilobytes.
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+    peak_mb = peak / 1024
+    if memory_budget is None:
+        print("Peak memory use: %.1f MB" % peak_mb)
+    else:
+        print("Peak memory use: %.1f MB (budget %s MB)" % (peak_mb, memory_budget))
+        if peak_mb > memory_budget:
+            print("Memory use went over the budget.  Most of what's left is the image cache list and the table of contents.")
 
 
-def ljdumptohtml(username, journal_short_name, ljuniq=None, verbose=True, cache_images=True, retry_images=True):
+def ljdumptohtml(username, journal_short_name, ljuniq=None, verbose=True, cache_images=True, retry_images=True, jobs=1, cache_fragments=False, memory_budget=None, comments_per_page=None, thread_depth=None, image_jobs=8, image_jobs_per_host=2, image_time_budget=10, image_byte_budget=None, image_order='oldest', image_max_size=20, revalidate_images=False, image_disk_budget=None, image_eviction='least_referenced', reconcile_images=False, download_rate_limit=None, download_rate_hours=None):
     if verbose:
         print("Starting conversion for: %s" % journal_short_name)
 
@@ -747,25 +1857,19 @@ def ljdumptohtml(username, journal_short_name, ljuniq=None, verbose=True, cache_
     if not conn:
         print("Database could not be opened for journal %s" % journal_short_name)
         os._exit(os.EX_IOERR)
+    # Bring older databases up to date, if this is run by itself.
+    create_tables_if_missing(conn, verbose)
     cur = conn.cursor()
 
-    all_entries = get_all_events(cur, verbose)
-    all_comments = get_all_comments(cur, verbose)
-
-    # Create arrays of comments by entry ID
-    comments_grouped_by_entry = {}
-    for entry in all_entries:
-        e_id = entry['itemid']
-        # Make sure every entry has an array even if it has 0 comments
-        comments_grouped_by_entry[e_id] = []
-    for comment in all_comments:
-        e_id = comment['entryid']
-        if not (e_id in comments_grouped_by_entry):
-            comments_grouped_by_entry[e_id] = []
-        comments_grouped_by_entry[e_id].append(comment)
-
-    # Sort all entries by UNIX timestamp, oldest to newest
-    entries_by_date = sorted(all_entries, key=lambda x: x['eventtime_unix'], reverse=False)
+    # Entries are never all loaded at once.  They are read in date order a batch at a time,
+    # and each entry's comments are fetched just before its page is rendered.  The table of
+    # contents and the counts on each page come from the running totals in the database.
+    month_entry_counts = []
+    entry_count = 0
+    for month in get_month_entry_counts(cur, verbose):
+        month_entry_counts.append(((month['year'], month['month_number']), month['entry_count']))
+        entry_count += month['entry_count']
+    batch_size = entry_batch_size("%s/journal.db" % journal_short_name, entry_count, memory_budget)
 
     # Fetch all user icons and sort by keyword
     all_icons = get_all_icons(cur, verbose)
@@ -783,213 +1887,363 @@ def ljdumptohtml(username, journal_short_name, ljuniq=None, verbose=True, cache_
     # image caching
     #
 
+    set_download_throttle(download_rate_limit, download_rate_hours)
+
+    if reconcile_images:
+        reconcile_image_cache(cur, verbose, journal_short_name)
+
     if cache_images:
-        dw_hosted_pattern = re.compile('^https://(\w+).dreamwidth.org/file/\d+x\d+/(.+)')
-        image_resolve_max = 200
-        entry_index = 0
-        while image_resolve_max > 0:
-            if entry_index >= len(entries_by_date):
-                image_resolve_max = 0
-            else:
-                entry = entries_by_date[entry_index]
-                entry_index += 1
-                e_id = entry['itemid']
-                entry_date = datetime.utcfromtimestamp(entry['eventtime_unix'])
-                entry_body = entry['event']
-                urls_found = re.findall(r'<img[^<>]*\ssrc\s?=\s?[\'\"](https?:/+[^\s\"\'()<>]+)[\'\"]', entry_body, flags=re.IGNORECASE)
-                subfolder = entry_date.strftime("%Y-%m")
-                for image_url in urls_found:
-
-                    url_to_cache = image_url
-                    if dw_hosted_pattern.match(image_url):
-                        dw_hosted = dw_hosted_pattern.search(image_url)
-                        url_to_cache = 'https://' + dw_hosted.group(1) + '.dreamwidth.org/file/' + dw_hosted.group(2)
-
-                    cached_image = get_or_create_cached_image_record(cur, verbose, url_to_cache, entry_date)
-                    try_cache = True
-                    # If a fetch was already attempted less than one day ago, don't try again
-                    if cached_image['date_last_attempted']:
-                        # Respect the global image cache setting
-                        try_cache = retry_images
-                        current_date = int(calendar.timegm(datetime.utcnow().utctimetuple()))
-                        if int(current_date) - int(cached_image['date_last_attempted']) < 86400:
-                            try_cache = False
-                    # If we already have an image cached for this URL, skip it.
-                    if (cached_image['cached'] == False) and try_cache:
-                        image_id = cached_image['id']
-                        cache_result = 0
-                        img_filename = None
-                        (cache_result, img_filename) = download_entry_image(url_to_cache, journal_short_name, subfolder, image_id, entry['url'], ljuniq)
-                        if (cache_result == 0) and (img_filename is not None):
-                            report_image_as_cached(cur, verbose, image_id, img_filename, entry_date)
-                            image_resolve_max -= 1
-                        else:
-                            report_image_as_attempted(cur, verbose, image_id)
+        cache_entry_images(
+            cur, verbose, journal_short_name, ljuniq, retry_images,
+            image_jobs=image_jobs,
+            image_jobs_per_host=image_jobs_per_host,
+            image_time_budget=image_time_budget,
+            image_byte_budget=image_byte_budget,
+            image_order=image_order,
+            image_max_size=image_max_size,
+            image_disk_budget=image_disk_budget
+        )
+
+    if revalidate_images:
+        revalidate_cached_images(
+            cur, verbose, journal_short_name, ljuniq,
+            image_jobs=image_jobs,
+            image_jobs_per_host=image_jobs_per_host,
+            image_time_budget=image_time_budget,
+            image_max_size=image_max_size
+        )
+
+    if image_disk_budget is not None:
+        evict_images_over_budget(cur, verbose, journal_short_name, image_disk_budget, image_eviction)
 
+    measure_cached_image_dimensions(cur, verbose, journal_short_name)
     all_cached = get_all_successfully_cached_image_records(cur, verbose)
     image_urls_to_filenames = {}
     for i in all_cached:
-        image_urls_to_filenames[i['url']] = i['filename']
+        image_urls_to_filenames[i['url']] = (i['filename'], i['width'], i['height'])
+    all_cached = None
 
     #pprint.pprint(image_urls_to_filenames)
     #os._exit(os.EX_OK)
 
+    # Hashes of the inputs to every page from the last run.  Pages whose inputs
+    # haven't changed since then, and still exist, are not generated again.
+    build_manifest = get_build_manifest(cur, verbose)
+    pages_by_entry = entry_pages_in_manifest(build_manifest)
+    new_page_hashes = {}
+
+    # Rather than the entries themselves, the hashes are worked out from a few numbers for each
+    # entry that change whenever it or its comments do, and from the cached images it uses.
+    # Only the entries whose pages need generating again are read.
+    entry_markers = get_entry_change_markers(cur, verbose)
+    revision_by_entry = {}
+    for (itemid, eventtime_unix, revision, comments_count, comments_revision) in entry_markers:
+        revision_by_entry[itemid] = revision
+    image_urls_by_entry = get_image_urls_by_entry(cur, verbose)
+    # Icons and moods can change how any entry looks.
+    icons_and_moods_hash = hash_page_inputs([icons_by_keyword, moods_by_id])
+
+    # Rendered entries are shared between entry pages and history pages, and if asked,
+    # kept in the database between runs.
+    entry_fragment_cache['fragments'] = {}
+    entry_fragment_cache['rendered'] = []
+    entry_fragment_cache['cur'] = None
+    if cache_fragments:
+        entry_fragment_cache['cur'] = cur
+
+    # With more than one job, pages are handed off to a pool of worker processes.
+    # They read from the database on their own, so it needs to be up to date.
+    pool = None
+    if jobs > 1:
+        conn.commit()
+        pool = multiprocessing.Pool(
+                    processes=jobs,
+                    initializer=init_render_worker,
+                    initargs=(journal_short_name, image_urls_to_filenames, icons_by_keyword, moods_by_id, cache_fragments, comments_per_page, thread_depth)
+                )
+
     #
-    # Entry pages, one per entry.
+    # Entry pages, one per entry, and history pages, with 20 entries each.
+    # Entries are handled a batch at a time, and each batch is a whole number of history pages.
     #
 
     entries_with_uncached_images = []
 
-    print("Rendering %s entry pages..." % (len(entries_by_date)))
+    history_page_count = (entry_count + 19) // 20
+    print("Rendering %s entry pages and %s history pages..." % (entry_count, history_page_count))
 
-    try:
-        os.mkdir("%s/entries" % (journal_short_name))
-    except OSError as e:
-        if e.errno == 17:   # Folder already exists
-            pass
-
-    entries_table_of_contents = []
-    current_month_group = []
-    current_year_and_month_str = None
-
-    for i in range(0, len(entries_by_date)):
-        entry = entries_by_date[i]
-        entry_date = datetime.utcfromtimestamp(entry['eventtime_unix'])
-        entry_year_and_month_str = entry_date.strftime("%Y-%m")
-
-        # Used for building a table of contents later
-        toc = {
-            'date': entry_date,
-            'subject': entry['subject'],
-            'filename': ("entries/entry-%s.html" % entry['itemid'])
-        }
-        previous_entry = None
-        if i > 0:
-            previous_entry = entries_by_date[i-1]
-            # If the month and year for this entry do not match the
-            # month and year for the current group of entries, start a new one.
-            if entry_year_and_month_str != current_year_and_month_str:
-                entries_table_of_contents.append(current_month_group)
-                current_month_group = []
-                current_year_and_month_str = entry_year_and_month_str
-        else:
-            # If we're on the first entry, skip the month/year comparison
-            current_year_and_month_str = entry_year_and_month_str
-        current_month_group.append(toc)
-    
-        next_entry = None
-        if i < len(entries_by_date) - 1:
-            next_entry = entries_by_date[i+1]
-
-        page = create_single_entry_page(
-                    journal_short_name=journal_short_name,
-                    entry=entry,
-                    comments=comments_grouped_by_entry[entry['itemid']],
-                    image_urls_to_filenames=image_urls_to_filenames,
-                    icons_by_keyword=icons_by_keyword,
-                    moods_by_id=moods_by_id,
-                    previous_entry=previous_entry,
-                    next_entry=next_entry
-                )
-        write_html("%s/entries/entry-%s.html" % (journal_short_name, entry['itemid']), page)
+    for folder in ["entries", "history"]:
+        try:
+            os.mkdir("%s/%s" % (journal_short_name, folder))
+        except OSError as e:
+            if e.errno == 17:   # Folder already exists
+                pass
 
-        entry_body = entry['event']
-        (entry_body, uncached) = resolve_cached_image_references(entry_body, image_urls_to_filenames)
-        if len(uncached) > 0:
-            entries_with_uncached_images.append((toc, uncached))
+    history_page_table_of_contents = []
 
+    entry_pages_rendered = 0
+    history_pages_rendered = 0
+    # Entry IDs for the pool, with the hash for their pages, filled in when the pool says what they were.
+    entry_hashes_for_pool = {}
+    history_pages_for_pool = []
+
+    batch_size = max(20, batch_size - (batch_size % 20))
+    for batch_start in range(0, entry_count, batch_size):
+        batch_markers = entry_markers[batch_start:batch_start + batch_size]
+
+        # Entries whose pages need generating, with the hash for their pages and their neighbors
+        stale_entries = []
+        # History pages that need generating, with the markers of their entries
+        stale_history_pages = []
+        container_hashes = {}
+
+        for i in range(0, len(batch_markers)):
+            n = batch_start + i
+            (itemid, eventtime_unix, revision, comments_count, comments_revision) = batch_markers[i]
+
+            images = []
+            uncached = []
+            for url in image_urls_by_entry.get(itemid, []):
+                images.append((url, image_urls_to_filenames.get(url)))
+                if not (url in image_urls_to_filenames):
+                    uncached.append(url)
+            if len(uncached) > 0:
+                entries_with_uncached_images.append((itemid, revision, uncached))
+
+            # Everything that goes into render_one_entry_container, which is shared with the history pages.
+            container_hashes[itemid] = hash_page_inputs([icons_and_moods_hash, itemid, revision, comments_count, images])
+
+            previous_itemid = entry_markers[n - 1][0] if n > 0 else None
+            next_itemid = entry_markers[n + 1][0] if n < entry_count - 1 else None
+            input_hash = hash_page_inputs([
+                container_hashes[itemid],
+                comments_revision,
+                previous_itemid,
+                next_itemid,
+                comments_per_page,
+                thread_depth
+            ])
+            if entry_pages_are_current(journal_short_name, itemid, pages_by_entry.get(itemid, []), input_hash, build_manifest):
+                for filename in pages_by_entry[itemid]:
+                    new_page_hashes[filename] = input_hash
+            else:
+                stale_entries.append((itemid, input_hash, previous_itemid, next_itemid))
+
+            if (len(history_page_table_of_contents) * 20 + 20 > n + 1) and (n < entry_count - 1):
+                continue
+
+            # The history page is full, or this is the last entry.
+            page_number = len(history_page_table_of_contents) + 1
+            group = entry_markers[(page_number - 1) * 20:n + 1]
+            previous_count = 0
+            if page_number > 1:
+                previous_count = 20
+            next_count = min(20, entry_count - n - 1)
+
+            history_toc = {
+                'from': datetime.utcfromtimestamp(group[0][1]),
+                'to': datetime.utcfromtimestamp(group[-1][1]),
+                'filename': "history/page-%s.html" % page_number
+            }
+            history_page_table_of_contents.append(history_toc)
+
+            input_hash = hash_page_inputs([page_number, previous_count, next_count,
+                                           [container_hashes[marker[0]] for marker in group]])
+            new_page_hashes[history_toc['filename']] = input_hash
+            if not page_is_current(journal_short_name, history_toc['filename'], input_hash, build_manifest):
+                stale_history_pages.append((page_number, group, previous_count, next_count))
+
+        entry_pages_rendered += len(stale_entries)
+        history_pages_rendered += len(stale_history_pages)
+
+        if pool is not None:
+            for (itemid, input_hash, previous_itemid, next_itemid) in stale_entries:
+                entry_hashes_for_pool[itemid] = input_hash
+            for (page_number, group, previous_count, next_count) in stale_history_pages:
+                history_pages_for_pool.append(
+                    (page_number, [marker[0] for marker in group], previous_count, next_count))
+            continue
+
+        # Read just the entries that are needed, all at once.
+        itemids_needed = set([itemid for (itemid, input_hash, previous_itemid, next_itemid) in stale_entries])
+        for (page_number, group, previous_count, next_count) in stale_history_pages:
+            itemids_needed.update([marker[0] for marker in group])
+        entries_by_id = get_events_by_id(cur, False, itemids_needed)
+
+        for (itemid, input_hash, previous_itemid, next_itemid) in stale_entries:
+            entry = entries_by_id[itemid]
+            comments = get_comments_for_entry(cur, False, itemid)
+            pages = plan_entry_pages(entry, comments, comments_per_page, thread_depth)
+            for page in pages:
+                new_page_hashes[page['filename']] = input_hash
+            write_entry_pages(
+                        journal_short_name=journal_short_name,
+                        entry=entry,
+                        comments=comments,
+                        pages=pages,
+                        image_urls_to_filenames=image_urls_to_filenames,
+                        icons_by_keyword=icons_by_keyword,
+                        moods_by_id=moods_by_id,
+                        previous_itemid=previous_itemid,
+                        next_itemid=next_itemid
+                    )
+            comments = None
+
+        for (page_number, group, previous_count, next_count) in stale_history_pages:
+            comment_counts_by_entry = {}
+            for marker in group:
+                comment_counts_by_entry[marker[0]] = marker[3]
+            page = create_history_page(
+                        journal_short_name=journal_short_name,
+                        entries=[entries_by_id[marker[0]] for marker in group],
+                        comment_counts_by_entry=comment_counts_by_entry,
+                        image_urls_to_filenames=image_urls_to_filenames,
+                        icons_by_keyword=icons_by_keyword,
+                        moods_by_id=moods_by_id,
+                        page_number=page_number,
+                        previous_page_entry_count=previous_count,
+                        next_page_entry_count=next_count
+                    )
+            write_html("%s/history/page-%s.html" % (journal_short_name, page_number), page)
+
+        # Nothing else needs these entries, so let go of everything rendered for them.
+        for itemid in entries_by_id.keys():
+            forget_rendered_entry(itemid)
+        entries_by_id = None
+        if cache_fragments:
+            update_entry_fragments(cur, False, take_rendered_entry_fragments())
+
+    if pool is not None:
+        # The workers read the database while their results come back, so the fragments
+        # they rendered are saved a batch at a time, each committed straight away.  One long
+        # write would end up locking them out.
+        conn.commit()
+        rendered_batch = []
+
+        def save_rendered(rendered, last=False):
+            if cache_fragments:
+                rendered_batch.extend(rendered)
+                if (len(rendered_batch) >= worker_fragment_batch_size) or (last and len(rendered_batch) > 0):
+                    update_entry_fragments(cur, False, rendered_batch)
+                    conn.commit()
+                    rendered_batch.clear()
+
+        for (itemid, filenames, rendered) in pool.imap_unordered(render_entry_page_in_worker, list(entry_hashes_for_pool.keys()), chunksize=8):
+            for filename in filenames:
+                new_page_hashes[filename] = entry_hashes_for_pool[itemid]
+            save_rendered(rendered)
+        for rendered in pool.starmap(render_history_page_in_worker, history_pages_for_pool, chunksize=4):
+            save_rendered(rendered)
+        save_rendered([], last=True)
+        pool.close()
+        pool.join()
+
+    print("%s entry pages were changed." % (entry_pages_rendered))
+    print("%s history pages were changed." % (history_pages_rendered))
 
-    entries_table_of_contents.append(current_month_group)
+    if verbose:
+        print("Rendering uncached image report page (%d entries)..." % (len(entries_with_uncached_images)))
 
     #
-    # History pages, with 20 entries each.
+    # Uncached images report page
     #
 
-    # Create groups of 20 entries for the history pages
-    groups_of_twenty = []
-    current_group = []
-    for entry in entries_by_date:
-        current_group.append(entry)
-        if len(current_group) > 19:
-            groups_of_twenty.append(current_group)
-            current_group = []
-    if len(current_group) > 0:
-        groups_of_twenty.append(current_group)
-
-    print("Rendering %s history pages..." % (len(groups_of_twenty)))
-
-    try:
-        os.mkdir("%s/history" % (journal_short_name))
-    except OSError as e:
-        if e.errno == 17:   # Folder already exists
-            pass
-
-    history_page_table_of_contents = []
-    for i in range(0, len(groups_of_twenty)):
-        previous_count = 0
-        if i > 0:
-            previous_count = len(groups_of_twenty[i-1])
-        next_count = 0
-        if i < len(groups_of_twenty) - 1:
-            next_count = len(groups_of_twenty[i+1])
-
-        current_group = groups_of_twenty[i]
-        page = create_history_page(
-                    journal_short_name=journal_short_name,
-                    entries=current_group,
-                    comments_grouped_by_entry=comments_grouped_by_entry,
-                    image_urls_to_filenames=image_urls_to_filenames,
-                    icons_by_keyword=icons_by_keyword,
-                    moods_by_id=moods_by_id,
-                    page_number=i+1,
-                    previous_page_entry_count=previous_count,
-                    next_page_entry_count=next_count
-                )
-        write_html("%s/history/page-%s.html" % (journal_short_name, i+1), page)
-
-        # Used for building a table of contents later
-        toc = {
-            'from': datetime.utcfromtimestamp(current_group[0]['eventtime_unix']),
-            'to': datetime.utcfromtimestamp(current_group[-1]['eventtime_unix']),
-            'filename': "history/page-%s.html" % (i+1)
-        }
-        history_page_table_of_contents.append(toc)
+    input_hash = hash_page_inputs(entries_with_uncached_images)
+    new_page_hashes['uncached_images_report.html'] = input_hash
+    if not page_is_current(journal_short_name, 'uncached_images_report.html', input_hash, build_manifest):
+        uncached_report = []
+        for start in range(0, len(entries_with_uncached_images), batch_size):
+            batch = entries_with_uncached_images[start:start + batch_size]
+            entries_by_id = get_events_by_id(cur, False, [itemid for (itemid, revision, uncached) in batch])
+            for (itemid, revision, uncached) in batch:
+                uncached_report.append((toc_entry(entries_by_id[itemid]), uncached))
+        entries_by_id = None
+        write_html_page(
+                "%s/uncached_images_report.html" % journal_short_name,
+                journal_short_name,
+                "%s uncached images" % journal_short_name,
+                render_uncached_images_report(uncached_report),
+                False
+            )
 
     #
-    # Organizing by tag
+    # Pages for each year, month, and tag
     #
 
-    entries_by_tag = {}
-    tags_encountered = []
-    for entry in entries_by_date:
-        taglist = entry['props_taglist']
-        if taglist is not None:
-            # Used for building a table of contents later
-            toc = {
-                'date': datetime.utcfromtimestamp(entry['eventtime_unix']),
-                'subject': entry['subject'],
-                'filename': ("entries/entry-%s.html" % entry['itemid'])
-            }
-            tags_split = taglist.split(', ')
-            for tag in tags_split:
-                if not (tag in entries_by_tag):
-                    tags_encountered.append(tag)
-                    entries_by_tag[tag] = []
-                entries_by_tag[tag].append(toc)
+    for folder in ["archive", "tags"]:
+        try:
+            os.mkdir("%s/%s" % (journal_short_name, folder))
+        except OSError as e:
+            if e.errno == 17:   # Folder already exists
+                pass
 
-    tags_encountered = sorted(tags_encountered)
+    months_by_year = []
+    for (key, count) in month_entry_counts:
+        if (len(months_by_year) == 0) or (months_by_year[-1][0] != key[0]):
+            months_by_year.append((key[0], []))
+        months_by_year[-1][1].append((key, count))
+
+    tag_entry_counts = get_tag_entry_counts(cur, verbose)
+    tags_encountered = sorted(tag_entry_counts.keys())
+
+    print("Rendering %s year pages, %s month pages, and %s tag pages..." % (len(months_by_year), len(month_entry_counts), len(tags_encountered)))
+
+    index_pages_rendered = 0
+    for i in range(0, len(months_by_year)):
+        (year, months) = months_by_year[i]
+        previous_year = months_by_year[i-1][0] if i > 0 else None
+        next_year = months_by_year[i+1][0] if i < len(months_by_year) - 1 else None
+        filename = year_page_filename(year)
+        input_hash = hash_page_inputs([year, months, previous_year, next_year])
+        new_page_hashes[filename] = input_hash
+        if not page_is_current(journal_short_name, filename, input_hash, build_manifest):
+            index_pages_rendered += 1
+            write_html_page(
+                    "%s/%s" % (journal_short_name, filename),
+                    journal_short_name,
+                    "%s entries from %s" % (journal_short_name, year),
+                    render_year_page(year, months, previous_year, next_year)
+                )
 
-    print("Rendering uncached image report page (%d entries)..." % (len(entries_with_uncached_images)))
+    # The entries in each month are just the next ones along, in date order.  Only the pages
+    # for months where one of them changed read the entries' subjects.
+    month_start = 0
+    for i in range(0, len(month_entry_counts)):
+        ((year, month), count) = month_entry_counts[i]
+        previous_month = month_entry_counts[i-1][0] if i > 0 else None
+        next_month = month_entry_counts[i+1][0] if i < len(month_entry_counts) - 1 else None
+        month_markers = entry_markers[month_start:month_start + count]
+        month_start += count
+        filename = month_page_filename(year, month)
+        input_hash = hash_page_inputs([year, month, [(marker[0], marker[2]) for marker in month_markers], previous_month, next_month])
+        new_page_hashes[filename] = input_hash
+        if not page_is_current(journal_short_name, filename, input_hash, build_manifest):
+            index_pages_rendered += 1
+            (start_unix, end_unix) = month_range_unix(year, month)
+            tocs = get_entry_summaries_in_range(cur, False, start_unix, end_unix)
+            write_html_page(
+                    "%s/%s" % (journal_short_name, filename),
+                    journal_short_name,
+                    "%s entries from %s" % (journal_short_name, month_name(year, month)),
+                    render_month_page(year, month, tocs, previous_month, next_month)
+                )
 
-    #
-    # Uncached images report page
-    #
+    entry_ids_by_tag = get_entry_ids_by_tag(cur, verbose)
+    for tag in tags_encountered:
+        filename = tag_page_filename(tag)
+        input_hash = hash_page_inputs([tag, [(itemid, revision_by_entry.get(itemid)) for itemid in entry_ids_by_tag.get(tag, [])]])
+        new_page_hashes[filename] = input_hash
+        if not page_is_current(journal_short_name, filename, input_hash, build_manifest):
+            index_pages_rendered += 1
+            tocs = get_entry_summaries_with_tag(cur, False, tag)
+            write_html_page(
+                    "%s/%s" % (journal_short_name, filename),
+                    journal_short_name,
+                    "%s entries tagged %s" % (journal_short_name, tag),
+                    render_tag_page(tag, tocs)
+                )
 
-    page = create_uncached_images_report_page(
-            journal_short_name=journal_short_name,
-            entries=entries_with_uncached_images,
-        )
-    write_html("%s/uncached_images_report.html" % journal_short_name, page)
+    print("%s year, month, and tag pages were changed." % (index_pages_rendered))
 
     print("Rendering table of contents page...")
 
@@ -997,15 +2251,27 @@ def ljdumptohtml(username, journal_short_name, ljuniq=None, verbose=True, cache_
     # Table of contents page
     #
 
-    page = create_table_of_contents_page(
-            journal_short_name=journal_short_name,
-            entry_count=len(entries_by_date),
-            entries_table_of_contents=entries_table_of_contents,
-            history_page_table_of_contents=history_page_table_of_contents,
-            tags_encountered=tags_encountered,
-            entries_by_tag=entries_by_tag,
-        )
-    write_html("%s/index.html" % journal_short_name, page)
+    input_hash = hash_page_inputs([
+        entry_count,
+        months_by_year,
+        history_page_table_of_contents,
+        [(tag, tag_entry_counts[tag]) for tag in tags_encountered]
+    ])
+    new_page_hashes['index.html'] = input_hash
+    if not page_is_current(journal_short_name, 'index.html', input_hash, build_manifest):
+        write_html_page(
+                "%s/index.html" % journal_short_name,
+                journal_short_name,
+                "%s archive" % journal_short_name,
+                render_table_of_contents(
+                    entry_count=entry_count,
+                    month_entry_counts=month_entry_counts,
+                    history_page_table_of_contents=history_page_table_of_contents,
+                    tags_encountered=tags_encountered,
+                    tag_entry_counts=tag_entry_counts,
+                ),
+                False
+            )
 
     print("Copying support files...")
 
@@ -1018,8 +2284,25 @@ def ljdumptohtml(username, journal_short_name, ljuniq=None, verbose=True, cache_
     dest = "%s/user.png" % (journal_short_name)
     shutil.copyfile(source, dest)
 
+    # Pages from earlier runs that weren't generated this time are left over, like the extra
+    # comment pages of an entry after --comments_per_page goes up, so they are deleted.
+    left_over_pages = [filename for filename in build_manifest.keys() if not (filename in new_page_hashes)]
+    if len(left_over_pages) > 0:
+        print("Deleting %s pages left over from earlier runs..." % len(left_over_pages))
+    for filename in left_over_pages:
+        try:
+            os.remove("%s/%s" % (journal_short_name, filename))
+        except OSError:
+            pass
+    remove_pages_from_build_manifest(cur, verbose, left_over_pages)
+
+    entry_fragment_cache['cur'] = None
+    update_build_manifest(cur, verbose, new_page_hashes)
+
     finish_with_database(conn, cur)
 
+    report_peak_memory(memory_budget)
+
     print("Done!")
 
 
@@ -1031,6 +2314,40 @@ if __name__ == "__main__":
                       help="build a cache of images referenced in entries")
     args.add_argument("--dont_retry_images", "-d", action='store_false', dest='retry_images',
                       help="don't retry images that failed to cache once already")
+    args.add_argument('--jobs', '-j', type=int, default=1, dest='jobs',
+                      help='Number of processes to use when generating pages.  Default is 1.')
+    args.add_argument("--cache_fragments", "-f", action='store_true', dest='cache_fragments',
+                      help="keep rendered entries in the database so later runs can reuse them")
+    args.add_argument('--memory_budget', '-m', type=int, default=None, dest='memory_budget',
+                      help='Approximate number of megabytes of memory to use when generating pages.')
+    args.add_argument('--comments_per_page', type=int, default=None, dest='comments_per_page',
+                      help='Split the comments on an entry into pages of about this many.  Default is no limit.')
+    args.add_argument('--thread_depth', type=int, default=None, dest='thread_depth',
+                      help='Move replies deeper than this onto separate thread pages.  Default is no limit.')
+    args.add_argument('--image_jobs', type=int, default=8, dest='image_jobs',
+                      help='Number of images to download at once.  Default is 8.')
+    args.add_argument('--image_jobs_per_host', type=int, default=2, dest='image_jobs_per_host',
+                      help='Number of images to download at once from any one server.  Default is 2.')
+    args.add_argument('--image_time_budget', type=float, default=10, dest='image_time_budget',
+                      help='Minutes to spend caching images in one run.  Default is 10.')
+    args.add_argument('--image_byte_budget', type=float, default=None, dest='image_byte_budget',
+                      help='Megabytes of images to download in one run.  Default is no limit.')
+    args.add_argument('--image_order', choices=['oldest', 'newest', 'referenced'], default='oldest', dest='image_order',
+                      help='Which images to cache first: from the oldest entries, the newest, or the ones used in the most entries.  Default is oldest.')
+    args.add_argument('--image_max_size', type=float, default=20, dest='image_max_size',
+                      help='Largest image to cache, in megabytes.  Default is 20.')
+    args.add_argument("--revalidate_images", action='store_true', dest='revalidate_images',
+                      help="check cached images against the originals, and fetch any that have changed")
+    args.add_argument('--image_disk_budget', type=float, default=None, dest='image_disk_budget',
+                      help='Most megabytes of disk for the image cache to use.  Default is no limit.')
+    args.add_argument('--image_eviction', choices=['largest', 'least_referenced'], default='least_referenced', dest='image_eviction',
+                      help='Which images to delete first when the image cache is over its disk budget.  Default is least_referenced.')
+    args.add_argument("--reconcile_images", action='store_true', dest='reconcile_images',
+                      help="compare the image cache folder with the database, and fix any differences")
+    args.add_argument('--download_rate_limit', type=float, default=None, dest='download_rate_limit',
+                      help='Most kilobytes per second to download images at, all together.  Default is no limit.')
+    args.add_argument('--download_rate_hours', type=parse_download_hours, default=None, dest='download_rate_hours',
+                      help='Only limit the download rate between these times of day, like 08:00-23:30.  Default is all day.')
     args = args.parse_args()
     if os.access("ljdump.config", os.F_OK):
         config = xml.dom.minidom.parse("ljdump.config")
@@ -1043,7 +2360,7 @@ if __name__ == "__main__":
         # If a user is hosting images on Dreamwidth and using a config file, they will
         # put their cookie in the config file.  Asking for it every time would annoy users
         # who are not hosting images on Dreamwidth.
-        if args.cache_images:
+        if args.cache_images or args.revalidate_images:
             ljuniq_els = config.documentElement.getElementsByTagName("ljuniq")
             if len(ljuniq_els) > 0:
                 ljuniq = ljuniq_els[0].childNodes[0].data
@@ -1064,7 +2381,7 @@ if __name__ == "__main__":
         else:
             journals = [username]
         ljuniq = None
-        if args.cache_images:
+        if args.cache_images or args.revalidate_images:
             ljuniq = getpass("ljuniq cookie (for Dreamwidth hosted image downloads, leave blank otherwise): ")
         print
 
@@ -1075,5 +2392,22 @@ if __name__ == "__main__":
             journal_short_name=journal,
             verbose=args.verbose,
             cache_images=args.cache_images,
-            retry_images=args.retry_images
+            retry_images=args.retry_images,
+            jobs=args.jobs,
+            cache_fragments=args.cache_fragments,
+            memory_budget=args.memory_budget,
+            comments_per_page=args.comments_per_page,
+            thread_depth=args.thread_depth,
+            image_jobs=args.image_jobs,
+            image_jobs_per_host=args.image_jobs_per_host,
+            image_time_budget=args.image_time_budget,
+            image_byte_budget=args.image_byte_budget,
+            image_order=args.image_order,
+            image_max_size=args.image_max_size,
+            revalidate_images=args.revalidate_images,
+            image_disk_budget=args.image_disk_budget,
+            image_eviction=args.image_eviction,
+            reconcile_images=args.reconcile_images,
+            download_rate_limit=args.download_rate_limit,
+            download_rate_hours=args.download_rate_hours
         )
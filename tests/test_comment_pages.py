@@ -0,0 +1,93 @@
+# Checks how the comments on an entry are split across pages, and how deep threads are
+# moved out onto pages of their own.
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ljdumptohtml import *
+
+
+# Builds comments in thread order from (id, depth) pairs.
+def make_comments(ids_and_depths):
+    return [{'id': comment_id, 'depth': depth, 'thread_path': 'x' * depth}
+            for (comment_id, depth) in ids_and_depths]
+
+
+def ids(comments):
+    return [comment['id'] for comment in comments]
+
+
+class CommentPagesTest(unittest.TestCase):
+
+    entry = {'itemid': 7}
+
+    def test_one_page_by_default(self):
+        comments = make_comments([(1, 1), (2, 2), (3, 1)])
+        pages = plan_entry_pages(self.entry, comments)
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(pages[0]['filename'], "entries/entry-7.html")
+        self.assertEqual(ids(pages[0]['comments']), [1, 2, 3])
+
+    def test_orphans_left_out(self):
+        comments = make_comments([(1, 1), (2, 2)])
+        comments[1]['thread_path'] = None
+        self.assertEqual(ids(plan_entry_pages(self.entry, comments)[0]['comments']), [1])
+
+    def test_split_between_threads(self):
+        comments = make_comments([(1, 1), (2, 2), (3, 1), (4, 1), (5, 2), (6, 3), (7, 1)])
+        pages = split_comments_into_pages(comments, 3)
+        self.assertEqual([ids(page) for page in pages], [[1, 2, 3], [4, 5, 6], [7]])
+
+    def test_big_thread_gets_its_own_page(self):
+        comments = make_comments([(1, 1), (2, 1), (3, 2), (4, 3), (5, 4), (6, 1)])
+        pages = split_comments_into_pages(comments, 2)
+        self.assertEqual([ids(page) for page in pages], [[1], [2, 3, 4, 5], [6]])
+
+    def test_page_filenames(self):
+        comments = make_comments([(1, 1), (2, 1), (3, 1)])
+        pages = plan_entry_pages(self.entry, comments, comments_per_page=1)
+        self.assertEqual([page['filename'] for page in pages],
+                         ["entries/entry-7.html", "entries/entry-7-p2.html", "entries/entry-7-p3.html"])
+        self.assertEqual([page['comment_page_count'] for page in pages], [3, 3, 3])
+        for filename in [page['filename'] for page in pages]:
+            self.assertTrue(entry_page_filename_pattern.match(filename))
+
+    def test_deep_threads(self):
+        comments = make_comments([(1, 1), (2, 2), (3, 3), (4, 4), (5, 3), (6, 1), (7, 2)])
+        (shown, subthreads) = collapse_deep_threads(comments, 2)
+        self.assertEqual(ids(shown), [1, 2, 6, 7])
+        self.assertEqual([(root['id'], [(c['id'], c['depth']) for c in thread]) for (root, thread) in subthreads],
+                         [(2, [(2, 1), (3, 2), (4, 3), (5, 2)])])
+
+    def test_thread_pages(self):
+        # Thread pages are collapsed at the same depth, so a long chain goes on page after page.
+        comments = make_comments([(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)])
+        pages = plan_entry_pages(self.entry, comments, thread_depth=2)
+        self.assertEqual([page['filename'] for page in pages],
+                         ["entries/entry-7.html", "entries/entry-7-thread-2.html",
+                          "entries/entry-7-thread-3.html", "entries/entry-7-thread-4.html"])
+        self.assertEqual(pages[0]['thread_links'], {2: ("entry-7-thread-2.html", 3)})
+        self.assertEqual(pages[1]['thread_links'], {3: ("entry-7-thread-3.html", 2)})
+        self.assertEqual(pages[2]['parent_filename'], "entries/entry-7-thread-2.html")
+        self.assertEqual([(c['id'], c['depth']) for c in pages[2]['comments']], [(3, 1), (4, 2)])
+        self.assertEqual([(c['id'], c['depth']) for c in pages[3]['comments']], [(4, 1), (5, 2)])
+
+    def test_thread_depth_of_one(self):
+        # A thread page starts at depth 1, so collapsing there would never finish.
+        comments = make_comments([(1, 1), (2, 2), (3, 3)])
+        pages = plan_entry_pages(self.entry, comments, thread_depth=1)
+        self.assertEqual(ids(pages[0]['comments']), [1, 2])
+
+    def test_comments_section_closes_containers(self):
+        comments = make_comments([(1, 1), (2, 2), (3, 3), (4, 1)])
+        for comment in comments:
+            comment.update({'date_unix': None, 'subject': None, 'user': 'someone', 'body': 'Hi'})
+        section = render_comments_section(self.entry, comments)
+        self.assertEqual(section.count('<div'), section.count('</div>'))
+        self.assertNotIn("Thread from here", section)
+        section = render_comments_section(self.entry, comments, thread_links={2: ("entry-7-thread-2.html", 1)})
+        self.assertIn('<a href="entry-7-thread-2.html">Thread from here</a> (1 reply)', section)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# Checks that comments come back from the database in the order they are displayed,
+# however they arrived, and that older databases get their thread paths rebuilt.
+
+import os, sys, sqlite3, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ljdumpsqlite import *
+
+
+def make_comment(comment_id, parent_id=None, entry_id=1):
+    return {
+        'id': comment_id,
+        'entryid': entry_id,
+        'date': '',
+        'parentid': '' if parent_id is None else str(parent_id),
+        'posterid': 0,
+        'user': 'someone',
+        'subject': None,
+        'body': 'Comment %s' % comment_id,
+        'state': 'A',
+    }
+
+
+class CommentThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        create_tables_if_missing(self.conn, False)
+        self.cur = self.conn.cursor()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def add(self, comment_id, parent_id=None):
+        insert_or_update_comment(self.cur, False, make_comment(comment_id, parent_id))
+
+    def displayed(self):
+        return [(c['id'], c['depth']) for c in get_comments_for_entry(self.cur, False, 1)
+                if c['thread_path'] is not None]
+
+    def test_display_order(self):
+        self.add(10)
+        self.add(20)
+        self.add(11, 10)
+        self.add(12, 11)
+        self.add(13, 10)
+        self.add(21, 20)
+        self.assertEqual(self.displayed(), [(10, 1), (11, 2), (12, 3), (13, 2), (20, 1), (21, 2)])
+
+    def test_sibling_order_follows_ids(self):
+        # 9 and 10 would sort the other way around as plain strings.
+        self.add(10)
+        self.add(9)
+        self.add(100000, 9)
+        self.add(99999, 9)
+        self.assertEqual(self.displayed(), [(9, 1), (99999, 2), (100000, 2), (10, 1)])
+
+    def test_reply_before_parent(self):
+        self.add(12, 11)
+        self.add(13, 12)
+        self.assertEqual(self.displayed(), [])
+        self.add(10)
+        self.add(11, 10)
+        self.assertEqual(self.displayed(), [(10, 1), (11, 2), (12, 3), (13, 4)])
+
+    def test_moved_reply_takes_its_thread_along(self):
+        self.add(10)
+        self.add(20)
+        self.add(11, 10)
+        self.add(12, 11)
+        self.add(11, 20)
+        self.assertEqual(self.displayed(), [(10, 1), (20, 1), (11, 2), (12, 3)])
+
+    def test_loop(self):
+        self.add(10)
+        self.add(11, 10)
+        self.add(12, 11)
+        # Now 10 replies to its own reply, so the whole thread has nowhere to go.
+        self.add(10, 12)
+        self.assertEqual(self.displayed(), [])
+        self.add(10)
+        self.assertEqual(self.displayed(), [(10, 1), (11, 2), (12, 3)])
+
+    def test_deep_thread(self):
+        chain_length = comment_thread_max_depth + 50
+        for i in range(1, chain_length + 1):
+            self.add(i, i - 1 if i > 1 else None)
+        # A branch off the deepest comment that still nests normally.
+        self.add(chain_length + 1, comment_thread_max_depth - 1)
+        self.add(chain_length + 2, chain_length + 1)
+
+        comments = get_comments_for_entry(self.cur, False, 1)
+        expected = [(i, i) for i in range(1, comment_thread_max_depth + 1)]
+        expected.extend([(i, comment_thread_max_depth + 1) for i in range(comment_thread_max_depth + 1, chain_length + 1)])
+        expected.append((chain_length + 1, comment_thread_max_depth))
+        expected.append((chain_length + 2, comment_thread_max_depth + 1))
+        self.assertEqual([(c['id'], c['depth']) for c in comments], expected)
+
+        longest = max(len(c['thread_path']) for c in comments)
+        self.assertEqual(longest, (comment_thread_max_depth + 1) * comment_thread_path_segment_length)
+
+    def test_deep_thread_reattached(self):
+        # The top of a long chain arrives last, and the whole chain is placed in one go.
+        chain_length = comment_thread_max_depth + 10
+        for i in range(2, chain_length + 1):
+            self.add(i, i - 1)
+        self.add(1)
+        depths = [depth for (c_id, depth) in self.displayed()]
+        self.assertEqual(depths, list(range(1, comment_thread_max_depth + 1)) + [comment_thread_max_depth + 1] * 10)
+
+    def test_migration(self):
+        self.add(10)
+        self.add(11, 10)
+        self.add(12, 11)
+        self.add(9)
+        # Paths the way earlier versions wrote them.
+        self.conn.execute("UPDATE comments SET thread_path = '0000000010/0000000011' WHERE id = 11")
+        self.conn.execute("PRAGMA user_version = 11")
+        self.conn.commit()
+        create_tables_if_missing(self.conn, False)
+        self.assertEqual(self.conn.execute("PRAGMA user_version").fetchone()[0], schema_migrations[-1][0])
+        self.assertEqual(self.displayed(), [(9, 1), (10, 1), (11, 2), (12, 3)])
+        for c in get_comments_for_entry(self.cur, False, 1):
+            self.assertEqual(len(c['thread_path']), c['depth'] * comment_thread_path_segment_length)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+# Checks how downloaded images are kept in the images folder: copies of the same picture
+# share one file, the cache is kept inside its disk budget, and cached images are checked
+# against the originals, which are served by a small web server on this machine.
+
+import io, os, sys, shutil, sqlite3, hashlib, tempfile, threading, unittest
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ljdumpsqlite import *
+from ljdumptohtml import *
+
+
+def make_event(itemid, eventtime, image_urls):
+    return {
+        'itemid': itemid,
+        'anum': 1,
+        'eventtime': eventtime,
+        'logtime': eventtime,
+        'subject': None,
+        'event': ''.join(['<img src="%s">' % url for url in image_urls]),
+        'url': 'https://example.dreamwidth.org/%s.html' % itemid,
+        'props': {},
+    }
+
+
+# Serves the pictures in its server's images dictionary, of paths to (etag, content).
+class ImageRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if not (self.path in self.server.images):
+            self.send_error(404)
+            return
+        (etag, content) = self.server.images[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal = os.path.join(self.folder, "j")
+        os.makedirs(os.path.join(self.journal, "images", "2004-11"))
+        self.conn = sqlite3.connect(":memory:")
+        create_tables_if_missing(self.conn, False)
+        self.cur = self.conn.cursor()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.folder)
+
+    def start_server(self, images):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), ImageRequestHandler)
+        server.images = images
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%s' % server.server_address[1]
+
+    def use_images(self, urls):
+        self.urls = urls
+        for (itemid, url) in enumerate(urls, 1):
+            insert_or_update_event(self.cur, False, make_event(itemid, '2004-11-%02d 10:00:00' % itemid, [url]))
+
+    # Runs one image caching pass, and returns what it printed.
+    def cache_images(self, image_disk_budget=None):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            cache_entry_images(self.cur, False, self.journal, None, True, 2, 2, None, None, image_disk_budget=image_disk_budget)
+        return output.getvalue()
+
+    def revalidate_images(self):
+        self.cur.execute("UPDATE cached_images SET date_last_validated = 0")
+        output = io.StringIO()
+        with redirect_stdout(output):
+            revalidate_cached_images(self.cur, False, self.journal, None, 2, 2, None)
+        return output.getvalue()
+
+    def image_files(self):
+        return sorted(os.listdir(os.path.join(self.journal, "images", "2004-11")))
+
+    def image_id(self, url):
+        return get_or_create_cached_image_record(self.cur, False, url)['id']
+
+    def cached_filenames(self):
+        self.cur.execute("SELECT url, filename FROM cached_images WHERE cached = 1 ORDER BY url")
+        return self.cur.fetchall()
+
+    # Writes a file the way download_entry_image does, and returns what it would.
+    def download(self, name, content):
+        filename = "2004-11/%s.png" % name
+        with open(os.path.join(self.journal, "images", filename), "wb") as f:
+            f.write(content)
+        return {
+            'filename': filename,
+            'content_hash': hashlib.sha1(content).hexdigest(),
+            'size': len(content),
+            'etag': None,
+            'last_modified': None,
+            'width': None,
+            'height': None
+        }
+
+    def test_copies_share_a_file(self):
+        self.use_images(['https://example.com/%s.png' % name for name in ['a', 'b', 'c']])
+        entry_date = datetime(2004, 11, 1)
+        saved = record_downloaded_image(self.cur, False, self.journal, self.image_id(self.urls[0]), self.download('a', b'same picture'), entry_date)
+        self.assertEqual(saved, 0)
+        saved = record_downloaded_image(self.cur, False, self.journal, self.image_id(self.urls[1]), self.download('b', b'same picture'), entry_date)
+        self.assertEqual(saved, len(b'same picture'))
+        record_downloaded_image(self.cur, False, self.journal, self.image_id(self.urls[2]), self.download('c', b'another picture'), entry_date)
+
+        self.assertEqual(self.cached_filenames(), [
+            (self.urls[0], '2004-11/a.png'),
+            (self.urls[1], '2004-11/a.png'),
+            (self.urls[2], '2004-11/c.png')])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.journal, "images", "2004-11"))), ['a.png', 'c.png'])
+        self.assertEqual(get_cached_image_file_use_count(self.cur, False, '2004-11/a.png'), 2)
+
+    def test_same_file_downloaded_again(self):
+        # An image fetched again into the file it already has keeps that file.
+        self.use_images(['https://example.com/%s.png' % name for name in ['a', 'b', 'c']])
+        entry_date = datetime(2004, 11, 1)
+        image_id = self.image_id(self.urls[0])
+        record_downloaded_image(self.cur, False, self.journal, image_id, self.download('a', b'picture'), entry_date)
+        saved = record_downloaded_image(self.cur, False, self.journal, image_id, self.download('a', b'picture'), entry_date)
+        self.assertEqual(saved, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.journal, "images", "2004-11", "a.png")))
+
+    # Caches three files: a.png is the biggest, and c.png is used by the fewest entries.
+    def cache_files_for_eviction(self):
+        self.use_images(['https://example.com/%s.png' % name for name in ['a', 'b', 'c']])
+        insert_or_update_event(self.cur, False, make_event(4, '2004-11-04 10:00:00', self.urls[:2]))
+        entry_date = datetime(2004, 11, 1)
+        for (url, name, size) in zip(self.urls, ['a', 'b', 'c'], [3000, 1000, 2000]):
+            record_downloaded_image(self.cur, False, self.journal, self.image_id(url), self.download(name, name.encode() * size), entry_date)
+
+    def evict(self, image_eviction):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            evict_images_over_budget(self.cur, False, self.journal, 5000 / (1024 * 1024), image_eviction)
+        return output.getvalue()
+
+    def test_evict_largest(self):
+        self.cache_files_for_eviction()
+        self.assertIn("Evicted 1 image files", self.evict('largest'))
+        self.assertEqual(self.image_files(), ['b.png', 'c.png'])
+        self.assertEqual([url for (url, filename) in self.cached_filenames()], self.urls[1:])
+        self.assertEqual(get_image_cache_size(self.cur, False), 3000)
+
+    def test_evict_least_referenced(self):
+        self.cache_files_for_eviction()
+        self.evict('least_referenced')
+        self.assertEqual(self.image_files(), ['a.png', 'b.png'])
+        # Already inside the budget, so nothing more goes.
+        self.assertNotIn("Evicted", self.evict('least_referenced'))
+        self.assertEqual(self.image_files(), ['a.png', 'b.png'])
+
+    def test_revalidation(self):
+        images = {'/d.png': ('"v1"', b'first version')}
+        self.use_images([self.start_server(images) + '/d.png'])
+        self.cache_images()
+        self.assertEqual(len(self.cached_filenames()), 1)
+        (url, old_filename) = self.cached_filenames()[0]
+
+        # Nothing has changed, so the server says so and the file is kept.
+        self.assertIn("1 unchanged, 0 updated", self.revalidate_images())
+        self.assertEqual(self.cached_filenames(), [(url, old_filename)])
+
+        # A changed image gets a new file, and the old one is let go of.
+        images['/d.png'] = ('"v2"', b'second version')
+        self.assertIn("0 unchanged, 1 updated", self.revalidate_images())
+        (url, new_filename) = self.cached_filenames()[0]
+        self.assertNotEqual(new_filename, old_filename)
+        self.assertEqual(self.image_files(), [os.path.basename(new_filename)])
+        with open(os.path.join(self.journal, "images", new_filename), "rb") as f:
+            self.assertEqual(f.read(), b'second version')
+
+        # Gone from the server, but the cached copy stays.
+        del images['/d.png']
+        self.assertIn("1 could not be checked", self.revalidate_images())
+        self.assertEqual(self.cached_filenames(), [(url, new_filename)])
+
+    def test_disk_budget(self):
+        server = self.start_server({'/d.png': ('"v1"', b'x' * 1000), '/e.png': ('"v1"', b'y' * 1000)})
+        self.use_images([server + '/d.png', server + '/e.png'])
+        # Room for a bit more than one of them.
+        output = self.cache_images(image_disk_budget=1500 / (1024 * 1024))
+        self.assertEqual(len(self.cached_filenames()), 1)
+        self.assertIn("disk budget", output)
+        self.assertNotIn("image budget for this run", output)
+
+        output = self.cache_images(image_disk_budget=1500 / (1024 * 1024))
+        self.assertIn("Cached 0 images", output)
+        self.assertIn("disk budget", output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# Checks that the width and height of GIF, PNG, and JPEG images are read from the start
+# of their files, including JPEGs that are meant to be shown turned on their side.
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ljdumptohtml import image_dimensions, jpeg_dimensions, exif_orientation
+
+
+def jpeg_segment(marker, data):
+    return bytes([0xff, marker]) + (len(data) + 2).to_bytes(2, 'big') + data
+
+
+# A TIFF header and one directory entry holding the orientation, the way it sits in EXIF data.
+def exif_tiff(orientation, byte_order='big'):
+    header = (b'MM' if byte_order == 'big' else b'II') + (42).to_bytes(2, byte_order) + (8).to_bytes(4, byte_order)
+    directory = (1).to_bytes(2, byte_order)
+    directory += (0x0112).to_bytes(2, byte_order) + (3).to_bytes(2, byte_order) + (1).to_bytes(4, byte_order)
+    directory += orientation.to_bytes(2, byte_order) + b'\x00\x00'
+    return header + directory + (0).to_bytes(4, byte_order)
+
+
+# The start of a JPEG: an optional EXIF block, then a frame header for the given size.
+def make_jpeg(width, height, orientation=None, frame_marker=0xc0, byte_order='big'):
+    head = b'\xff\xd8'
+    head += jpeg_segment(0xe0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+    if orientation is not None:
+        head += jpeg_segment(0xe1, b'Exif\x00\x00' + exif_tiff(orientation, byte_order))
+    head += jpeg_segment(frame_marker, b'\x08' + height.to_bytes(2, 'big') + width.to_bytes(2, 'big') + b'\x03')
+    return head + jpeg_segment(0xda, b'\x00' * 10)
+
+
+class ImageDimensionsTest(unittest.TestCase):
+
+    def test_gif(self):
+        self.assertEqual(image_dimensions(b'GIF89a' + (320).to_bytes(2, 'little') + (200).to_bytes(2, 'little')), (320, 200))
+        self.assertEqual(image_dimensions(b'GIF87a\x10\x00\x08\x00\x00'), (16, 8))
+
+    def test_png(self):
+        head = b'\x89PNG\r\n\x1a\n' + (13).to_bytes(4, 'big') + b'IHDR' + (640).to_bytes(4, 'big') + (480).to_bytes(4, 'big')
+        self.assertEqual(image_dimensions(head), (640, 480))
+        self.assertIsNone(image_dimensions(head[:20]))
+
+    def test_jpeg(self):
+        self.assertEqual(image_dimensions(make_jpeg(1024, 768)), (1024, 768))
+        # Progressive JPEGs have a different frame marker.
+        self.assertEqual(jpeg_dimensions(make_jpeg(1024, 768, frame_marker=0xc2)), (1024, 768))
+
+    def test_jpeg_padding(self):
+        head = make_jpeg(10, 20)
+        self.assertEqual(jpeg_dimensions(head[:2] + b'\xff' + head[2:]), (10, 20))
+
+    def test_jpeg_without_frame_header(self):
+        head = b'\xff\xd8' + jpeg_segment(0xe0, b'JFIF\x00') + jpeg_segment(0xda, b'\x00' * 10)
+        self.assertIsNone(jpeg_dimensions(head))
+        # Cut off before the frame header
+        self.assertIsNone(image_dimensions(make_jpeg(10, 20, orientation=1)[:30]))
+
+    def test_jpeg_orientation(self):
+        self.assertEqual(image_dimensions(make_jpeg(400, 300, orientation=1)), (400, 300))
+        self.assertEqual(image_dimensions(make_jpeg(400, 300, orientation=3)), (400, 300))
+        for orientation in [5, 6, 7, 8]:
+            self.assertEqual(image_dimensions(make_jpeg(400, 300, orientation=orientation)), (300, 400))
+        self.assertEqual(image_dimensions(make_jpeg(400, 300, orientation=6, byte_order='little')), (300, 400))
+
+    def test_exif_orientation(self):
+        self.assertEqual(exif_orientation(exif_tiff(8)), 8)
+        self.assertEqual(exif_orientation(exif_tiff(6, 'little')), 6)
+        self.assertIsNone(exif_orientation(b'XX' + exif_tiff(6)[2:]))
+        # The directory runs past the end of the data.
+        self.assertIsNone(exif_orientation(exif_tiff(6)[:16]))
+
+    def test_unknown(self):
+        self.assertIsNone(image_dimensions(b''))
+        self.assertIsNone(image_dimensions(b'<html><body>Not found</body></html>'))
+        self.assertIsNone(image_dimensions(b'GIF89a\x00\x00\x08\x00'))
+
+
+if __name__ == '__main__':
+    unittest.main()
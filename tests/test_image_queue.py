@@ -0,0 +1,114 @@
+# Checks the queue of images waiting to be cached: when failed images come up again,
+# when they're given up on, and what a successful download clears.
+
+import os, sys, sqlite3, calendar, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ljdumpsqlite import *
+
+
+def make_event(itemid, eventtime, image_urls):
+    return {
+        'itemid': itemid,
+        'anum': 1,
+        'eventtime': eventtime,
+        'logtime': eventtime,
+        'subject': None,
+        'event': ''.join(['<img src="%s">' % url for url in image_urls]),
+        'url': 'https://example.dreamwidth.org/%s.html' % itemid,
+        'props': {},
+    }
+
+
+class ImageQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        create_tables_if_missing(self.conn, False)
+        self.cur = self.conn.cursor()
+        insert_or_update_event(self.cur, False, make_event(1, '2004-11-02 10:00:00', ['https://example.com/a.png']))
+        insert_or_update_event(self.cur, False, make_event(2, '2004-11-03 10:00:00', ['https://example.com/b.png']))
+        self.image_id = self.image('https://example.com/a.png')['id']
+        self.now = calendar.timegm(datetime.utcnow().utctimetuple())
+
+    def tearDown(self):
+        self.conn.close()
+
+    def image(self, url):
+        self.cur.execute("""
+            SELECT id, attempt_count, last_error, failed_permanently, next_attempt
+            FROM cached_images WHERE url = ?""", (url,))
+        row = self.cur.fetchone()
+        return {'id': row[0], 'attempt_count': row[1], 'last_error': row[2],
+                'failed_permanently': row[3], 'next_attempt': row[4]}
+
+    def due(self, days_from_now=0, retry=True):
+        images = get_images_to_cache(self.cur, False, self.now + days_from_now * 86400 + 1, retry=retry)
+        return [image['url'] for image in images]
+
+    def test_order(self):
+        self.assertEqual(self.due(), ['https://example.com/a.png', 'https://example.com/b.png'])
+        images = get_images_to_cache(self.cur, False, self.now, order='newest', limit=1)
+        self.assertEqual([image['url'] for image in images], ['https://example.com/b.png'])
+
+    def test_backoff(self):
+        # Each failure puts the next attempt twice as far off.
+        for days in [1, 2, 4]:
+            report_image_as_attempted(self.cur, False, self.image_id, 'timeout')
+            self.assertNotIn('https://example.com/a.png', self.due(days - 1))
+            self.assertIn('https://example.com/a.png', self.due(days))
+        self.assertEqual(self.image('https://example.com/a.png')['attempt_count'], 3)
+        self.assertNotIn('https://example.com/a.png', self.due(days, retry=False))
+
+    def test_gone_fails_for_good(self):
+        for attempt in range(0, image_gone_max_attempts - 1):
+            report_image_as_attempted(self.cur, False, self.image_id, 'http 404')
+        self.assertEqual(self.image('https://example.com/a.png')['failed_permanently'], 0)
+        report_image_as_attempted(self.cur, False, self.image_id, 'http 404')
+        self.assertEqual(self.image('https://example.com/a.png')['failed_permanently'], 1)
+        self.assertNotIn('https://example.com/a.png', self.due(image_retry_max_days + 1))
+
+    def test_other_errors_take_longer_to_give_up_on(self):
+        for attempt in range(0, image_max_attempts - 1):
+            report_image_as_attempted(self.cur, False, self.image_id, 'http 500')
+        self.assertEqual(self.image('https://example.com/a.png')['failed_permanently'], 0)
+        report_image_as_attempted(self.cur, False, self.image_id, 'http 500')
+        self.assertEqual(self.image('https://example.com/a.png')['failed_permanently'], 1)
+
+    def test_too_large(self):
+        report_image_as_attempted(self.cur, False, self.image_id, 'too large', 1000)
+        self.assertEqual(self.image('https://example.com/a.png')['failed_permanently'], 1)
+
+        # The same limit, or a lower one, doesn't bring it back.
+        allow_too_large_images_again(self.cur, False, 1000)
+        allow_too_large_images_again(self.cur, False, 500)
+        self.assertNotIn('https://example.com/a.png', self.due(image_retry_max_days + 1))
+
+        allow_too_large_images_again(self.cur, False, 2000)
+        self.assertEqual(self.image('https://example.com/a.png')['attempt_count'], 0)
+        self.assertIn('https://example.com/a.png', self.due())
+
+        # Other permanent failures stay failed, even with no limit at all.
+        image_id = self.image('https://example.com/b.png')['id']
+        for attempt in range(0, image_gone_max_attempts):
+            report_image_as_attempted(self.cur, False, image_id, 'http 410')
+        allow_too_large_images_again(self.cur, False, None)
+        self.assertEqual(self.due(), ['https://example.com/a.png'])
+
+    def test_success_clears_failures(self):
+        report_image_as_attempted(self.cur, False, self.image_id, 'timeout')
+        report_image_as_attempted(self.cur, False, self.image_id, 'timeout')
+        report_image_as_cached(self.cur, False, self.image_id, '2004-11/a.png', size=10)
+        image = self.image('https://example.com/a.png')
+        self.assertEqual((image['attempt_count'], image['last_error'], image['next_attempt']), (0, None, None))
+
+        # Once evicted, it starts over with a clean slate too.
+        report_image_file_as_evicted(self.cur, False, '2004-11/a.png')
+        allow_evicted_images_again(self.cur, False)
+        self.assertIn('https://example.com/a.png', self.due())
+        report_image_as_attempted(self.cur, False, self.image_id, 'timeout')
+        self.assertEqual(self.image('https://example.com/a.png')['attempt_count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
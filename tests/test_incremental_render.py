@@ -0,0 +1,106 @@
+# Renders a small journal more than once, and checks that a second run with nothing new
+# rewrites no pages, that an edit only rewrites the pages it touches, and that pages
+# a run no longer produces are cleaned up.
+
+import io, os, re, sys, shutil, sqlite3, tempfile, unittest
+from contextlib import redirect_stdout
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+from ljdumpsqlite import *
+from ljdumptohtml import ljdumptohtml
+
+
+def make_event(itemid, eventtime, subject=None):
+    return {
+        'itemid': itemid,
+        'anum': 1,
+        'eventtime': eventtime,
+        'logtime': eventtime,
+        'subject': subject,
+        'event': 'Entry %s' % itemid,
+        'url': 'https://example.dreamwidth.org/%s.html' % itemid,
+        'props': {'taglist': 'cats'},
+    }
+
+
+def make_comment(comment_id, entry_id, parent_id=None, body=None):
+    return {
+        'id': comment_id,
+        'entryid': entry_id,
+        'date': '2004-11-02T12:00:00Z',
+        'parentid': '' if parent_id is None else str(parent_id),
+        'posterid': 0,
+        'user': 'someone',
+        'subject': None,
+        'body': body or 'Comment %s' % comment_id,
+        'state': 'A',
+    }
+
+
+class IncrementalRenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        for support_file in ["stylesheet.css", "user.png"]:
+            shutil.copyfile(os.path.join(repo_path, support_file), support_file)
+        os.mkdir("j")
+        self.conn = sqlite3.connect("j/journal.db")
+        create_tables_if_missing(self.conn, False)
+        self.cur = self.conn.cursor()
+        for itemid in range(1, 6):
+            insert_or_update_event(self.cur, False, make_event(itemid, '2004-11-%02d 10:00:00' % itemid))
+        for comment_id in range(10, 22):
+            insert_or_update_comment(self.cur, False, make_comment(comment_id, 3, comment_id - 1 if comment_id > 10 else None))
+        for comment_id in range(30, 37):
+            insert_or_update_comment(self.cur, False, make_comment(comment_id, 4))
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.folder)
+
+    def render(self, **options):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            ljdumptohtml(username='j', journal_short_name='j', verbose=False, cache_images=False, **options)
+        counts = re.findall(r"^(\d+) (entry|history|year, month, and tag) pages were changed", output.getvalue(), re.M)
+        return dict((kind, int(count)) for (count, kind) in counts)
+
+    def test_rerun_changes_nothing(self):
+        self.assertEqual(self.render()['entry'], 5)
+        self.assertEqual(self.render(), {'entry': 0, 'history': 0, 'year, month, and tag': 0})
+
+    def test_edits(self):
+        self.render()
+        insert_or_update_comment(self.cur, False, make_comment(15, 3, 14, body='Edited comment'))
+        self.conn.commit()
+        # The history pages only show how many comments there are, which hasn't changed.
+        self.assertEqual(self.render(), {'entry': 1, 'history': 0, 'year, month, and tag': 0})
+        with open("j/entries/entry-3.html") as f:
+            self.assertIn("Edited comment", f.read())
+
+        # A new subject shows up on the entry and the index pages, but the neighbouring
+        # entries only link to it by number.
+        insert_or_update_event(self.cur, False, make_event(2, '2004-11-02 10:00:00', 'A subject'))
+        self.conn.commit()
+        changed = self.render()
+        self.assertEqual(changed['entry'], 1)
+        self.assertGreater(changed['year, month, and tag'], 0)
+
+    def test_left_over_pages_are_deleted(self):
+        self.render(comments_per_page=5, thread_depth=3)
+        paged = [f for f in os.listdir("j/entries") if re.search(r"-(p\d+|thread-\d+)\.html$", f)]
+        self.assertIn("entry-4-p2.html", paged)
+        self.assertIn("entry-3-thread-12.html", paged)
+
+        self.render()
+        self.assertEqual(sorted(os.listdir("j/entries")), ["entry-%s.html" % itemid for itemid in range(1, 6)])
+        self.assertEqual(self.render()['entry'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
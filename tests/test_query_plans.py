@@ -0,0 +1,110 @@
+# Checks that the read API in ljdumpsqlite is answered from indexes.
+# Each query is run against an empty database through a cursor that remembers what it
+# executed, then every statement is run again under EXPLAIN QUERY PLAN.
+
+import os, sys, sqlite3, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ljdumpsqlite import *
+
+
+class RecordingCursor:
+    def __init__(self, cur):
+        self.cur = cur
+        self.statements = []
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, params))
+        return self.cur.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        create_tables_if_missing(self.conn, False)
+        self.cur = RecordingCursor(self.conn.cursor())
+        self.entry = {'itemid': 1, 'eventtime_unix': 1000000000}
+
+    def tearDown(self):
+        self.conn.close()
+
+    # full_scans: Tables the query is meant to read every row of
+    def assertUsesIndexes(self, query, full_scans=()):
+        self.cur.statements = []
+        query(self.cur)
+        self.assertTrue(len(self.cur.statements) > 0)
+        for (sql, params) in self.cur.statements:
+            plan = [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            for step in plan:
+                self.assertNotIn("TEMP B-TREE", step, "%s\n%s" % (sql, plan))
+                # A constant row is a single value in the query itself, not a table.
+                if step.startswith("SCAN") and (step != "SCAN CONSTANT ROW") and (step.split()[1] not in full_scans):
+                    self.assertIn("USING", step, "%s\n%s" % (sql, plan))
+
+    def test_event_by_id(self):
+        self.assertUsesIndexes(lambda cur: get_event(cur, False, 1))
+
+    def test_first_page(self):
+        self.assertUsesIndexes(lambda cur: get_events_page(cur, False, None, 20))
+
+    def test_next_page(self):
+        self.assertUsesIndexes(lambda cur: get_events_page(cur, False, self.entry, 20))
+
+    def test_neighbors(self):
+        self.assertUsesIndexes(lambda cur: get_neighbor_events(cur, False, self.entry))
+
+    def test_date_range(self):
+        self.assertUsesIndexes(lambda cur: get_events_in_range(cur, False, 1000000000, 1100000000))
+
+    def test_month(self):
+        self.assertUsesIndexes(lambda cur: get_events_in_month(cur, False, 2004, 11))
+
+    def test_year(self):
+        self.assertUsesIndexes(lambda cur: get_events_in_year(cur, False, 2004))
+
+    def test_entries_with_tag(self):
+        self.assertUsesIndexes(lambda cur: get_entries_with_tag(cur, False, "cats"))
+
+    def test_entry_summaries_in_range(self):
+        self.assertUsesIndexes(lambda cur: get_entry_summaries_in_range(cur, False, 1000000000, 1100000000))
+
+    def test_entry_summaries_with_tag(self):
+        self.assertUsesIndexes(lambda cur: get_entry_summaries_with_tag(cur, False, "cats"))
+
+    def test_comments_for_entry(self):
+        self.assertUsesIndexes(lambda cur: get_comments_for_entry(cur, False, 1))
+
+    def test_entry_change_markers(self):
+        # Every entry is listed, but only from the index and the comment totals, never the comments themselves.
+        self.assertUsesIndexes(lambda cur: get_entry_change_markers(cur, False))
+
+    def test_events_by_id(self):
+        self.assertUsesIndexes(lambda cur: get_events_by_id(cur, False, [1, 2, 3]))
+
+    def test_comment_count_for_entry(self):
+        self.assertUsesIndexes(lambda cur: get_comment_count_for_entry(cur, False, 1))
+
+    def test_comment_thread_position(self):
+        self.conn.execute("INSERT INTO comments (id, entryid, parentid) VALUES (2, 1, 1)")
+        # The replies found so far are read back in full, and each step looks up the next ones by index.
+        self.assertUsesIndexes(lambda cur: update_comment_thread_position(cur, 2), full_scans=("subtree",))
+
+    def test_image_queue_oldest(self):
+        self.assertUsesIndexes(lambda cur: get_images_to_cache(cur, False, 1000000000, order='oldest', limit=32))
+
+    def test_image_queue_newest(self):
+        self.assertUsesIndexes(lambda cur: get_images_to_cache(cur, False, 1000000000, order='newest', limit=32))
+
+    def test_image_queue_referenced(self):
+        self.assertUsesIndexes(lambda cur: get_images_to_cache(cur, False, 1000000000, retry=False, order='referenced', limit=32))
+
+    def test_too_large_images(self):
+        self.assertUsesIndexes(lambda cur: allow_too_large_images_again(cur, False, 1000000))
+
+
+if __name__ == '__main__':
+    unittest.main()
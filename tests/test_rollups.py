@@ -0,0 +1,128 @@
+# Checks that the running totals kept alongside entries and comments stay in step with
+# the rows they count, as entries are added, moved to another month, and retagged.
+
+import os, sys, sqlite3, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ljdumpsqlite import *
+
+
+def make_event(itemid, eventtime, taglist=None, subject=None):
+    props = {}
+    if taglist is not None:
+        props['taglist'] = taglist
+    return {
+        'itemid': itemid,
+        'anum': 1,
+        'eventtime': eventtime,
+        'logtime': eventtime,
+        'subject': subject,
+        'event': 'Entry %s' % itemid,
+        'url': 'https://example.dreamwidth.org/%s.html' % itemid,
+        'props': props,
+    }
+
+
+def make_comment(comment_id, entry_id):
+    return {
+        'id': comment_id,
+        'entryid': entry_id,
+        'date': '',
+        'parentid': '',
+        'posterid': 0,
+        'user': 'someone',
+        'subject': None,
+        'body': 'Comment %s' % comment_id,
+        'state': 'A',
+    }
+
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        create_tables_if_missing(self.conn, False)
+        self.cur = self.conn.cursor()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def months(self):
+        return [(m['month'], m['entry_count'], m['first_itemid'], m['last_itemid'])
+                for m in get_month_entry_counts(self.cur, False)]
+
+    def test_months(self):
+        insert_or_update_event(self.cur, False, make_event(2, '2004-11-20 10:00:00'))
+        insert_or_update_event(self.cur, False, make_event(1, '2004-11-02 10:00:00'))
+        insert_or_update_event(self.cur, False, make_event(3, '2005-01-01 00:00:00'))
+        self.assertEqual(self.months(), [('2004-11', 2, 1, 2), ('2005-01', 1, 3, 3)])
+
+        # Moving an entry to another month takes it out of the first one.
+        insert_or_update_event(self.cur, False, make_event(1, '2005-01-05 10:00:00'))
+        self.assertEqual(self.months(), [('2004-11', 1, 2, 2), ('2005-01', 2, 3, 1)])
+        insert_or_update_event(self.cur, False, make_event(2, '2005-01-06 10:00:00'))
+        self.assertEqual(self.months(), [('2005-01', 3, 3, 2)])
+
+    def test_tags(self):
+        insert_or_update_event(self.cur, False, make_event(1, '2004-11-02 10:00:00', 'cats, dogs'))
+        insert_or_update_event(self.cur, False, make_event(2, '2004-11-03 10:00:00', 'cats'))
+        self.assertEqual(get_tag_entry_counts(self.cur, False), {'cats': 2, 'dogs': 1})
+
+        insert_or_update_event(self.cur, False, make_event(1, '2004-11-02 10:00:00', 'cats'))
+        self.assertEqual(get_tag_entry_counts(self.cur, False), {'cats': 2})
+        self.assertEqual([toc[0] for toc in get_entry_summaries_with_tag(self.cur, False, 'cats')], [1, 2])
+
+    def test_comments(self):
+        insert_or_update_event(self.cur, False, make_event(1, '2004-11-02 10:00:00'))
+        for comment_id in range(10, 15):
+            insert_or_update_comment(self.cur, False, make_comment(comment_id, 1))
+        # Comments can turn up before their entry does.
+        insert_or_update_comment(self.cur, False, make_comment(20, 2))
+        self.assertEqual(get_comment_count_for_entry(self.cur, False, 1), 5)
+        self.assertEqual(get_comment_count_for_entry(self.cur, False, 2), 1)
+
+        # An update to a comment already counted doesn't count it again.
+        insert_or_update_comment(self.cur, False, make_comment(10, 1))
+        self.assertEqual(get_comment_count_for_entry(self.cur, False, 1), 5)
+
+    def test_revisions(self):
+        insert_or_update_event(self.cur, False, make_event(1, '2004-11-02 10:00:00'))
+        insert_or_update_event(self.cur, False, make_event(2, '2004-11-01 10:00:00'))
+        markers = get_entry_change_markers(self.cur, False)
+        self.assertEqual([marker[0] for marker in markers], [2, 1])
+        self.assertEqual([marker[2:] for marker in markers], [(0, 0, 0), (0, 0, 0)])
+
+        insert_or_update_event(self.cur, False, make_event(1, '2004-11-02 10:00:00', subject='Edited'))
+        insert_or_update_comment(self.cur, False, make_comment(10, 2))
+        insert_or_update_comment(self.cur, False, make_comment(11, 2))
+        # Storing a comment again counts as a change, since it might have been edited.
+        insert_or_update_comment(self.cur, False, make_comment(11, 2))
+        markers = get_entry_change_markers(self.cur, False)
+        self.assertEqual([marker[2:] for marker in markers], [(0, 2, 3), (1, 0, 0)])
+
+    def test_summaries(self):
+        insert_or_update_event(self.cur, False, make_event(1, '2004-11-02 10:00:00', subject='First'))
+        insert_or_update_event(self.cur, False, make_event(2, '2004-11-30 23:59:59'))
+        insert_or_update_event(self.cur, False, make_event(3, '2004-12-01 00:00:00'))
+        (start_unix, end_unix) = month_range_unix(2004, 11)
+        tocs = get_entry_summaries_in_range(self.cur, False, start_unix, end_unix)
+        self.assertEqual([(toc[0], toc[2]) for toc in tocs], [(1, 'First'), (2, '(no subject)')])
+
+    def test_backfill_matches(self):
+        insert_or_update_event(self.cur, False, make_event(1, '2004-11-02 10:00:00', 'cats, dogs'))
+        insert_or_update_event(self.cur, False, make_event(2, '2004-12-03 10:00:00', 'cats'))
+        insert_or_update_event(self.cur, False, make_event(3, '2004-12-04 10:00:00'))
+        for comment_id in range(10, 13):
+            insert_or_update_comment(self.cur, False, make_comment(comment_id, comment_id % 2 + 1))
+        months = self.months()
+        tags = get_tag_entry_counts(self.cur, False)
+        comments = [get_comment_count_for_entry(self.cur, False, itemid) for itemid in [1, 2, 3]]
+
+        migrate_backfill_counts(self.conn, False)
+        self.assertEqual(self.months(), months)
+        self.assertEqual(get_tag_entry_counts(self.cur, False), tags)
+        self.assertEqual([get_comment_count_for_entry(self.cur, False, itemid) for itemid in [1, 2, 3]], comments)
+
+
+if __name__ == '__main__':
+    unittest.main()
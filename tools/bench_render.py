@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# bench_render.py - time page generation on made-up journals
+#
+# Builds a journal database full of generated entries and comments, then times a full
+# run of ljdumptohtml on it, from an empty output folder.  Two kinds of journal:
+#
+#   journal   10,000 entries over about 27 years, with about 78,000 comments between them
+#   comments  one entry with 8,000 comments, threaded several levels deep
+#
+# The same random seed is used every time, so runs can be compared.  To compare two
+# versions of the code, check the older one out somewhere else and point --code at it:
+#
+#   git worktree add /tmp/before <commit>
+#   python3 tools/bench_render.py journal --code /tmp/before
+#   python3 tools/bench_render.py journal
+#
+# Each run happens in a fresh process and a fresh temporary folder, so nothing carries
+# over from one to the next.  Only the page generation is timed, not building the database.
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2024 Garrett Birkel and contributors
+
+import sys, os, argparse, random, shutil, subprocess, tempfile, time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+
+default_code_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+tags = ['food', 'travel', 'pixel art', 'Work & Life', 'games', 'family', 'misc']
+users = ['alice', 'bob', 'carol', 'dave', None]
+first_entry_time = 1100000000
+
+
+def make_comment(rng, comment_id, entry_id, parent_id, comment_time):
+    return {
+        'id': comment_id,
+        'entryid': entry_id,
+        'date': datetime.utcfromtimestamp(comment_time).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'parentid': '' if parent_id is None else str(parent_id),
+        'posterid': str(rng.randint(1, 50)),
+        'user': rng.choice(users),
+        'subject': rng.choice([None, None, 'Re: that thing']),
+        'body': 'Comment %s\nwith a line break, <b>some bold</b> & an ampersand.' % comment_id,
+        'state': 'A'
+    }
+
+
+# Replies go to one of the last few comments most of the time, so threads get a few levels deep.
+def pick_parent(rng, comment_ids):
+    if (len(comment_ids) == 0) or (rng.random() < 0.4):
+        return None
+    return rng.choice(comment_ids[-10:])
+
+
+# entry_count: Entries to make
+# comment_counts: Function taking the random generator and an entry number, returning how
+#   many comments that entry gets
+def generate_journal(ljdumpsqlite, db_file, entry_count, comment_counts):
+    rng = random.Random(1)
+    conn = ljdumpsqlite.connect_to_local_journal_db(db_file, False)
+    ljdumpsqlite.create_tables_if_missing(conn, False)
+    cur = conn.cursor()
+    ljdumpsqlite.get_sync_status_or_defaults(cur, "", 0)
+    comment_id = 1
+    for itemid in range(1, entry_count + 1):
+        eventtime = first_entry_time + (itemid * 86400) + rng.randint(0, 80000)
+        paragraphs = ['Paragraph %s of entry %s, with <i>some markup</i> & an ampersand.' % (n, itemid) for n in range(rng.randint(1, 8))]
+        props = {'commentalter': eventtime}
+        if rng.random() < 0.7:
+            props['taglist'] = ', '.join(rng.sample(tags, rng.randint(1, 3)))
+        if rng.random() < 0.3:
+            props['current_music'] = 'Song number %s' % itemid
+        event = {
+            'itemid': itemid,
+            'anum': itemid % 256,
+            'eventtime': datetime.utcfromtimestamp(eventtime).strftime('%Y-%m-%d %H:%M:%S'),
+            'logtime': datetime.utcfromtimestamp(eventtime).strftime('%Y-%m-%d %H:%M:%S'),
+            'subject': 'Entry number %s' % itemid,
+            'event': '\n\n'.join(paragraphs),
+            'url': 'https://example.dreamwidth.org/%s.html' % (itemid * 256),
+            'props': props
+        }
+        ljdumpsqlite.insert_or_update_event(cur, False, event)
+
+        comment_ids = []
+        for n in range(comment_counts(rng, itemid)):
+            parent_id = pick_parent(rng, comment_ids)
+            ljdumpsqlite.insert_or_update_comment(cur, False, make_comment(rng, comment_id, itemid, parent_id, eventtime + n * 60))
+            comment_ids.append(comment_id)
+            comment_id += 1
+    ljdumpsqlite.finish_with_database(conn, cur)
+    return comment_id - 1
+
+
+journal_kinds = {
+    'journal': lambda args: (args.entries, lambda rng, itemid: rng.choice([0, 0, 1, 2, 3, 5, 10, 20, 30])),
+    'comments': lambda args: (1, lambda rng, itemid: args.comments)
+}
+
+
+# Build the journal and time one full run of ljdumptohtml on it, in this process.
+def run_once(args):
+    sys.path.insert(0, args.code)
+    import ljdumpsqlite
+    from ljdumptohtml import ljdumptohtml
+
+    folder = tempfile.mkdtemp(prefix="bench_render_")
+    try:
+        os.chdir(folder)
+        os.mkdir("bench")
+        for support_file in ["stylesheet.css", "user.png"]:
+            shutil.copyfile(os.path.join(args.code, support_file), support_file)
+        (entry_count, comment_counts) = journal_kinds[args.kind](args)
+        comment_count = generate_journal(ljdumpsqlite, "bench/journal.db", entry_count, comment_counts)
+
+        options = {}
+        if args.jobs > 1:
+            options['jobs'] = args.jobs
+        started = time.perf_counter()
+        with open(os.devnull, "w") as quiet:
+            with redirect_stdout(quiet):
+                ljdumptohtml(username='bench', journal_short_name='bench', verbose=False, cache_images=False, **options)
+        elapsed = time.perf_counter() - started
+        print("%s entries, %s comments: %.2fs" % (entry_count, comment_count, elapsed))
+    finally:
+        os.chdir("/")
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Time page generation on a made-up journal")
+    args.add_argument("kind", choices=sorted(journal_kinds.keys()),
+                      help="'journal' for lots of entries, 'comments' for one entry with lots of comments")
+    args.add_argument('--code', default=default_code_path, dest='code',
+                      help='Folder with the version of ljdumptohtml.py to time.  Default is this one.')
+    args.add_argument('--runs', type=int, default=1, dest='runs',
+                      help='Number of times to run it.  Default is 1.')
+    args.add_argument('--entries', type=int, default=10000, dest='entries',
+                      help='Number of entries in the journal kind.  Default is 10000.')
+    args.add_argument('--comments', type=int, default=8000, dest='comments',
+                      help='Number of comments in the comments kind.  Default is 8000.')
+    args.add_argument('--jobs', '-j', type=int, default=1, dest='jobs',
+                      help='Number of processes to generate pages with, if the code has --jobs.  Default is 1.')
+    args.add_argument('--one_run', action='store_true', dest='one_run', help=argparse.SUPPRESS)
+    args = args.parse_args()
+    args.code = os.path.abspath(args.code)
+
+    if args.one_run:
+        run_once(args)
+    else:
+        print("Timing %s from %s" % (args.kind, args.code))
+        for n in range(args.runs):
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--one_run"] + sys.argv[1:], check=True)